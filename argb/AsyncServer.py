@@ -1,133 +1,526 @@
-from asyncio import Protocol, get_event_loop
+from asyncio import Event, Protocol, gather, get_event_loop, sleep
+from time import monotonic
+from functools import partial
 from serial_asyncio import create_serial_connection
-from traceback import format_exc
 
-from .messages import set_light as build_set_light
-from .messages import Request
-from .stream import PacketProcessor
+from .messages import set_light_key, commit_key, request_key, ACKNOWLEDGEMENTS
+from .stream import PacketProcessor, Dispatcher
+from .framing import FrameSplitter
+from .batching import FrameBatcher
+from .mirror import LightMirror, Scene
+from .cache import FrameCache
+from .budget import LinkBudget, DEFAULT_BAUDRATE
+from .crc import DEFAULT_ENGINE
+from .metrics import Metrics
+from .capture import Capture, IN, OUT
+from .log import get_logger, limited, flush_limited, set_debug, DEBUG
+from .link import LinkQuality, RUNT, RESYNCING, REJECTION_CODES, SETTLE_TIME
+from .recovery import QUEUE, DROP, READY_TIMEOUT
 
 class ARGBProtocol(Protocol):
-    def __init__(self, *args, **kwargs):
-        self.logging_enabled = True
+    def __init__(self, *args, crc=DEFAULT_ENGINE, cache_size=64, baudrate=DEFAULT_BAUDRATE, **kwargs):
+        self.logger = get_logger('protocol')
         self.delegate = None
-        self.input_buffer = bytearray()
-        self.packet = PacketProcessor()
+        self.framer = FrameSplitter()
+        self.metrics = Metrics('protocol')
+        self.link = LinkQuality()
+        self.link.listeners.append(self._link_changed)
+        self.packet = PacketProcessor(crc, metrics=self.metrics, link=self.link)
         self.incoming = 0
         self.outgoing = 0
+        self.batcher = FrameBatcher(self._write_data)
+        self.mirror = LightMirror()
+        self.scene = Scene()
+        self.cache = FrameCache(cache_size)
+        self.budget = LinkBudget(baudrate)
+        self.capture = Capture()
+        self.dispatcher = Dispatcher(default=self._on_response)
+        self.dispatcher.register('log', self._on_log)
+        self.dispatcher.register('current_time', self._on_current_time)
+        self.dispatcher.register('debug', self._on_debug_message)
+        self.dispatcher.register('error', self._on_error)
+        # (high, low) transport write buffer limits, or None for the
+        # transport's defaults. By default writing pauses once about a
+        # quarter of a second of data is waiting to be sent.
+        high = int(self.budget.bytes_per_second / 4)
+        self.write_buffer_limits = (high, high // 4)
+        # While writing is paused, the link is resyncing or responses to
+        # requests written before a rejected frame are on their way, requests
+        # are held back with only the latest set_light per light and the
+        # latest commit kept.
+        self.paused = False
+        self._writable = Event()
+        self._writable.set()
+        self._held_lights = {}
+        self._held_commit = None
+        self._held_other = []
+        self._paused_at = None
+        self._resync_timer = None
+        self._settle_timer = None
+        self.pauses = 0
+        self.paused_time = 0.0
+        self.frames_superseded = 0
+        # Set while the connection is lost or hasn't been restored yet, when
+        # requests are held back under the QUEUE policy and dropped under
+        # DROP (see supervisor).
+        self.suspended = False
+        self.policy = QUEUE
+        self.frames_dropped = 0
+        # Whether the event loop is stopped once the connection is lost.
+        self.stop_loop = True
+        # Whether the delegate asked for the connection to be closed.
+        self.stopped = False
+        # Called with the protocol when the device sends the ready log,
+        # before the delegate, and when the connection is lost.
+        self.ready_listeners = []
+        self.lost_listeners = []
         super().__init__(*args, **kwargs)
 
     def set_delegate(self, delegate):
         self.delegate = delegate
 
-    def log(self, msg):
-        print(f'protocol: {msg}')
+    @property
+    def logging_enabled(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging_enabled.setter
+    def logging_enabled(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
 
     def connection_made(self, transport):
         self.transport = transport
-        self.transport.set_write_buffer_limits(80, 40)
-        self.log('connection made')
+        if self.write_buffer_limits is not None:
+            self.transport.set_write_buffer_limits(*self.write_buffer_limits)
+        self.logger.info('connection made')
     
     def connection_lost(self, exc):
-        self.log('connection lost')
+        self.logger.info('connection lost')
+        self.suspended = True
+        for timer in (self._settle_timer, self._resync_timer):
+            if timer is not None:
+                timer.cancel()
+        self._settle_timer = self._resync_timer = None
+        flush_limited(self.logger)
+        flush_limited(self.packet.logger)
+        self.capture.close()
         self.delegate.completed(self)
-        self.transport.loop.stop()
+        for listener in self.lost_listeners:
+            listener(self)
+        if self.stop_loop:
+            self.transport.loop.stop()
 
     def data_received(self, data):
-        self.input_buffer.extend(data)
+        self.metrics.count('bytes_in', amount=len(data))
+        if self.capture.enabled:
+            self.capture.record(IN, data)
+        self.framer.feed(data)
         self.detect_packets()
     
     def pause_writing(self):
         self.log('pause writing')
+        self.paused = True
+        self._writable.clear()
+        self._paused_at = monotonic()
+        self.pauses += 1
 
     def resume_writing(self):
         self.log('resume writing')
+        self.paused = False
+        self._writable.set()
+        if self._paused_at is not None:
+            self.paused_time += monotonic() - self._paused_at
+            self._paused_at = None
+        if self.link.state != RESYNCING and self._settle_timer is None:
+            self._release_held()
+
+    def _link_changed(self, link, health):
+        if health == RESYNCING:
+            self._resync()
+            return
+        self.log('link %s', health)
+        if self._resync_timer is not None:
+            self.logger.info('link resynced')
+            self._resync_timer.cancel()
+            self._resync_timer = None
+            if not self.paused and self._settle_timer is None:
+                self._release_held()
+
+    def _resync(self):
+        # Whatever is buffered may be misaligned, and requests in flight may
+        # never be answered.
+        self.logger.warning('resyncing the link, %s', self.link.reason)
+        self.framer.resync()
+        self.mirror.invalidate()
+        self.metrics.forget()
+        # The link is checked again once the responses on their way are in.
+        self._resync_timer = get_event_loop().call_later(
+            self.link.settle_time, lambda: self.link.health)
+
+    def flow_statistics(self):
+        paused_time = self.paused_time
+        if self._paused_at is not None:
+            paused_time += monotonic() - self._paused_at
+        return {
+            'paused': self.paused,
+            'pauses': self.pauses,
+            'paused_time': paused_time,
+            'frames_superseded': self.frames_superseded,
+            'frames_dropped': self.frames_dropped,
+            'held': len(self._held_lights) + len(self._held_other) + (self._held_commit is not None),
+        }
 
     def process_packet(self, data):
         result = self.packet.process(data)
         if result is None:
             return
-        t, message = result
-        if t == 'Response':
-            if message.HasField('log') and message.log.id == 9:
-                try:
-                    self.delegate.ready(self)
-                except:
-                    print(format_exc())
-            else:
-                try:
-                    should_stop = self.delegate.process(self, message)
-                except:
-                    print(format_exc())
-                if should_stop:
-                    self.transport.close()
-        elif t == 'DebugMessage':
-            try:
-                self.delegate.debug_message(self, message)
-            except:
-                print(format_exc())
+        self.dispatcher.dispatch(*result)
+
+    def _on_log(self, message):
+        if message.log.id == 9:
+            self.link.ready()
+            self.ready()
+        elif message.log.is_error and message.log.id in REJECTION_CODES:
+            self.link.rejected(message)
+            self._rejected()
+            self._on_response(message)
         else:
-            # error, exception
-            print(t, message)
+            self.mirror.acknowledged(message.log.is_error)
+            self.metrics.acknowledged('log')
+            self._on_response(message)
+
+    def ready(self):
+        '''
+        Handles the device being ready, after its ready log or once it is
+        assumed to be running without one.
+        '''
+        self.mirror.invalidate()
+        self.metrics.forget()
+        for listener in self.ready_listeners:
+            listener(self)
+        try:
+            self.delegate.ready(self)
+        except Exception:
+            self.logger.exception('the delegate failed handling the ready log')
+
+    def _rejected(self):
+        # The frame the device couldn't read may have been any of those
+        # written, so the responses on their way can't be matched to the
+        # requests any more. They are let through before sending again.
+        limited(self.logger, 'rejected', 'frame rejected by the device')
+        self.mirror.invalidate()
+        self.metrics.forget()
+        if self._settle_timer is not None:
+            self._settle_timer.cancel()
+        # Frames still buffered are answered too once they are written.
+        buffered = self.transport.get_write_buffer_size()
+        self._settle_timer = get_event_loop().call_later(
+            SETTLE_TIME + self.budget.airtime(buffered), self._settled)
+
+    def _settled(self):
+        self._settle_timer = None
+        if not self.paused and self.link.state != RESYNCING:
+            self._release_held()
+
+    def _on_current_time(self, message):
+        self.metrics.acknowledged('current_time')
+        self._on_response(message)
+
+    def _on_response(self, message):
+        should_stop = False
+        try:
+            should_stop = self.delegate.process(self, message)
+        except Exception:
+            self.logger.exception('the delegate failed processing a message')
+        if should_stop:
+            self.stopped = True
+            self.batcher.flush()
+            self.transport.close()
+
+    def _on_debug_message(self, message):
+        try:
+            self.delegate.debug_message(self, message)
+        except Exception:
+            self.logger.exception('the delegate failed handling a debug message')
+
+    def _on_error(self, error):
+        limited(self.logger, 'decode', 'error %s', error)
 
     def detect_packets(self):
-        start_of_message = None
-        drop_up_to = None
-        for (index, element) in enumerate(self.input_buffer):
-            if element != 0 and start_of_message is None:
-                start_of_message = index
-            elif element == 0 and start_of_message is not None:
-                buffer = self.input_buffer[start_of_message:index]
-                start_of_message = None
-                drop_up_to = index
-                if len(buffer) > 0:
-                    self.incoming += 1
-                    if len(buffer) <= 4:
-                        self.log('detected message without a crc')
-                    else:
-                        self.process_packet(buffer)
-        if drop_up_to is not None:
-            self.input_buffer = self.input_buffer[drop_up_to:]
-
-    def set_light(self, *args, **kwargs):
-        request = build_set_light(*args, **kwargs)
-        self.send_request(request)
-
-    def send_request(self, msg):
-        encoded_data = self.packet.encode(msg)
-        self.transport.write(encoded_data)
-        self.transport.write(b'\x00')
+        for frame in self.framer:
+            self.incoming += 1
+            if len(frame) <= 4:
+                self.metrics.count('runts')
+                self.link.record(RUNT)
+                limited(self.logger, 'runt', 'detected message without a crc')
+            else:
+                self.process_packet(frame)
+
+    def set_light(self, *args, force=False, **kwargs):
+        self._send_key(set_light_key(*args, **kwargs), force=force)
+
+    def _write_data(self, data):
+        if self.capture.enabled:
+            self.capture.record(OUT, data)
+        self.transport.write(data)
+
+    def send_request(self, msg, force=False):
+        self._send_key(request_key(msg), force)
+
+    def send_key(self, key, force=False):
+        '''
+        Sends the request identified by key, see messages.request_key.
+        '''
+        self._send_key(key, force)
+
+    async def send(self, msg, force=False):
+        '''
+        Waits while writing is paused, then sends the request.
+        '''
+        await self._writable.wait()
+        self.send_request(msg, force)
+
+    def _hold(self, key, force):
+        kind, value = key
+        if kind == 'set_light':
+            if value[0] in self._held_lights:
+                self.frames_superseded += 1
+            self._held_lights[value[0]] = (key, force)
+        elif kind == 'commit_transaction':
+            if self._held_commit is not None:
+                self.frames_superseded += 1
+            self._held_commit = (key, force)
+        else:
+            self._held_other.append((key, force))
+
+    def adopt_held(self, other):
+        '''
+        Takes over the requests other held back, e.g. the protocol of a lost
+        connection, and sends them unless requests are being held back.
+        '''
+        for key, force in other._held_other + list(other._held_lights.values()):
+            self._hold(key, force)
+        if other._held_commit is not None:
+            self._hold(*other._held_commit)
+        other._held_lights = {}
+        other._held_commit = None
+        other._held_other = []
+        if not (self.paused or self.suspended or self.link.state == RESYNCING or self._settle_timer is not None):
+            self._release_held()
+
+    def _release_held(self):
+        # Lights are sent before the commit, so a light changed after a held
+        # commit is applied by it rather than by the next commit.
+        held = self._held_other + list(self._held_lights.values())
+        if self._held_commit is not None:
+            held.append(self._held_commit)
+        self._held_lights = {}
+        self._held_commit = None
+        self._held_other = []
+        with self.batch():
+            for key, force in held:
+                self._send_key(key, force)
+
+    def _send_key(self, key, force=False):
+        if self.suspended and self.policy == DROP:
+            self.frames_dropped += 1
+            return
+        if self.suspended or self.paused or self.link.state == RESYNCING or self._settle_timer is not None:
+            self._hold(key, force)
+            return
+        if not self.mirror.should_send(key, force):
+            return
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self.packet.encode_key(key)
+            self.cache.put(key, frame)
+        self.mirror.sent(key, len(frame))
+        self.scene.sent(key)
+        self.budget.record(len(frame))
+        self.batcher.add(frame)
         self.outgoing += 1
+        metrics = self.metrics
+        if metrics.enabled:
+            metrics.count('messages_out', key[0])
+            metrics.count('bytes_out', amount=len(frame))
+            kind = ACKNOWLEDGEMENTS.get(key[0])
+            if kind is not None:
+                metrics.expect(kind)
 
-    def commit(self, delta):
-        request = Request()
-        message = request.commit_transaction
-        message.timestamp = delta
-        self.send_request(request)
+    def batch(self):
+        return self.batcher.batch()
+
+    def commit(self, delta, force=False):
+        self._send_key(commit_key(delta), force=force)
+
+    def replay_scene(self, staged=True):
+        '''
+        Sends the last committed scene again, in one batch, e.g. after the
+        device reset. Returns the number of requests sent.
+        '''
+        keys = self.scene.replay(staged)
+        with self.batch():
+            for key in keys:
+                self._send_key(key, force=True)
+        return len(keys)
 
 
 class AsyncServer:
-    def __init__(self, device, delegate):
+    '''
+    Connects a delegate to a device.
+
+    By default the event loop is stopped when the connection is lost. With
+    reconnect the port is opened again instead, with exponential backoff
+    starting at backoff seconds, and whenever the device sends the ready
+    log, after reconnecting or after resetting on its own, the last
+    committed scene is replayed before the delegate's ready is called. A
+    device which doesn't reset when the port is opened again is assumed to
+    be running after ready_timeout seconds without a ready log.
+
+    Requests made while the connection is lost or being restored are
+    handled according to policy, as by a Supervisor: under QUEUE they are
+    held back and sent after the replay, which includes the set_light
+    requests which weren't committed yet; under DROP they are dropped, as
+    are the uncommitted set_light requests.
+    '''
+    def __init__(self, device, delegate, crc=DEFAULT_ENGINE, baudrate=DEFAULT_BAUDRATE, reconnect=False,
+                 backoff=0.05, max_backoff=2.0, ready_timeout=READY_TIMEOUT, policy=QUEUE):
+        if policy not in (QUEUE, DROP):
+            raise ValueError(f'unknown policy: {policy}')
+        self.device = device
         self.delegate = delegate
+        self.crc = crc
+        self.baudrate = baudrate
+        self.reconnect = reconnect
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ready_timeout = ready_timeout
+        self.policy = policy
         self.logging_enabled = False
+        self.logger = get_logger('server')
         self.loop = get_event_loop()
-        self.connection = create_serial_connection(
+        self.transport = None
+        self.protocol = None
+        # The protocol of the lost connection, whose held requests are sent
+        # once the new one has been restored.
+        self._previous = None
+        self._ready_timer = None
+        self.closing = False
+        self.outages = 0
+        self.attempts = 0
+        self._lost_at = None
+        # Seconds from losing the connection to the scene being replayed.
+        self.restore_times = []
+        self.connection = self._create_connection()
+
+    def _create_connection(self):
+        return create_serial_connection(
                 self.loop, 
-                ARGBProtocol, 
-                device, 
-                baudrate=9600)
+                partial(ARGBProtocol, crc=self.crc, baudrate=self.baudrate),
+                self.device,
+                baudrate=self.baudrate)
 
-    def log(self, msg):
-        print(f'server: {msg}')
+    def log(self, msg, *args):
+        self.logger.info(msg, *args)
 
-    def main(self):
-        transport, protocol = self.loop.run_until_complete(self.connection)
+    def _connected(self, connection):
+        transport, protocol = connection
         protocol.logging_enabled = self.logging_enabled
         protocol.set_delegate(self.delegate)
-        try:
-            self.loop.run_forever()
-        except KeyboardInterrupt:
-            print()
-            transport.close()
-            self.loop._run_once()
-        self.loop.close()
+        protocol.policy = self.policy
+        if self.reconnect:
+            protocol.stop_loop = False
+            protocol.lost_listeners.append(self._lost)
+            protocol.ready_listeners.append(self._ready)
+            if self.protocol is not None:
+                # The scene outlives the connection it was sent over.
+                protocol.scene = self.protocol.scene
+                protocol.suspended = True
+                self._previous = self.protocol
+        self.transport = transport
+        self.protocol = protocol
+        return transport
+
+    def _lost(self, protocol):
+        if self.closing or protocol.stopped:
+            self.loop.stop()
+            return
+        if self._ready_timer is not None:
+            self._ready_timer.cancel()
+            self._ready_timer = None
+        self.outages += 1
+        if self._lost_at is None:
+            self._lost_at = monotonic()
+        self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = self.backoff
+        while not self.closing:
+            # A port which just dropped is rarely back straight away.
+            await sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+            self.attempts += 1
+            try:
+                connection = await self._create_connection()
+            except OSError as error:
+                self.logger.debug('reconnecting failed: %s', error)
+                continue
+            self._connected(connection)
+            self.log('reconnected to %s', self.device)
+            self._ready_timer = self.loop.call_later(self.ready_timeout, self._ready_timed_out, self.protocol)
+            return
+
+    def _ready_timed_out(self, protocol):
+        self._ready_timer = None
+        self.logger.info('no ready log within %g s, assuming the device is running', self.ready_timeout)
+        protocol.ready()
+
+    def _ready(self, protocol):
+        if self._ready_timer is not None:
+            self._ready_timer.cancel()
+            self._ready_timer = None
+        if self.policy == DROP:
+            protocol.scene.drop_staged()
+        protocol.suspended = False
+        with protocol.batch():
+            count = protocol.replay_scene(staged=self.policy == QUEUE)
+            if self._previous is not None:
+                protocol.adopt_held(self._previous)
+                self._previous = None
+        if self._lost_at is not None:
+            elapsed = monotonic() - self._lost_at
+            self._lost_at = None
+            self.restore_times.append(elapsed)
+            self.log('output restored in %.3f s, %d requests replayed', elapsed, count)
+
+    def close(self):
+        self.closing = True
+        if self._ready_timer is not None:
+            self._ready_timer.cancel()
+            self._ready_timer = None
+        if self.transport is not None:
+            self.transport.close()
+
+    def main(self):
+        run_servers([self])
+
 
+def run_servers(servers):
+    '''
+    Connects all servers, which must share an event loop, at once and runs
+    the loop until interrupted.
+    '''
+    loop = servers[0].loop
+    connections = loop.run_until_complete(gather(*(server.connection for server in servers)))
+    for server, connection in zip(servers, connections):
+        server._connected(connection)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print()
+        for server in servers:
+            server.close()
+        loop._run_once()
+    loop.close()
@@ -1,7 +1,6 @@
-from .coms import *
-from .server import Request
-from .stack_measurement import StackMeasurement
-import pandas as pd
+from time import sleep
+from .messages import build_request
+from .stack_measurement import StackAggregator
 
 def sequence(server):
     for x in range(0, 20):
@@ -23,8 +22,14 @@ def sequence(server):
                 ahds=(0, 0, 0, 0))
 
 class DebugMonitor:
-    def __init__(self):
-        self.stack_measurements = []
+    '''
+    Stops after limit stack measurements, or never if limit is None, and
+    prints a summary every summary_interval measurements if it is set.
+    '''
+    def __init__(self, limit=100, summary_interval=None):
+        self.stack = StackAggregator()
+        self.limit = limit
+        self.summary_interval = summary_interval
 
     def log(self, msg):
         print(f'debug monitor: {msg}')
@@ -68,27 +73,26 @@ class DebugMonitor:
         server.commit(3000)
 
     def current_time(self, server):
-        request = Request()
-        request.current_time_request = True
-        server.send_request(request)
+        server.send_request(build_request(('current_time_request', True)))
 
     def process(self, server, msg):
         # Respond to messages here.
         if msg.HasField('stack_measurement'):
-            self.stack_measurements.append(StackMeasurement(msg))
+            self.stack.add(msg.stack_measurement)
+            if self.summary_interval and self.stack.count % self.summary_interval == 0:
+                print(self.stack.format())
         elif msg.HasField('log') and msg.log.id == 2:
             self.log('resending message')
             self.send_message(server)
         else:
             self.log(str(msg))
-        return len(self.stack_measurements) >= 100
+        return self.limit is not None and self.stack.count >= self.limit
     
     def debug_message(self, server, msg):
         self.log(msg)
 
     def completed(self, server):
         self.log('completed')
-        results = pd.json_normalize([obj.todict() for obj in self.stack_measurements])
-        print(results.groupby('id').agg(['min', ('mode', lambda x: x.mode()), 'max']).transpose().to_string())
+        print(self.stack.format())
         #for line in server.connection.received.hex('-').split('00'):
         #    print(line)
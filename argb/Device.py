@@ -1,8 +1,17 @@
 from serial_asyncio import open_serial_connection
-from .stream import PacketProcessor
-from asyncio import Queue, get_event_loop
-from .messages import Response, Request, DebugMessage
-from .messages import set_light as build_set_light, commit as build_commit
+from .stream import PacketProcessor, Dispatcher
+from .crc import DEFAULT_ENGINE
+from .batching import FrameBatcher
+from .mirror import LightMirror, Scene
+from .cache import FrameCache
+from .budget import LinkBudget, DEFAULT_BAUDRATE
+from .metrics import Metrics
+from .capture import Capture, IN, OUT
+from .log import get_logger, limited, flush_limited, set_debug, DEBUG, hexdump, one_line
+from .link import LinkQuality, RUNT, RESYNCING, REJECTION_CODES, SETTLE_TIME
+from asyncio import Event, Queue, Semaphore, CancelledError, TimeoutError, gather, get_event_loop, wait_for
+from collections import deque
+from .messages import set_light_key, commit_key, request_key, ACKNOWLEDGEMENTS
 
 class DebugDelegate:
     def log(self, msg):
@@ -15,98 +24,441 @@ class DebugDelegate:
         self.log('error')
 
 class Device:
-    def __init__(self, device, delegate=None):
+    '''
+    By default each write waits for the device's response before returning.
+    Passing a window enables pipelining: up to window acknowledged requests
+    can be in flight at once, and a reader task matches responses to
+    requests in the order they were sent.
+
+    The quality of the link is tracked in link (see LinkQuality). When it
+    resyncs, requests in flight fail with ConnectionResetError, frames are
+    dropped until it has settled and new requests wait for it.
+    They fail the same way when the device reports a frame it couldn't
+    read, as the responses can no longer be matched to the requests, and
+    new requests wait until the responses still on their way are in.
+    '''
+    def __init__(self, device, delegate=None, crc=DEFAULT_ENGINE, window=None, cache_size=64,
+                 baudrate=DEFAULT_BAUDRATE, ready_timeout=None):
         self.port = device
+        self.baudrate = baudrate
         self.reader = None
         self.writer = None
         self.delegate = delegate
         self.incoming = 0
         self.outgoing = 0
-        self.packet = PacketProcessor()
+        self.metrics = Metrics('device')
+        self.link = LinkQuality()
+        self.link.listeners.append(self._link_changed)
+        self._link_ready = Event()
+        self._link_ready.set()
+        self._resync_timer = None
+        self._settle_timer = None
+        self.packet = PacketProcessor(crc, metrics=self.metrics, link=self.link)
         self.write_queue = Queue()
-        self.logging = False
+        self.logger = get_logger('device')
+        self.window = window
+        self.in_flight = {'log': deque(), 'current_time': deque()}
+        self._window_slots = None
+        self._reader_task = None
+        self.batcher = FrameBatcher(self._write_data)
+        self.mirror = LightMirror()
+        self.scene = Scene()
+        # Called with the device whenever it sends the ready log after a
+        # reset, once it has been opened.
+        self.ready_listeners = []
+        # Seconds to wait for the ready log when opening, or None to wait
+        # indefinitely. A device which was opened without resetting, e.g.
+        # with hupcl turned off, doesn't send one.
+        self.ready_timeout = ready_timeout
+        self.cache = FrameCache(cache_size)
+        self.budget = LinkBudget(baudrate)
+        self.capture = Capture()
+        self.dispatcher = Dispatcher(default=self._unsolicited)
+        self.dispatcher.register('debug', self._debug_message)
+        self.dispatcher.register('log', self._on_log)
+        self.dispatcher.register('current_time', self._on_current_time)
 
-    def log(self, msg):
-        if self.logging:
-            print(f'device: {msg}')
+    @property
+    def logging(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging.setter
+    def logging(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
 
     async def __aenter__(self):
         self.log('enter')
-        self.reader, self.writer = await open_serial_connection(url=self.port, baudrate=9600)
+        await self._open()
         # Discard messages where the beginning has been missed.
         await self.reader.readuntil(separator=b'\x00')
-        await self._wait_until_ready()
+        if self.ready_timeout is None:
+            await self._wait_until_ready()
+        else:
+            try:
+                await wait_for(self._wait_until_ready(), self.ready_timeout)
+            except TimeoutError:
+                self.logger.info('no ready log within %g s, assuming the device is running',
+                                 self.ready_timeout)
+        if self.window is not None:
+            self._window_slots = Semaphore(self.window)
+            self._reader_task = get_event_loop().create_task(self._read_responses())
         return self
 
+    async def _open(self):
+        self.reader, self.writer = await open_serial_connection(url=self.port, baudrate=self.baudrate)
+
     async def __aexit__(self, exc_type, exc, tb):
-        print(exc_type, exc, tb)
+        if exc is not None:
+            self.logger.info('exit after %s: %s', exc_type.__name__, exc)
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except CancelledError:
+                pass
+            self._reader_task = None
+        if self._resync_timer is not None:
+            self._resync_timer.cancel()
+            self._resync_timer = None
+        if self._settle_timer is not None:
+            self._settle_timer.cancel()
+            self._settle_timer = None
+        self._fail_in_flight(ConnectionAbortedError('device closed'))
+        self.capture.close()
+        flush_limited(self.logger)
+        flush_limited(self.packet.logger)
         self.log('exit')
 
     def _debug_message(self, message):
-        self.log(f'debug message {message}')
-
-    def _read_error():
-        self.log('read error')
+        self.log('debug message %s', one_line(message))
 
     async def _read_packet(self):
         #self.log('read packet')
         data = await self.reader.readuntil(separator=b'\x00')
+        self.metrics.count('bytes_in', amount=len(data))
+        if self.capture.enabled:
+            self.capture.record(IN, data)
         if data == b'\x00':
             # read a bogus end of packet.
             return None
         if len(data) <= 5:
             # data ends with the separator, and all messages
             # must contain a four byte crc.
-            self.log(f'read data length: {len(data)}, data: {data.hex("-")}')
+            self.metrics.count('runts')
+            self.link.record(RUNT)
+            limited(self.logger, 'runt', 'read data length: %d, data: %s', len(data), hexdump(data))
             return None
         result = self.packet.process(data[:-1])
         if result is None:
             self.log('read result is none')
             return None
-        t, message = result
-        if t == 'Response' or t == 'DebugMessage':
-            return message
-        else:
-            # error, exception
-            print(t, message)
+        kind, message = result
+        if kind == 'error':
+            limited(self.logger, 'decode', 'error %s', message)
             return None
+        if kind == 'log':
+            if message.log.id == 9:
+                self.link.ready()
+            elif message.log.is_error:
+                self.link.rejected(message)
+        if self.link.state == RESYNCING and self.link.resyncing:
+            # Dropped until the device is ready again.
+            return None
+        return result
+
+    def _link_changed(self, link, health):
+        if health == RESYNCING:
+            self._resync()
+            return
+        self.log('link %s', health)
+        if not self._link_ready.is_set():
+            self.logger.info('link resynced')
+            if self._resync_timer is not None:
+                self._resync_timer.cancel()
+                self._resync_timer = None
+            if self._settle_timer is None:
+                self._link_ready.set()
+
+    def _resync(self):
+        self.logger.warning('resyncing the link, %s', self.link.reason)
+        self._link_ready.clear()
+        self.mirror.invalidate()
+        self._fail_in_flight(ConnectionResetError('link resync'))
+        # The link is checked again once the responses on their way are in.
+        self._resync_timer = get_event_loop().call_later(
+            self.link.settle_time, lambda: self.link.health)
 
     async def _wait_until_ready(self):
         self.log('wait until ready')
         while True:
-            message = await self._read_packet()
-            if message is None:
+            result = await self._read_packet()
+            if result is None:
                 continue
-            if not isinstance(message, Response):
-                continue
-            if message.HasField('log') and message.log.id == 9:
+            kind, message = result
+            if kind == 'log' and message.log.id == 9:
                 break
         self.log('ready')
 
-    async def _read_non_debug_message(self):
-        self.log('read non debug message')
+    async def _read_response(self, expected):
+        '''
+        Reads until a response of kind expected, or the ready log after a
+        reset, skipping what the device sends unasked, such as stack
+        measurements.
+        '''
+        self.log('read response')
+        resyncs = self.link.resyncs
         while True:
-            message = await self._read_packet()
-            if message is None:
+            result = await self._read_packet()
+            if self.link.resyncs != resyncs:
+                raise ConnectionResetError('link resync')
+            if result is None:
                 continue
-            elif isinstance(message, Response):
-                return message
-            elif isinstance(message, DebugMessage):
+            kind, message = result
+            if kind == 'debug':
                 self._debug_message(message)
-            else:
-                self._read_error()
+                continue
+            if kind == 'log' and message.log.id == 9:
+                self.mirror.invalidate()
+                return message
+            if kind != expected:
+                self._unsolicited(message)
+                continue
+            return message
 
-    async def write(self, message):
-        self.log('write')
-        data = self.packet.encode(message)
+    async def _read_responses(self):
+        try:
+            while True:
+                result = await self._read_packet()
+                if result is not None:
+                    self.dispatcher.dispatch(*result)
+        except CancelledError:
+            raise
+        except Exception as error:
+            self._fail_in_flight(error)
+            raise
+
+    def _on_log(self, message):
+        if message.log.id == 9:
+            # The device has reset, so nothing in flight will be answered.
+            self.log('ready')
+            self.mirror.invalidate()
+            self._fail_in_flight(ConnectionResetError('device reset'))
+            for listener in self.ready_listeners:
+                listener(self)
+        elif message.log.is_error and message.log.id in REJECTION_CODES:
+            self._rejected()
+        else:
+            self._acknowledge('log', message)
+
+    def _rejected(self):
+        # The frame the device couldn't read may have been any of those
+        # written, so the responses to the others can't be matched to their
+        # requests any more.
+        limited(self.logger, 'rejected', 'frame rejected, failing %d requests in flight',
+                            sum(len(in_flight) for in_flight in self.in_flight.values()))
+        self.mirror.invalidate()
+        self._fail_in_flight(ConnectionResetError('frame rejected'))
+        self._link_ready.clear()
+        if self._settle_timer is not None:
+            self._settle_timer.cancel()
+        # Frames still buffered are answered too once they are written.
+        buffered = self.writer.transport.get_write_buffer_size()
+        self._settle_timer = get_event_loop().call_later(
+            SETTLE_TIME + self.budget.airtime(buffered), self._settled)
+
+    def _settled(self):
+        self._settle_timer = None
+        if self.link.state != RESYNCING:
+            self._link_ready.set()
+
+    def _on_current_time(self, message):
+        self._acknowledge('current_time', message)
+
+    def _acknowledge(self, kind, message):
+        in_flight = self.in_flight[kind]
+        if not in_flight:
+            self._unsolicited(message)
+            return
+        future = in_flight.popleft()
+        self.metrics.acknowledged(kind)
+        if kind == 'log':
+            self.mirror.acknowledged(message.log.is_error)
+        # The request may have been cancelled while waiting for its response.
+        if not future.done():
+            future.set_result(message)
+
+    def _unsolicited(self, message):
+        self.log('unsolicited message %s', one_line(message))
+
+    def _fail_in_flight(self, error):
+        self.metrics.forget()
+        for in_flight in self.in_flight.values():
+            while in_flight:
+                future = in_flight.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+    def _write_data(self, data):
+        if self.capture.enabled:
+            self.capture.record(OUT, data)
         self.writer.write(data)
-        self.writer.write(b'\x00')
+
+    def encode_key(self, key):
+        '''
+        Returns the frame, with its delimiter, of the request identified by
+        key (see messages.request_key).
+        '''
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self.packet.encode_key(key)
+            self.cache.put(key, frame)
+        return frame
+
+    def queue_key(self, key, force=False):
+        '''
+        Adds the frame of key to the frames written with the next batch,
+        without waiting for a slot in the window or registering for a
+        response. Returns False if the mirror skips it as redundant.
+        '''
+        if not self.mirror.should_send(key, force):
+            return False
+        frame = self.encode_key(key)
+        self.mirror.sent(key, len(frame))
+        self.scene.sent(key)
+        self.budget.record(len(frame))
+        self.batcher.add(frame)
+        self.outgoing += 1
+        self.metrics.count('messages_out', key[0])
+        self.metrics.count('bytes_out', amount=len(frame))
+        return True
+
+    def batch(self):
+        '''
+        Requests sent inside a with device.batch(): block are written together
+        when the block exits.
+        '''
+        return self.batcher.batch()
+
+    def flush_batch(self):
+        '''
+        Writes the frames added so far straight away, rather than when the
+        event loop next runs its callbacks.
+        '''
+        self.batcher.flush()
+
+    def batch_statistics(self):
+        return self.batcher.statistics()
+
+    @property
+    def lost(self):
+        '''
+        Whether reading from a pipelined device has failed.
+        '''
+        return self._reader_task is not None and self._reader_task.done()
+
+    async def wait_lost(self):
+        '''
+        Waits until reading from a pipelined device fails and raises the error.
+        '''
+        await self._reader_task
+
+    async def send(self, message, force=False):
+        '''
+        Writes a request without waiting for the device to respond, waiting
+        only for a free slot in the window. Returns a future which resolves
+        to the response acknowledging the request, or to None for requests
+        the device doesn't acknowledge and redundant requests which were
+        skipped (see LightMirror).
+        '''
+        return await self.send_key(request_key(message), force)
+
+    async def send_key(self, key, force=False):
+        '''
+        send() for the request identified by key (see messages.request_key).
+        '''
+        if self.window is None:
+            raise RuntimeError('send requires a device opened with a window')
+        if not self._link_ready.is_set():
+            await self._link_ready.wait()
+        future = get_event_loop().create_future()
+        if not self.mirror.should_send(key, force):
+            future.set_result(None)
+            return future
+        kind = ACKNOWLEDGEMENTS[key[0]]
+        if kind is None:
+            future.set_result(None)
+        else:
+            if self._window_slots.locked():
+                # Requests still held by a batch would never be acknowledged.
+                self.batcher.flush()
+            await self._window_slots.acquire()
+            future.add_done_callback(lambda _: self._window_slots.release())
+            if not self._link_ready.is_set():
+                # The slot was freed by requests failing.
+                try:
+                    await self._link_ready.wait()
+                except CancelledError:
+                    future.cancel()
+                    raise
+            self.in_flight[kind].append(future)
+            self.metrics.expect(kind)
+        self.log('send')
+        self.queue_key(key, force=True)
         await self.writer.drain()
-        return await self._read_non_debug_message()
+        return future
+
+    async def flush(self):
+        '''
+        Waits until every request sent so far has been acknowledged.
+        '''
+        futures = [future for in_flight in self.in_flight.values() for future in in_flight]
+        return await gather(*futures)
+
+    async def write(self, message, force=False):
+        return await self.write_key(request_key(message), force)
+
+    async def write_key(self, key, force=False):
+        '''
+        write() for the request identified by key (see messages.request_key).
+        '''
+        self.log('write')
+        if self.window is not None:
+            return await (await self.send_key(key, force))
+        if not self._link_ready.is_set():
+            await self._link_ready.wait()
+        if not self.queue_key(key, force):
+            return None
+        kind = ACKNOWLEDGEMENTS[key[0]]
+        if kind is not None:
+            self.metrics.expect(kind)
+        self.batcher.flush()
+        await self.writer.drain()
+        if kind is None:
+            # Nothing answers a commit.
+            return None
+        response = await self._read_response(kind)
+        self.metrics.acknowledged(kind)
+        if key[0] == 'set_light':
+            self.mirror.acknowledged(response.HasField('log') and response.log.is_error)
+        return response
+
+    async def set_light(self, *args, force=False, **kwargs):
+        await self.write_key(set_light_key(*args, **kwargs), force=force)
+
+    async def commit(self, delta, force=False):
+        await self.write_key(commit_key(delta), force=force)
 
-    async def set_light(self, *args, **kwargs):
-        request = build_set_light(*args, **kwargs)
-        await self.write(request)
+    async def send_light(self, *args, force=False, **kwargs):
+        '''
+        Pipelined set_light, see send().
+        '''
+        return await self.send_key(set_light_key(*args, **kwargs), force=force)
 
-    async def commit(self, *args, **kwargs):
-        await self.write(build_commit(*args, **kwargs))
+    async def send_commit(self, delta, force=False):
+        '''
+        Pipelined commit, see send().
+        '''
+        return await self.send_key(commit_key(delta), force=force)
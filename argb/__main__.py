@@ -1,25 +1,141 @@
 import click
-from .coms import *
-from .server import Server
-from .DebugMonitor import DebugMonitor
-from .AsyncServer import AsyncServer
+from .budget import DEFAULT_BAUDRATE
+
+# Subcommands import what they need when they run, so that starting the CLI
+# doesn't pay for serial, asyncio, protobuf or the analysis dependencies.
 
 @click.option('-l', '--log', is_flag=True)
+@click.option('-L', '--log-levels', metavar='SPEC',
+              help='Log levels, e.g. info,packet=error; defaults to $ARGB_LOG.')
 @click.option('-a', '--async-runtime', is_flag=True)
-@click.command
-def main(log, async_runtime):
+@click.option('-r', '--reconnect', is_flag=True,
+              help='With --async-runtime, reconnect and restore the lights when the port drops.')
+@click.option('-d', '--daemon', 'use_daemon', is_flag=True,
+              help='Monitor the controller through a running daemon.')
+@click.option('-p', '--port', multiple=True, default=['/dev/ttyACM0'], show_default=True,
+              help='Serial port of a controller, may be given once per controller.')
+@click.option('--limit', default=100, show_default=True,
+              help='Stop after this many stack measurements, 0 to run until interrupted.')
+@click.option('-s', '--summary-interval', type=int,
+              help='Print a stack measurement summary every this many measurements.')
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(context, log, log_levels, async_runtime, reconnect, use_daemon, port, limit, summary_interval):
+    from .log import configure
+    configure(log_levels)
+    if context.invoked_subcommand is not None:
+        return
     print('ARGB Controller Started...')
-    if async_runtime:
-        monitor = DebugMonitor()
-        server = AsyncServer('/dev/ttyACM0', monitor)
-        server.logging_enabled = log
-        server.main()
+    from .DebugMonitor import DebugMonitor
+    if use_daemon:
+        from asyncio import run
+        from .daemon import monitor
+        run(monitor(DebugMonitor(limit or None, summary_interval)))
+    elif async_runtime:
+        from .AsyncServer import AsyncServer, run_servers
+        servers = []
+        for device in port:
+            server = AsyncServer(device, DebugMonitor(limit or None, summary_interval), reconnect=reconnect)
+            server.logging_enabled = log
+            servers.append(server)
+        run_servers(servers)
     else:
-        monitor = DebugMonitor()
-        server = Server('/dev/ttyACM0', monitor)
+        if len(port) > 1:
+            raise click.UsageError('more than one port requires --async-runtime')
+        from .server import Server
+        monitor = DebugMonitor(limit or None, summary_interval)
+        server = Server(port[0], monitor)
         server.connection.logging_enabled = log
         server.main()
 
+@main.command()
+@click.option('-c', '--case', multiple=True, help='Run only the named cases.')
+@click.option('-t', '--time', 'minimum_time', default=0.5, show_default=True,
+              help='Minimum seconds to time each case for.')
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Write the results as JSON.')
+@click.option('-b', '--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare against results saved with --output.')
+@click.option('--tolerance', default=0.1, show_default=True,
+              help='Slowdown relative to the baseline that counts as a regression.')
+@click.option('--list', 'list_cases', is_flag=True, help='List the cases and exit.')
+@click.option('--legacy', is_flag=True, help='Also run the implementation comparisons.')
+def bench(case, minimum_time, output, baseline, tolerance, list_cases, legacy):
+    '''
+    Benchmarks the host side encode, decode and transport paths.
+    '''
+    from . import bench as suite
+    if list_cases:
+        for name in suite.SUITE:
+            print(name)
+        return
+    unknown = set(case) - set(suite.SUITE)
+    if unknown:
+        raise click.UsageError(f'unknown cases: {", ".join(sorted(unknown))}')
+    if legacy:
+        suite.main()
+    results = suite.run_suite(case, minimum_time, progress=lambda name: click.echo(f'running {name}', err=True))
+    previous = suite.load_results(baseline) if baseline else None
+    suite.report_suite(results, previous)
+    if output:
+        suite.save_results(output, results)
+    if previous is not None:
+        regressions = suite.compare(results, previous, tolerance)
+        for name, expected, actual in regressions:
+            click.echo(f'regression: {name}: {actual:.0f} ops/s, baseline {expected:.0f} ops/s', err=True)
+        if regressions:
+            raise SystemExit(1)
+
+@main.command()
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--sent', is_flag=True, help='Replay the data sent to the device instead.')
+def replay(paths, sent):
+    '''
+    Replays capture files, oldest first, through the frame decoder.
+    '''
+    from .capture import replay, report, IN, OUT
+    report(replay(paths, OUT if sent else IN))
+
+@main.command()
+@click.option('-b', '--baudrate', default=DEFAULT_BAUDRATE, show_default=True)
+@click.option('--fast', is_flag=True, help='Run without pacing or delays.')
+@click.option('--no-stack', is_flag=True, help="Don't stream stack measurements.")
+@click.option('-e', '--error-rate', default=0.0, show_default=True,
+              help='Probability of corrupting each byte.')
+@click.pass_context
+def emulator(context, baudrate, fast, no_stack, error_rate):
+    '''
+    Emulates the controller firmware on a pseudo-terminal.
+    '''
+    from .emulator import run
+    run(baudrate, fast, no_stack, error_rate, context.parent.params['log'])
+
+@main.command()
+@click.option('-p', '--port', default='/dev/ttyACM0', show_default=True)
+@click.option('-S', '--socket', 'path', help='Unix socket to listen on, $ARGB_SOCKET by default.')
+@click.option('-b', '--baudrate', default=DEFAULT_BAUDRATE, show_default=True)
+def daemon(port, path, baudrate):
+    '''
+    Shares the controller on port with clients connecting to a Unix socket.
+    '''
+    from asyncio import run
+    from .daemon import serve, DEFAULT_SOCKET
+    try:
+        daemon = run(serve(port, path or DEFAULT_SOCKET, baudrate=baudrate))
+    except KeyboardInterrupt:
+        return
+    print(daemon.statistics())
+
+@main.command()
+@click.option('-p', '--port', default='/dev/ttyACM0', show_default=True)
+@click.option('-n', '--samples', default=16, show_default=True)
+@click.option('-b', '--baudrate', default=DEFAULT_BAUDRATE, show_default=True)
+def clock(port, samples, baudrate):
+    '''
+    Synchronises with the controller's clock and prints the estimate.
+    '''
+    from asyncio import run
+    from .clock import probe
+    print(run(probe(port, samples, baudrate=baudrate)))
+
 if __name__=='__main__':
     main()
-
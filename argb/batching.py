@@ -0,0 +1,69 @@
+from asyncio import get_event_loop
+from contextlib import contextmanager
+
+
+class FrameBatcher:
+    '''
+    Coalesces delimited frames into a single write.
+
+    Frames added during one iteration of the event loop are written together
+    when the loop next runs its callbacks. Inside a batch() block nothing is
+    written until the outermost block exits.
+    '''
+    def __init__(self, write):
+        self._write = write
+        self.pending = bytearray()
+        self.pending_frames = 0
+        self._depth = 0
+        self._scheduled = None
+        self.writes = 0
+        self.frames = 0
+        self.bytes = 0
+
+    def add(self, frame):
+        self.pending.extend(frame)
+        self.pending_frames += 1
+        if self._depth == 0 and self._scheduled is None:
+            self._scheduled = get_event_loop().call_soon(self.flush)
+
+    def flush(self):
+        if self._scheduled is not None:
+            self._scheduled.cancel()
+            self._scheduled = None
+        if not self.pending:
+            return
+        # Transports may keep a reference to the data, so hand over the
+        # buffer and start a new one rather than clearing it.
+        data, self.pending = self.pending, bytearray()
+        self.writes += 1
+        self.frames += self.pending_frames
+        self.bytes += len(data)
+        self.pending_frames = 0
+        self._write(data)
+
+    @contextmanager
+    def batch(self):
+        self._depth += 1
+        try:
+            yield self
+        finally:
+            self._depth -= 1
+            if self._depth == 0:
+                self.flush()
+
+    @property
+    def frames_per_write(self):
+        return self.frames / self.writes if self.writes else 0.0
+
+    @property
+    def bytes_per_write(self):
+        return self.bytes / self.writes if self.writes else 0.0
+
+    def statistics(self):
+        return {
+            'writes': self.writes,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'frames_per_write': self.frames_per_write,
+            'bytes_per_write': self.bytes_per_write,
+        }
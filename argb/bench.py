@@ -0,0 +1,652 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+from random import Random
+from time import perf_counter, perf_counter_ns
+
+from cobs.cobs import encode, decode
+
+from .crc import ENGINES, BitByBitCrc
+from .framing import FrameSplitter
+from .stream import PacketProcessor, decode_payload
+from .cache import FrameCache
+from .messages import set_light, set_light_key, commit_key, build_request, Response, DebugMessage
+from .wire import encode_request, decode_response, default_codec
+
+
+def random_payloads(count, seed=0, max_length=64):
+    rng = Random(seed)
+    return [
+        bytes(rng.getrandbits(8) for _ in range(rng.randrange(max_length + 1)))
+        for _ in range(count)
+    ]
+
+
+def measure(function, items, minimum_time=0.2):
+    '''
+    Calls function on every item until minimum_time has elapsed and returns
+    the number of items processed per second.
+    '''
+    processed = 0
+    start = perf_counter()
+    while True:
+        for item in items:
+            function(item)
+        processed += len(items)
+        elapsed = perf_counter() - start
+        if elapsed >= minimum_time:
+            return processed / elapsed
+
+
+def verify_crc(engine, payloads):
+    reference = BitByBitCrc()
+    for payload in payloads:
+        expected = reference.digest(payload)
+        actual = engine.digest(payload)
+        if actual != expected:
+            raise AssertionError(
+                f'{engine.name}: crc mismatch for {payload.hex("-")}: '
+                f'{actual.hex("-")} != {expected.hex("-")}')
+
+
+def bench_crc(frames=200):
+    payloads = random_payloads(frames)
+    results = {}
+    for name, engine_class in ENGINES.items():
+        engine = engine_class()
+        verify_crc(engine, payloads)
+        results[name] = measure(engine.digest, payloads)
+    return results
+
+
+def encoded_stream(frames=200, seed=0, max_length=32):
+    '''
+    Returns a byte stream framed the way the firmware sends it: four
+    delimiters, the COBS encoded frame and a trailing delimiter.
+    '''
+    packet = PacketProcessor()
+    stream = bytearray()
+    for payload in random_payloads(frames, seed=seed, max_length=max_length):
+        stream.extend(b'\x00' * 4)
+        stream.extend(packet.encode_payload(payload))
+        stream.append(0)
+    return bytes(stream)
+
+
+def chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def _rescanning_splitter(chunks):
+    # The scanner ARGBProtocol.detect_packets used before FrameSplitter, kept
+    # for comparison.
+    frames = 0
+    input_buffer = bytearray()
+    for chunk in chunks:
+        input_buffer.extend(chunk)
+        start_of_message = None
+        drop_up_to = None
+        for (index, element) in enumerate(input_buffer):
+            if element != 0 and start_of_message is None:
+                start_of_message = index
+            elif element == 0 and start_of_message is not None:
+                buffer = input_buffer[start_of_message:index]
+                start_of_message = None
+                drop_up_to = index
+                if len(buffer) > 0:
+                    frames += 1
+        if drop_up_to is not None:
+            input_buffer = input_buffer[drop_up_to:]
+    return frames
+
+
+def _frame_splitter(chunks):
+    frames = 0
+    framer = FrameSplitter()
+    for chunk in chunks:
+        framer.feed(chunk)
+        for frame in framer:
+            frames += 1
+    return frames
+
+
+def bench_framing(frames=200, chunk_sizes=(1, 16, 256, 4096), max_length=72):
+    # 72 bytes of payload is close to the largest frame the firmware sends.
+    stream = encoded_stream(frames, max_length=max_length)
+    results = {}
+    for size in chunk_sizes:
+        chunks = chunked(stream, size)
+        for name, split in (('rescanning', _rescanning_splitter), ('splitter', _frame_splitter)):
+            if split(chunks) != frames:
+                raise AssertionError(f'{name}: wrong number of frames with chunk size {size}')
+            results[f'{name}/{size}'] = frames * measure(split, [chunks])
+    return results
+
+
+def random_set_light_keys(count, seed=0):
+    rng = Random(seed)
+    def color():
+        return (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    keys = []
+    for _ in range(count):
+        start = rng.randrange(20)
+        keys.append(set_light_key(
+            index=rng.randrange(4),
+            start=start,
+            end=rng.randrange(start, 21),
+            start_color=color(),
+            end_color=color(),
+            ahds=tuple(rng.randrange(256) for _ in range(4)),
+            start_color_alt=color(),
+            end_color_alt=color()))
+    return keys
+
+
+def random_responses(count, seed=0):
+    rng = Random(seed)
+    def int32():
+        return rng.choice((rng.randrange(1 << 16), rng.randrange(-(1 << 31), 1 << 31)))
+    responses = []
+    for _ in range(count):
+        response = Response()
+        kind = rng.randrange(3)
+        if kind == 0:
+            response.current_time.timestamp = rng.randrange(-(1 << 63), 1 << 63)
+        elif kind == 1:
+            response.log.id = int32()
+            response.log.is_error = rng.random() < 0.5
+        else:
+            message = response.stack_measurement
+            message.id = int32()
+            message.data = int32()
+            message.bss = int32()
+            message.heap = int32()
+            message.heap_gap = int32()
+            message.stack = int32()
+        responses.append(response)
+    return responses
+
+
+def verify_wire(count=1000, seed=0):
+    '''
+    Checks the wire encoder and decoder agree with protobuf on random input.
+    '''
+    rng = Random(seed)
+    keys = random_set_light_keys(count, seed=seed)
+    for _ in range(count):
+        keys.append(commit_key(rng.randrange(-(1 << 63), 1 << 63)))
+        keys.append(set_light_key(
+            index=rng.randrange(-(1 << 31), 1 << 31),
+            start=rng.randrange(1 << 15),
+            end=rng.randrange(1 << 16),
+            start_color=(255, 255, 255),
+            end_color=(0, 0, 0),
+            ahds=(255, 255, 255, 255)))
+    keys.append(('current_time_request', True))
+    for key in keys:
+        expected = build_request(key).SerializeToString()
+        actual = bytes(encode_request(key))
+        if actual != expected:
+            raise AssertionError(f'{key}: {actual.hex("-")} != {expected.hex("-")}')
+    for response in random_responses(count, seed=seed):
+        data = response.SerializeToString()
+        decoded = decode_response(data)
+        kind = response.WhichOneof('payload')
+        expected = getattr(response, kind)
+        actual = getattr(decoded, kind)
+        if decoded.WhichOneof('payload') != kind or any(
+                getattr(actual, field.name) != getattr(expected, field.name)
+                for field in expected.DESCRIPTOR.fields):
+            raise AssertionError(f'{data.hex("-")}: {decoded} != {response}')
+
+
+def bench_wire(frames=200):
+    verify_wire()
+    keys = random_set_light_keys(frames)
+    out = bytearray()
+    payloads = [response.SerializeToString() for response in random_responses(frames)]
+
+    def protobuf_encode(key):
+        return build_request(key).SerializeToString()
+
+    def wire_encode(key):
+        return encode_request(key, out)
+
+    def protobuf_decode(data):
+        response = Response()
+        response.ParseFromString(data)
+        return response
+
+    return {
+        'protobuf encode': measure(protobuf_encode, keys),
+        'wire encode': measure(wire_encode, keys),
+        'protobuf decode': measure(protobuf_decode, payloads),
+        'wire decode': measure(decode_response, payloads),
+    }
+
+
+def _try_response_then_debug(data):
+    # How PacketProcessor decoded payloads before decode_payload, kept for
+    # comparison.
+    try:
+        message = Response()
+        message.ParseFromString(data)
+        return ('Response', message)
+    except Exception as e:
+        error = e
+    try:
+        message = DebugMessage()
+        message.ParseFromString(data)
+        return ('DebugMessage', message)
+    except:
+        pass
+    return ('error', error)
+
+
+def bench_decode(frames=200):
+    payloads = [response.SerializeToString() for response in random_responses(frames // 2)]
+    for index in range(frames - len(payloads)):
+        message = DebugMessage()
+        message.id = 10
+        message.description = f'debug message {index}'
+        payloads.append(message.SerializeToString())
+    return {
+        'try both': measure(_try_response_then_debug, payloads),
+        'protobuf': measure(lambda data: decode_payload(data, 'protobuf'), payloads),
+        'wire': measure(lambda data: decode_payload(data, 'wire'), payloads),
+    }
+
+
+def bench_encode(frames=200, palette=16):
+    # Effects cycle through a small palette of frames.
+    palette_keys = random_set_light_keys(palette)
+    keys = [palette_keys[i % palette] for i in range(frames)]
+    packet = PacketProcessor()
+    protobuf_packet = PacketProcessor(codec='protobuf')
+    wire_packet = PacketProcessor(codec='wire')
+    cache = FrameCache()
+
+    def uncached(key):
+        return packet.encode_key(key)
+
+    def cached(key):
+        frame = cache.get(key)
+        if frame is None:
+            frame = uncached(key)
+            cache.put(key, frame)
+        return frame
+
+    return {
+        'protobuf': measure(protobuf_packet.encode_key, keys),
+        'wire': measure(wire_packet.encode_key, keys),
+        'cached': measure(cached, keys),
+    }
+
+
+def report(title, results):
+    print(f'{title}:')
+    for name, rate in results.items():
+        print(f'    {name:>16}: {rate:12.0f}')
+
+
+def protobuf_implementation():
+    from google.protobuf.internal import api_implementation
+    return api_implementation.Type()
+
+
+def percentile(samples, fraction):
+    '''
+    Returns the sample at fraction (0 to 1) of the sorted samples.
+    '''
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+def time_calls(function, items, minimum_time=0.2):
+    '''
+    Calls function on every item, repeating the items until minimum_time has
+    elapsed, and returns the duration of every call in nanoseconds.
+    '''
+    durations = []
+    total = 0
+    limit = minimum_time * 1e9
+    while total < limit:
+        for item in items:
+            start = perf_counter_ns()
+            function(item)
+            duration = perf_counter_ns() - start
+            durations.append(duration)
+            total += duration
+    return durations
+
+
+def measure_allocations(function, items):
+    '''
+    Returns the average peak of memory allocated while calling function on
+    an item, and the average number of memory blocks each call leaves
+    allocated.
+    '''
+    # Warm up caches and interned objects first.
+    for item in items:
+        function(item)
+    tracemalloc.start()
+    try:
+        peak = 0
+        blocks = sys.getallocatedblocks()
+        for item in items:
+            tracemalloc.reset_peak()
+            current = tracemalloc.get_traced_memory()[0]
+            function(item)
+            peak += tracemalloc.get_traced_memory()[1] - current
+        retained = sys.getallocatedblocks() - blocks
+    finally:
+        tracemalloc.stop()
+    return peak / len(items), retained / len(items)
+
+
+def summarize(durations, frames_per_call=1):
+    durations = sorted(durations)
+    total = sum(durations)
+    return {
+        'calls': len(durations),
+        'ops_per_second': len(durations) * 1e9 / total if total else 0.0,
+        'frames_per_second': len(durations) * frames_per_call * 1e9 / total if total else 0.0,
+        'p50_us': percentile(durations, 0.5) / 1e3,
+        'p99_us': percentile(durations, 0.99) / 1e3,
+    }
+
+
+def run_case(function, items, minimum_time=0.2, frames_per_call=1, allocations=True):
+    result = summarize(time_calls(function, items, minimum_time), frames_per_call)
+    if allocations:
+        peak, retained = measure_allocations(function, items)
+        result['peak_bytes_per_frame'] = peak / frames_per_call
+        result['retained_blocks_per_frame'] = retained / frames_per_call
+    return result
+
+
+class _NullDelegate:
+    def ready(self, server):
+        pass
+
+    def process(self, server, message):
+        return False
+
+    def debug_message(self, server, message):
+        pass
+
+    def completed(self, server):
+        pass
+
+
+def _set_light_arguments(count, seed=0):
+    rng = Random(seed)
+    def color():
+        return (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    arguments = []
+    for _ in range(count):
+        start = rng.randrange(20)
+        arguments.append(dict(
+            index=rng.randrange(4),
+            start=start,
+            end=rng.randrange(start, 21),
+            start_color=color(),
+            end_color=color(),
+            ahds=tuple(rng.randrange(256) for _ in range(4))))
+    return arguments
+
+
+def _response_frames(count, seed=0):
+    packet = PacketProcessor()
+    return [packet.encode_payload(response.SerializeToString())
+            for response in random_responses(count, seed=seed)]
+
+
+def case_set_light(minimum_time, frames=200):
+    arguments = _set_light_arguments(frames)
+    return run_case(lambda kwargs: set_light(**kwargs), arguments, minimum_time)
+
+
+def case_encode(minimum_time, frames=200):
+    packet = PacketProcessor()
+    messages = [build_request(key) for key in random_set_light_keys(frames)]
+    return run_case(packet.encode, messages, minimum_time)
+
+
+def case_encode_key(minimum_time, frames=200):
+    packet = PacketProcessor()
+    return run_case(packet.encode_key, random_set_light_keys(frames), minimum_time)
+
+
+def case_process(minimum_time, frames=200):
+    packet = PacketProcessor()
+    return run_case(packet.process, _response_frames(frames), minimum_time)
+
+
+def case_process_corrupt(minimum_time, frames=200):
+    # Every frame fails the CRC check, which is a rate limited warning.
+    import logging
+    packet = PacketProcessor()
+    corrupt = []
+    for frame in _response_frames(frames):
+        payload = bytearray(decode(frame))
+        payload[-1] ^= 0xff
+        corrupt.append(encode(payload))
+    # The warnings are logged, but not printed.
+    logger = packet.logger
+    handler = logging.NullHandler()
+    propagate = logger.propagate
+    logger.addHandler(handler)
+    logger.propagate = False
+    try:
+        return run_case(packet.process, corrupt, minimum_time)
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = propagate
+
+
+def case_crc(minimum_time, frames=200):
+    engine = ENGINES['zlib']()
+    return run_case(engine.digest, random_payloads(frames), minimum_time)
+
+
+def case_cobs_encode(minimum_time, frames=200):
+    return run_case(encode, random_payloads(frames), minimum_time)
+
+
+def case_cobs_decode(minimum_time, frames=200):
+    frames = [encode(payload) for payload in random_payloads(frames)]
+    return run_case(decode, frames, minimum_time)
+
+
+def _case_detect_packets(chunk_size):
+    def case(minimum_time, frames=200):
+        from .AsyncServer import ARGBProtocol
+        stream = bytearray()
+        for frame in _response_frames(frames):
+            stream.extend(b'\x00' * 4)
+            stream.extend(frame)
+            stream.append(0)
+        chunks = chunked(bytes(stream), chunk_size)
+        protocol = ARGBProtocol()
+        protocol.logging_enabled = False
+        protocol.set_delegate(_NullDelegate())
+
+        def feed(chunks):
+            for chunk in chunks:
+                protocol.data_received(chunk)
+        return run_case(feed, [chunks], minimum_time, frames_per_call=frames)
+    return case
+
+
+def case_connection_receive(minimum_time, frames=50):
+    from .coms import Connection
+    connection = Connection('loop://')
+    connection.serialPort.write_timeout = None
+    connection.serialPort.open()
+    stream = bytearray()
+    for frame in _response_frames(frames):
+        stream.extend(b'\x00' * 4)
+        stream.extend(frame)
+        stream.append(0)
+    # loop:// blocks writes that don't fit its 4096 byte queue.
+    stream = bytes(stream)
+    assert len(stream) <= 4096
+
+    def receive(_):
+        connection.serialPort.write(stream)
+        for _ in range(frames):
+            connection.receive_payload(1)
+    try:
+        return run_case(receive, [None], minimum_time, frames_per_call=frames)
+    finally:
+        connection.serialPort.close()
+
+
+async def _device_round_trips(port, minimum_time, window):
+    from .Device import Device
+    keys = random_set_light_keys(200)
+    durations = []
+    total = 0
+    async with Device(port, window=window) as device:
+        index = 0
+        while total < minimum_time * 1e9:
+            key = keys[index % len(keys)]
+            index += 1
+            start = perf_counter_ns()
+            await device.write_key(key, force=True)
+            duration = perf_counter_ns() - start
+            durations.append(duration)
+            total += duration
+    return durations
+
+
+def _case_device(window):
+    def case(minimum_time):
+        from .emulator import Emulator
+        with Emulator(realtime=False, stack_measurements=False) as emulator:
+            durations = asyncio.run(_device_round_trips(emulator.port, minimum_time, window))
+        return summarize(durations)
+    return case
+
+
+def import_time(module):
+    '''
+    Returns the microseconds a fresh interpreter spends importing module, as
+    reported by python -X importtime.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(
+        filter(None, (root, environment.get('PYTHONPATH'))))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=environment, capture_output=True, text=True, check=True)
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1])
+    raise ValueError(f'no import time reported for {module}')
+
+
+def _case_import(module, runs=5):
+    def case(minimum_time):
+        durations = []
+        start = perf_counter()
+        while len(durations) < runs or perf_counter() - start < minimum_time:
+            durations.append(import_time(module) * 1000)
+        return summarize(durations)
+    return case
+
+
+SUITE = {
+    'import argb.__main__': _case_import('argb.__main__'),
+    'import argb.Device': _case_import('argb.Device'),
+    'messages.set_light': case_set_light,
+    'PacketProcessor.encode': case_encode,
+    'PacketProcessor.encode_key': case_encode_key,
+    'PacketProcessor.process': case_process,
+    'PacketProcessor.process/corrupt': case_process_corrupt,
+    'crc': case_crc,
+    'cobs.encode': case_cobs_encode,
+    'cobs.decode': case_cobs_decode,
+    'ARGBProtocol.detect_packets/16': _case_detect_packets(16),
+    'ARGBProtocol.detect_packets/256': _case_detect_packets(256),
+    'Connection.receive': case_connection_receive,
+    'Device.write': _case_device(None),
+    'Device.write/window': _case_device(8),
+}
+
+
+def run_suite(names=None, minimum_time=0.2, progress=None):
+    '''
+    Runs the cases of SUITE named by names, or all of them, and returns
+    their results by name.
+    '''
+    results = {}
+    for name in names or SUITE:
+        if progress is not None:
+            progress(name)
+        results[name] = SUITE[name](minimum_time)
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    '''
+    Returns (name, baseline rate, rate) for every case that is more than
+    tolerance slower than in baseline.
+    '''
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        expected = previous['ops_per_second']
+        actual = result['ops_per_second']
+        if actual < expected * (1 - tolerance):
+            regressions.append((name, expected, actual))
+    return regressions
+
+
+def report_suite(results, baseline=None):
+    print(f'{"case":>32} {"ops/s":>12} {"frames/s":>12} {"p50 us":>9} {"p99 us":>9} '
+          f'{"bytes/frame":>12} {"change":>8}')
+    for name, result in results.items():
+        change = ''
+        if baseline and name in baseline:
+            change = f'{result["ops_per_second"] / baseline[name]["ops_per_second"] - 1:+8.1%}'
+        peak = result.get('peak_bytes_per_frame')
+        peak = '' if peak is None else f'{peak:12.0f}'
+        print(f'{name:>32} {result["ops_per_second"]:12.0f} {result["frames_per_second"]:12.0f} '
+              f'{result["p50_us"]:9.1f} {result["p99_us"]:9.1f} {peak:>12} {change:>8}')
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)['results']
+
+
+def save_results(path, results):
+    with open(path, 'w') as file:
+        json.dump({
+            'python': sys.version,
+            'protobuf': protobuf_implementation(),
+            'codec': default_codec(),
+            'results': results,
+        }, file, indent=2)
+
+
+def main():
+    print(f'protobuf implementation: {protobuf_implementation()}, '
+          f'default codec: {default_codec()}')
+    report('crc (frames/sec)', bench_crc())
+    report('framing (frames/sec)', bench_framing())
+    report('set_light encode (frames/sec)', bench_encode())
+    report('protobuf vs wire (messages/sec)', bench_wire())
+    report('decode, half debug messages (messages/sec)', bench_decode())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from collections import deque
+from time import monotonic
+from .log import get_logger, limited
+
+# Must match BAUD_RATE in argb_controller.ino.
+DEFAULT_BAUDRATE = 9600
+# The firmware's PacketSerial receive buffer (Connection<80, ...>) holds one
+# encoded frame without its delimiter.
+DEVICE_BUFFER_SIZE = 80
+# 8N1 framing sends a start and a stop bit with every byte.
+BITS_PER_BYTE = 10
+
+
+class LinkBudget:
+    '''
+    Tracks how much of the serial link's capacity outgoing frames use.
+
+    Frames are recorded with their exact encoded size, including COBS
+    overhead and the delimiter. Utilisation is the airtime of the frames
+    sent during the last window seconds as a fraction of the window.
+    '''
+    def __init__(self, baudrate=DEFAULT_BAUDRATE, window=1.0, target=0.8,
+                 device_buffer=DEVICE_BUFFER_SIZE, clock=monotonic):
+        self.baudrate = baudrate
+        self.window = window
+        self.target = target
+        self.device_buffer = device_buffer
+        self.clock = clock
+        self.samples = deque()
+        self.window_bytes = 0
+        self.frames = 0
+        self.bytes = 0
+        self.oversized = 0
+        self.logger = get_logger('budget')
+
+    @property
+    def bytes_per_second(self):
+        return self.baudrate / BITS_PER_BYTE
+
+    def airtime(self, size):
+        '''
+        Seconds it takes to transmit size bytes.
+        '''
+        return size * BITS_PER_BYTE / self.baudrate
+
+    def record(self, size, now=None):
+        '''
+        Records an outgoing frame of size bytes, including its delimiter.
+        Returns False if the frame is too large for the device's buffer.
+        '''
+        now = self.clock() if now is None else now
+        self._expire(now)
+        self.samples.append((now, size))
+        self.window_bytes += size
+        self.frames += 1
+        self.bytes += size
+        if size - 1 > self.device_buffer:
+            self.oversized += 1
+            limited(self.logger, 'oversized', '%d byte frame overruns the device buffer of %d bytes',
+                                size - 1, self.device_buffer)
+            return False
+        return True
+
+    def _expire(self, now):
+        oldest = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] <= oldest:
+            self.window_bytes -= samples.popleft()[1]
+
+    def utilisation(self, now=None):
+        now = self.clock() if now is None else now
+        self._expire(now)
+        return self.airtime(self.window_bytes) / self.window
+
+    def minimum_interval(self, size):
+        '''
+        Shortest interval between bursts of size bytes that stays within the
+        target utilisation.
+        '''
+        return self.airtime(size) / self.target
+
+    def statistics(self):
+        return {
+            'baudrate': self.baudrate,
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'oversized': self.oversized,
+            'utilisation': self.utilisation(),
+        }
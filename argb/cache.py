@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+class FrameCache:
+    '''
+    A bounded least recently used cache of encoded frames keyed by request
+    key (see messages.request_key).
+    '''
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def get(self, key):
+        frame = self.frames.get(key)
+        if frame is None:
+            self.misses += 1
+            return None
+        self.frames.move_to_end(key)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        if self.capacity <= 0:
+            return
+        self.frames[key] = frame
+        self.frames.move_to_end(key)
+        if len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.frames.clear()
+
+    def statistics(self):
+        return {
+            'capacity': self.capacity,
+            'size': len(self.frames),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,213 @@
+'''
+Capture of the raw bytes sent to and received from a device.
+
+Every transport has a Capture its traffic is recorded into once it is
+enabled, which keeps the most recent traffic in memory and can also write
+it to rotating capture files.
+A capture file starts with MAGIC followed by records of a RECORD header
+(timestamp in seconds since the epoch, direction, length) and the data.
+
+Run python -m argb.capture FILE... to replay capture files through the
+frame decoder and report what they contain.
+'''
+import mmap
+import os
+import struct
+from collections import deque
+from time import time, perf_counter
+from .framing import FrameSplitter
+from .stream import PacketProcessor
+from .crc import DEFAULT_ENGINE
+
+MAGIC = b'ARGBCAP1'
+RECORD = struct.Struct('<dBI')
+# Directions.
+IN = 0
+OUT = 1
+
+
+class Capture:
+    '''
+    Keeps the last capacity bytes of traffic in memory and, if path is set,
+    appends every record to a capture file. Once the file grows past
+    max_file_size it is rotated to path.1, path.1 to path.2 and so on, and
+    only backups old files are kept.
+
+    Nothing is recorded while enabled is False, the default unless path is
+    set, and transports check enabled before recording.
+    '''
+    def __init__(self, capacity=64 * 1024, path=None, max_file_size=16 * 1024 * 1024, backups=3,
+                 enabled=None):
+        self.enabled = path is not None if enabled is None else enabled
+        self.capacity = capacity
+        self.records = deque()
+        self.size = 0
+        self.path = path
+        self.max_file_size = max_file_size
+        self.backups = backups
+        self.file = None
+        self.dropped = 0
+        if path is not None:
+            self._open()
+
+    def _open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+
+    def _rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f'{self.path}.{index}'
+            if os.path.exists(source):
+                os.replace(source, f'{self.path}.{index + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def record(self, direction, data, timestamp=None):
+        if not self.enabled or (self.capacity <= 0 and self.file is None):
+            return
+        timestamp = time() if timestamp is None else timestamp
+        data = bytes(data)
+        if self.capacity > 0:
+            records = self.records
+            records.append((timestamp, direction, data))
+            self.size += len(data)
+            while self.size > self.capacity:
+                self.size -= len(records.popleft()[2])
+                self.dropped += 1
+        if self.file is not None:
+            self.file.write(RECORD.pack(timestamp, direction, len(data)))
+            self.file.write(data)
+            if self.file.tell() >= self.max_file_size:
+                self._rotate()
+
+    def data(self, direction):
+        '''
+        Returns the bytes in memory that went in direction.
+        '''
+        return b''.join(data for _, record_direction, data in self.records
+                        if record_direction == direction)
+
+    def received(self):
+        return self.data(IN)
+
+    def sent(self):
+        return self.data(OUT)
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def save(self, path):
+        '''
+        Writes the records in memory to a capture file.
+        '''
+        with open(path, 'wb') as file:
+            file.write(MAGIC)
+            for timestamp, direction, data in self.records:
+                file.write(RECORD.pack(timestamp, direction, len(data)))
+                file.write(data)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def statistics(self):
+        return {
+            'records': len(self.records),
+            'bytes': self.size,
+            'dropped': self.dropped,
+        }
+
+
+def read_records(buffer):
+    '''
+    Yields (timestamp, direction, data) for every record in buffer, which
+    holds a capture file. data is a memoryview into buffer.
+    '''
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a capture file')
+    view = memoryview(buffer)
+    position = len(MAGIC)
+    end = len(buffer)
+    try:
+        while position + RECORD.size <= end:
+            timestamp, direction, length = RECORD.unpack_from(buffer, position)
+            position += RECORD.size
+            if position + length > end:
+                # The capture was cut off while writing this record.
+                break
+            data = view[position:position + length]
+            yield timestamp, direction, data
+            data.release()
+            position += length
+    finally:
+        view.release()
+
+
+def replay(paths, direction=IN, crc=DEFAULT_ENGINE, codec=None):
+    '''
+    Pushes the data of the capture files at paths, in order, through a
+    FrameSplitter and a PacketProcessor as fast as possible. Data sent to
+    the device is decoded as requests. Returns the number of frames by
+    decoded kind, plus bytes, frames, runts, invalid frames and the seconds
+    spent.
+    '''
+    framer = FrameSplitter()
+    packet = PacketProcessor(crc, codec)
+    kinds = {}
+    counts = {'bytes': 0, 'frames': 0, 'runts': 0, 'invalid': 0}
+    start = perf_counter()
+    for path in paths:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            for _, record_direction, data in read_records(buffer):
+                if record_direction != direction:
+                    continue
+                counts['bytes'] += len(data)
+                framer.feed(data)
+                for frame in framer:
+                    counts['frames'] += 1
+                    if len(frame) <= 4:
+                        counts['runts'] += 1
+                        continue
+                    if direction == IN:
+                        result = packet.process(frame)
+                    else:
+                        result = packet.process_request(frame)
+                    if result is None:
+                        counts['invalid'] += 1
+                        continue
+                    kinds[result[0]] = kinds.get(result[0], 0) + 1
+    counts['seconds'] = perf_counter() - start
+    counts['kinds'] = kinds
+    return counts
+
+
+def report(result):
+    seconds = result['seconds']
+    print(f'{result["bytes"]} bytes, {result["frames"]} frames in {seconds:.3f} s '
+          f'({result["frames"] / seconds if seconds else 0:.0f} frames/s)')
+    print(f'runts: {result["runts"]}, invalid: {result["invalid"]}')
+    for kind, count in sorted(result['kinds'].items(), key=lambda item: str(item[0])):
+        print(f'    {kind}: {count}')
+
+
+def main():
+    import click
+
+    @click.command
+    @click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+    @click.option('--sent', is_flag=True, help='Replay the data sent to the device instead.')
+    def command(paths, sent):
+        report(replay(paths, OUT if sent else IN))
+
+    command()
+
+
+if __name__ == '__main__':
+    main()
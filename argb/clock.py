@@ -0,0 +1,352 @@
+'''
+Host and device clock synchronisation, for commits applied at a given time.
+
+ClockSync estimates the device's millis() from the host's monotonic clock
+the way NTP does, with current_time_request round trips: a request written
+at host time t0 is answered with the device time T and received at host
+time t1. The link carries both frames at the baud rate, so their airtimes
+are taken out of the round trip; the rest of the latency is assumed to be
+the same both ways, which puts T at host time
+(t0 + request airtime + t1 - response airtime) / 2.
+
+Round trips stretched by frames queued ahead of the request or its
+response, or by the firmware's loop being slow to come round to reading the
+request, give poor estimates, so only the last samples whose round trip is
+within rtt_tolerance ms of the shortest one are used. Samples are spaced
+randomly so that they don't all catch the loop at the same point. Once the
+samples used span at least minimum_span seconds, a line is fitted through
+their offsets over host time, which models the drift of the device's
+resonator against the host's clock.
+
+The firmware applies a commit once millis() minus the time the last commit
+was applied reaches its timestamp (AnimationController::update). To apply
+a commit at a host time, ClockSync therefore also keeps track of when the
+commits it sent are applied. After a reset that starts at millis() 0, as
+the AnimationController is constructed before millis() starts counting.
+Commits sent to the device any other way aren't seen, so a device should be
+committed to through a single ClockSync.
+
+A commit is applied by the first iteration of the loop once it is due,
+and the next commit is timed from that iteration's millis(). While the loop
+takes less than a millisecond that adds nothing; apply_lag is the average
+delay otherwise. As commits aren't acknowledged, the actual delay can't be
+measured, and errors would add up over a chain of commits each timed from
+the last. So every max_chain commits, and whenever the time of the last
+commit isn't known, a commit is anchored instead: sent with a timestamp of
+0, timed to arrive at the requested time.
+
+The stack measurements the firmware streams every iteration stretch its
+loop to a tenth of a second or more at 9600 baud, which then bounds how
+precisely both requests are timestamped and commits are applied.
+'''
+from asyncio import get_event_loop, sleep
+from collections import deque
+from math import sqrt
+from random import random
+from time import monotonic
+from .messages import commit_key
+from .log import get_logger, limited
+
+CURRENT_TIME_REQUEST = ('current_time_request', True)
+# A current_time response frame is the CurrentTime message with the tag and
+# length of Response.current_time, the CRC, the COBS overhead byte, the
+# delimiter and the four zero bytes Connection::send starts with.
+RESPONSE_OVERHEAD = 3 + 4 + 1 + 1 + 4
+# millis() is an unsigned long.
+MILLIS_WRAP = 1 << 32
+
+
+def _varint_size(value):
+    return max((value.bit_length() + 6) // 7, 1)
+
+
+class ClockSync:
+    '''
+    Synchronises with a pipelined Device (see the module documentation).
+    Device times are in milliseconds, host times in seconds of clock.
+
+    last_commit is the device time of the last applied commit: 0 for a
+    device which was reset when it was opened, the default, or None if it
+    isn't known.
+    '''
+    def __init__(self, device, samples=16, rtt_tolerance=2.0, minimum_span=5.0, max_skew=0.01,
+                 interval=1.0, last_commit=0, apply_lag=0.0, max_chain=16, clock=monotonic):
+        self.device = device
+        self.samples = deque(maxlen=samples)
+        self.rtt_tolerance = rtt_tolerance
+        self.minimum_span = minimum_span
+        self.max_skew = max_skew
+        self.interval = interval
+        self.apply_lag = apply_lag
+        self.max_chain = max_chain
+        self.clock = clock
+        self.logger = get_logger('clock')
+        # device time = host ms + offset + skew * (host ms - reference)
+        self.offset = None
+        self.skew = 0.0
+        self.reference = 0.0
+        self.min_rtt = None
+        # Milliseconds each way which aren't spent on the wire.
+        self.latency = 0.0
+        self.dispersion = 0.0
+        self.measurements = 0
+        self.failures = 0
+        self.resets = 0
+        self._wraps = 0
+        self._last_timestamp = None
+        # Device times the last commit was applied at and the commit sent
+        # after it will be applied at, if it isn't superseded first.
+        self.last_applied = last_commit
+        self.pending = None
+        # Commits timed from the last one since the last anchored commit.
+        self.chain = 0
+        self.scheduled = 0
+        self.anchored = 0
+        self.late = 0
+        self.lateness = 0.0
+        self._task = None
+        device.ready_listeners.append(self._device_reset)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    @property
+    def synchronised(self):
+        return self.offset is not None
+
+    def _device_reset(self, device):
+        self.log('device reset')
+        self.resets += 1
+        self.samples.clear()
+        self.offset = None
+        self.min_rtt = None
+        self._wraps = 0
+        self._last_timestamp = None
+        self.last_applied = 0
+        self.pending = None
+        self.chain = 0
+
+    def _unwrap(self, timestamp):
+        if self._last_timestamp is not None and timestamp < self._last_timestamp - MILLIS_WRAP // 2:
+            self._wraps += 1
+        self._last_timestamp = timestamp
+        return timestamp + self._wraps * MILLIS_WRAP
+
+    def record(self, sent, timestamp, received, request_size, response_size=None):
+        '''
+        Records a round trip: a current_time_request frame of request_size
+        bytes written at host time sent, answered with timestamp and received
+        at host time received.
+        '''
+        if response_size is None:
+            response_size = RESPONSE_OVERHEAD + _varint_size(timestamp)
+        timestamp = self._unwrap(timestamp)
+        airtime = self.device.budget.airtime
+        request_airtime = airtime(request_size)
+        response_airtime = airtime(response_size)
+        rtt = (received - sent) * 1000
+        host = (sent + request_airtime + received - response_airtime) * 500
+        # millis() truncates, so the device is half a millisecond later on
+        # average.
+        offset = timestamp + 0.5 - host
+        latency = max(rtt - (request_airtime + response_airtime) * 1000, 0.0) / 2
+        self.samples.append((host, offset, rtt, latency))
+        self.measurements += 1
+        self._estimate()
+
+    def _estimate(self):
+        self.min_rtt = min(sample[2] for sample in self.samples)
+        best = [sample for sample in self.samples if sample[2] <= self.min_rtt + self.rtt_tolerance]
+        count = len(best)
+        reference = sum(sample[0] for sample in best) / count
+        offset = sum(sample[1] for sample in best) / count
+        if count >= 2 and best[-1][0] - best[0][0] >= self.minimum_span * 1000:
+            variance = sum((sample[0] - reference) ** 2 for sample in best)
+            covariance = sum((sample[0] - reference) * (sample[1] - offset) for sample in best)
+            skew = covariance / variance
+            self.skew = max(-self.max_skew, min(skew, self.max_skew))
+        # Otherwise the last fitted skew is kept.
+        self.reference = reference
+        self.offset = offset
+        self.latency = min(sample[3] for sample in best)
+        self.dispersion = sqrt(sum(
+            (sample[1] - offset - self.skew * (sample[0] - reference)) ** 2 for sample in best) / count)
+
+    def device_time(self, host=None):
+        '''
+        Estimates the device's millis() at host time host, by default now.
+        '''
+        if self.offset is None:
+            raise RuntimeError('the clock has not been synchronised')
+        host = (self.clock() if host is None else host) * 1000
+        return host + self.offset + self.skew * (host - self.reference)
+
+    def host_time(self, device_time):
+        '''
+        Estimates the host time at which the device's millis() reaches
+        device_time.
+        '''
+        if self.offset is None:
+            raise RuntimeError('the clock has not been synchronised')
+        return (device_time - self.offset + self.skew * self.reference) / (1 + self.skew) / 1000
+
+    async def measure(self):
+        '''
+        Sends a current_time_request, records its round trip and returns the
+        device's timestamp.
+        '''
+        device = self.device
+        # Requests in flight would delay the response.
+        await device.flush()
+        size = len(device.encode_key(CURRENT_TIME_REQUEST))
+        received = []
+        sent = self.clock()
+        future = await device.send_key(CURRENT_TIME_REQUEST, force=True)
+        future.add_done_callback(lambda _: received.append(self.clock()))
+        response = await future
+        timestamp = response.current_time.timestamp
+        self.record(sent, timestamp, received[0], size)
+        return timestamp
+
+    async def synchronise(self, count=8, spacing=0.1):
+        '''
+        Takes count samples, on average spacing seconds apart, e.g. right
+        after opening the device.
+        '''
+        for index in range(count):
+            if index:
+                await sleep(spacing * 2 * random())
+            await self.measure()
+        return self.statistics()
+
+    async def run(self):
+        '''
+        Takes a sample about every interval seconds until cancelled.
+        '''
+        while True:
+            try:
+                await self.measure()
+            except (ConnectionError, OSError) as error:
+                # The device reset or the link is resyncing; the next sample
+                # starts over.
+                self.failures += 1
+                self.log('measuring failed: %s', error)
+            await sleep(self.interval * (0.5 + random()))
+
+    def start(self):
+        self._task = get_event_loop().create_task(self.run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _arrival(self, key):
+        # Host time a frame written now would have been received in full.
+        device = self.device
+        queued = device.writer.transport.get_write_buffer_size() + len(device.encode_key(key))
+        return self.clock() + device.budget.airtime(queued) + self.latency / 1000
+
+    @property
+    def must_anchor(self):
+        '''
+        Whether the next commit has to be anchored.
+        '''
+        return self.last_applied is None or self.chain >= self.max_chain
+
+    def commit_delta(self, at, arrival):
+        '''
+        Returns the timestamp of a commit, arriving at the device at host
+        time arrival, which applies it at host time at, the host time it is
+        expected to be applied at and how many ms later than at that is
+        because it arrives too late. Records the commit as sent.
+        '''
+        target = self.device_time(at)
+        arrives = self.device_time(arrival)
+        last = self.last_applied
+        # A pending commit which hasn't been applied by the time the next one
+        # arrives is superseded by it.
+        if self.pending is not None and self.pending <= arrives:
+            last = self.pending
+        if self.must_anchor:
+            delta = 0
+            applied = last = arrives
+            self.chain = 0
+            self.anchored += 1
+        else:
+            delta = max(round(max(target, arrives) - last), 0)
+            applied = max(last + delta, arrives)
+            self.chain += 1
+        self.last_applied = last
+        self.pending = applied + self.apply_lag
+        return delta, self.host_time(self.pending), max(arrives - target, 0.0)
+
+    async def commit_at(self, at):
+        '''
+        Writes a commit which applies the staged lights at host time at and
+        returns the host time they are expected to be applied at. Waits
+        until shortly before at to send an anchored commit.
+        '''
+        device = self.device
+        device.flush_batch()
+        if self.must_anchor:
+            # Frames ahead of the commit drain while it waits, so the wait is
+            # checked again once it is over.
+            wait = at - self._arrival(commit_key(0))
+            while wait > 0.001:
+                await sleep(wait)
+                wait = at - self._arrival(commit_key(0))
+        delta, applied, lateness = self.commit_delta(at, self._arrival(commit_key(0)))
+        device.queue_key(commit_key(delta), force=True)
+        device.flush_batch()
+        self.scheduled += 1
+        if lateness > 1:
+            self.late += 1
+            self.lateness = max(self.lateness, lateness)
+            limited(self.logger, 'late', 'commit arrives %.1f ms late', lateness)
+        self.log('commit %d ms after the last, applied at %.3f', delta, applied)
+        await device.writer.drain()
+        return applied
+
+    async def apply_at(self, at, keys, force=False):
+        '''
+        Sends the set_light requests identified by keys (see
+        messages.set_light_key) followed by a commit which applies them at
+        host time at. Returns the futures acknowledging the set_light
+        requests (see Device.send) and the host time they are expected to be
+        applied at, which is later than at if they can't reach the device in
+        time.
+        '''
+        device = self.device
+        with device.batch():
+            futures = [await device.send_key(key, force) for key in keys]
+        return futures, await self.commit_at(at)
+
+    def statistics(self):
+        return {
+            'synchronised': self.synchronised,
+            'offset': self.offset,
+            'skew_ppm': self.skew * 1e6,
+            'min_rtt': self.min_rtt,
+            'latency': self.latency,
+            'dispersion': self.dispersion,
+            'samples': len(self.samples),
+            'measurements': self.measurements,
+            'failures': self.failures,
+            'resets': self.resets,
+            'scheduled': self.scheduled,
+            'anchored': self.anchored,
+            'late': self.late,
+            'lateness_max': self.lateness,
+        }
+
+
+async def probe(port, count=16, **kwargs):
+    '''
+    Opens the device on port, synchronises with its clock and returns the
+    statistics.
+    '''
+    from .Device import Device
+    async with Device(port, window=1, **kwargs) as device:
+        return await ClockSync(device).synchronise(count)
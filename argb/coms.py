@@ -1,124 +1,190 @@
-from serial import Serial
-from cobs.cobs import encode, decode
-from time import sleep
-from pycrc.algorithms import Crc
-from messages_pb2 import Response, DebugMessage
-from textwrap import dedent
+from serial import serial_for_url
+from time import sleep, monotonic
+from .crc import DEFAULT_ENGINE
+from .framing import FrameSplitter
+from .stream import PacketProcessor
+from .budget import LinkBudget, DEFAULT_BAUDRATE
+from .cache import FrameCache
+from .messages import request_key, ACKNOWLEDGEMENTS
+from .metrics import Metrics
+from .capture import Capture, IN, OUT
+from .wire import default_codec
+from .log import get_logger, limited, flush_limited, set_debug, DEBUG, hexdump
+from .link import LinkQuality, RUNT, RESYNCING
 
 class Connection:
-    def __init__(self, port, baudrate=9600):
-        self.serialPort = Serial()
+    def __init__(self, port, baudrate=DEFAULT_BAUDRATE, crc=DEFAULT_ENGINE, cache_size=64, codec=None):
+        # serial_for_url also accepts pyserial urls such as loop://.
+        self.serialPort = serial_for_url(port, do_not_open=True)
         self.serialPort.baudrate = baudrate
-        self.serialPort.port = port
         self.serialPort.timeout = 1
         self.serialPort.write_timeout = 0
-        self.crc = Crc(
-            width=32,
-            poly=0x04c11db7,
-            reflect_in=True,
-            xor_in=0xffffffff,
-            xor_out=0xffffffff,
-            reflect_out=True
-        )
-        self.logging_enabled = False
+        self.logger = get_logger('connection')
         self.incoming = 0
         self.outgoing = 0
-        self.received = bytearray()
+        self.capture = Capture()
+        self.framer = FrameSplitter()
+        self.cache = FrameCache(cache_size)
+        self.budget = LinkBudget(baudrate)
+        self.metrics = Metrics('connection')
+        self.link = LinkQuality()
+        self.link.listeners.append(self._link_changed)
+        # 'wire' or 'protobuf', see wire.default_codec.
+        self.codec = codec or default_codec()
+        # Decodes received frames and encodes requests, sharing the metrics,
+        # logger and link quality of the connection.
+        self.packet = PacketProcessor(crc, codec=self.codec, metrics=self.metrics,
+                                      logger=self.logger, link=self.link)
     
+    @property
+    def received(self):
+        '''
+        The most recently received bytes, while capture is enabled, see
+        Capture.
+        '''
+        return self.capture.received()
+
     def __enter__(self):
         self.serialPort.__enter__()
         sleep(2)
 
     def __exit__(self, *args):
         self.serialPort.__exit__(*args)
-    
-    def log(self, *args, **kwargs):
-        if self.logging_enabled:
-            print(*args, **kwargs)
+        self.capture.close()
+        flush_limited(self.logger)
+
+    @property
+    def logging_enabled(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging_enabled.setter
+    def logging_enabled(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def _link_changed(self, link, health):
+        if health == RESYNCING:
+            self.logger.warning('resyncing the link, %s', link.reason)
+            self.framer.resync()
+            self.metrics.forget()
+        else:
+            self.log('link %s', health)
+
+    def receive_payload(self, timeout=None):
+        '''
+        Returns (kind, message) as described in stream.decode_payload, or None.
+        While the link is resyncing, everything but the ready log is dropped.
+        '''
+        frame = self.recv_frame(timeout)
+        if frame is None:
+            return None
+        if len(frame) <= 4:
+            self.metrics.count('runts')
+            self.link.record(RUNT)
+            limited(self.logger, 'runt', 'received too short a buffer: %s', hexdump(frame))
+            return None
+        self.incoming += 1
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug('received frame: %s', hexdump(frame))
+        # Decodes the frame and records its outcome in metrics and link.
+        result = self.packet.process(frame)
+        if result is None:
+            return None
+        kind, message = result
+        if kind == 'error':
+            return result
+        link = self.link
+        if kind == 'log':
+            if message.log.id == 9:
+                link.ready()
+            elif message.log.is_error:
+                link.rejected(message)
+        if self.metrics.enabled:
+            if kind == 'log' and message.log.id == 9:
+                self.metrics.forget()
+            elif kind in ('log', 'current_time'):
+                self.metrics.acknowledged(kind)
+        if link.state == RESYNCING and link.resyncing:
+            return None
+        return result
 
-    def receiveMessage(self):
-        data = self.receive()
-        if data is None:
+    def receiveMessage(self, timeout=None):
+        result = self.receive_payload(timeout)
+        if result is None:
             return None
-        try:
-            message = Response()
-            message.ParseFromString(data)
-            return message
-        except:
-            message = DebugMessage()
-            message.ParseFromString(data)
-            return message
+        kind, message = result
+        if kind == 'error':
+            raise message
+        return message
+
+    def _read(self, timeout):
+        # Blocks until at least one byte is available or the timeout expires,
+        # then takes everything the driver has buffered in a single read.
+        if self.serialPort.timeout != timeout:
+            self.serialPort.timeout = timeout
+        data = self.serialPort.read(self.serialPort.in_waiting or 1)
+        if data:
+            self.metrics.count('bytes_in', amount=len(data))
+            if self.capture.enabled:
+                self.capture.record(IN, data)
+            self.framer.feed(data)
+        return data
 
     def ignore_until_next_message(self):
+        while not self.framer.discard_until_delimiter():
+            self._read(None)
+
+    def recv_frame(self, timeout=None):
+        '''
+        Blocks until a complete frame has been received and returns it without
+        the delimiter. Returns None if timeout seconds pass first; a timeout of
+        None waits indefinitely.
+        '''
+        deadline = None if timeout is None else monotonic() + timeout
         while True:
-            if self.serialPort.in_waiting > 0:
-                byte = self.serialPort.read()[0]
-                self.received.append(byte)
-                if byte == 0:
-                    break
+            frame = self.framer.next_frame()
+            if frame is not None:
+                return bytes(frame)
+            if deadline is None:
+                remaining = None
             else:
-                sleep(0.1)
-    
-    def receive(self):
-        buffer = bytearray()
-        while True:
-            if self.serialPort.in_waiting > 0:
-                byte = self.serialPort.read()[0]
-                self.received.append(byte)
-                if byte == 0:
-                    if len(buffer) > 0:
-                        break
-                else:
-                    buffer.append(byte)
-        if len(buffer) <= 4:
-            print('received too short a buffer')
-            return None
-        else:
-            self.incoming += 1
-            try:
-                msg = decode(buffer)
-                received_crc = msg[-4:]
-                crc = self.crc.bit_by_bit(msg[:-4])
-                crc = bytes([
-                    (crc & 0x000000FF) >> 0*8,
-                    (crc & 0x0000FF00) >> 1*8,
-                    (crc & 0x00FF0000) >> 2*8,
-                    (crc & 0xFF000000) >> 3*8,
-                ])
-                if received_crc != crc:
-                    print(f'warning: received crc: {received_crc.hex("-")}, expected crc: {crc.hex("-")}')
-                self.log(dedent(f'''
-                Received Message:
-                    length: {len(buffer)}
-                    buffer: {buffer.hex('-')}
-                    data: {msg[:-4].hex('-')}
-                    received crc: {received_crc.hex('-')}
-                    calculated crc: {crc.hex('-')}
-                '''))
-                #print(f'received: {buffer.hex("-")}')
-                return msg[:-4]
-            except Exception as error:
-                print(error, f'incoming: {self.incoming}, outgoing: {self.outgoing}, buffer:', buffer.hex('-'))
-                return None
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return None
+            self._read(remaining)
 
-    def send(self, message):
-        checksum = self.crc.bit_by_bit(message).to_bytes(4, byteorder='little')
-        data = bytearray(message)
-        data.extend(checksum)
-        encoded_data = encode(data)
-        self.log(dedent(f'''
-        Sending Message:
-            length: {len(encoded_data)}
-            buffer: {encoded_data.hex('-')}
-            data: {data[:-4].hex('-')}
-            crc: {checksum.hex('-')}
-        '''), end='')
-        self.serialPort.write(encoded_data)
-        self.serialPort.write([0])
+    def write_frame(self, frame):
+        self.budget.record(len(frame))
+        if self.capture.enabled:
+            self.capture.record(OUT, frame)
+        self.serialPort.write(frame)
         self.serialPort.flush()
-        self.log('done')
+        self.logger.debug('done')
         self.outgoing += 1
+        self.metrics.count('bytes_out', amount=len(frame))
+
+    def send(self, message):
+        self.write_frame(self._sending(self.packet.encode_payload(message) + b'\x00'))
+
+    def _sending(self, frame):
+        if self.logger.isEnabledFor(DEBUG):
+            self.logger.debug('sending frame: %s', hexdump(frame))
+        return frame
 
     def sendMessage(self, msg):
-        data = msg.SerializeToString()
-        self.send(data)
+        key = request_key(msg)
+        metrics = self.metrics
+        frame = self.cache.get(key)
+        if frame is None:
+            frame = self._sending(self.packet.encode_key(key))
+            self.cache.put(key, frame)
+        else:
+            self.logger.debug('sending cached frame: %s', hexdump(frame))
+        self.write_frame(frame)
+        if metrics.enabled:
+            metrics.count('messages_out', key[0])
+            kind = ACKNOWLEDGEMENTS.get(key[0])
+            if kind is not None:
+                metrics.expect(kind)
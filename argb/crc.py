@@ -0,0 +1,95 @@
+from abc import ABC, abstractmethod
+from zlib import crc32
+
+# The firmware uses AceCRC's crc32 (reflected 0x04c11db7, init and final xor of
+# 0xffffffff), which is the same parameter set as zlib's crc32.
+WIDTH = 32
+POLY = 0x04c11db7
+REFLECTED_POLY = 0xedb88320
+XOR_IN = 0xffffffff
+XOR_OUT = 0xffffffff
+
+
+class CrcEngine(ABC):
+    name = None
+
+    @abstractmethod
+    def checksum(self, data):
+        '''
+        Returns the crc32 of data as an integer.
+        '''
+
+    def digest(self, data):
+        # The checksum is transmitted little endian after the payload.
+        return self.checksum(data).to_bytes(4, byteorder='little')
+
+
+class BitByBitCrc(CrcEngine):
+    name = 'bit_by_bit'
+
+    def __init__(self):
+        from pycrc.algorithms import Crc
+        self.crc = Crc(
+            width=WIDTH,
+            poly=POLY,
+            reflect_in=True,
+            xor_in=XOR_IN,
+            xor_out=XOR_OUT,
+            reflect_out=True
+        )
+
+    def checksum(self, data):
+        return self.crc.bit_by_bit(data)
+
+
+def _build_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ REFLECTED_POLY
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+
+class TableCrc(CrcEngine):
+    name = 'table'
+    table = _build_table()
+
+    def checksum(self, data):
+        table = self.table
+        crc = XOR_IN
+        for byte in data:
+            crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+        return crc ^ XOR_OUT
+
+
+class ZlibCrc(CrcEngine):
+    name = 'zlib'
+
+    def checksum(self, data):
+        return crc32(data)
+
+
+ENGINES = {
+    BitByBitCrc.name: BitByBitCrc,
+    TableCrc.name: TableCrc,
+    ZlibCrc.name: ZlibCrc,
+}
+
+DEFAULT_ENGINE = ZlibCrc.name
+
+
+def make_crc(engine=DEFAULT_ENGINE):
+    '''
+    Returns a crc engine given either its name or an existing engine.
+    '''
+    if isinstance(engine, CrcEngine):
+        return engine
+    try:
+        return ENGINES[engine]()
+    except KeyError:
+        raise ValueError(f'unknown crc engine: {engine}') from None
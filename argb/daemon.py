@@ -0,0 +1,420 @@
+'''
+A daemon which owns a controller's serial port and shares it between
+client processes.
+
+Run python -m argb daemon to start one. Clients connect to its Unix socket
+(DEFAULT_SOCKET) and talk to it with the device's own framing: COBS encoded,
+CRC checked Requests one way, Responses and DebugMessages the other.
+DaemonClient is a Device on the socket, so code written against Device works
+against the daemon, and connecting takes milliseconds instead of waiting for
+the device to reset.
+
+set_light requests are staged per light, the last writer winning, and are
+acknowledged by the daemon straight away: with log 8 if the light and range
+are valid, or error 6 if they aren't, as the firmware does. Any client may
+set any light; statistics() reports which client set each light last and
+how often a light was set by a different client than before. A commit from
+any client
+writes the staged lights to the device as one batch followed by a single
+commit; commits arriving in the same iteration of the event loop are merged
+and the last delta wins. current_time requests are passed on, and the
+responses returned to the clients which asked, in order.
+
+Clients receive the ready log once the device is ready and whenever it
+resets. A client which sends a DebugMessage with id SUBSCRIBE, and a comma
+separated list of SUBSCRIPTIONS as its description, also receives those
+messages from the device. Messages for a client which doesn't keep up with
+them are dropped.
+'''
+import os
+from asyncio import Event, current_task, gather, get_event_loop, open_unix_connection, start_unix_server, Queue
+from collections import deque
+from functools import partial
+from serial_asyncio import create_serial_connection
+from .AsyncServer import ARGBProtocol
+from .Device import Device
+from .stream import PacketProcessor
+from .framing import FrameSplitter
+from .budget import DEFAULT_BAUDRATE
+from .crc import DEFAULT_ENGINE
+from .log import get_logger
+from .messages import (
+    protobuf, request_key, commit_key, valid_set_light, INVALID_CRC, PROTOBUF_DECODE,
+    NO_CALLBACK_ASSIGNED, UNKNOWN_MESSAGE, SET_LIGHT, READY, DEFAULT_LEDS, DEFAULT_LIGHTS)
+
+DEFAULT_SOCKET = os.environ.get(
+    'ARGB_SOCKET', os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'argb.sock'))
+# DebugMessage id of subscription requests from clients.
+SUBSCRIBE = 64
+SUBSCRIPTIONS = ('debug', 'stack_measurement', 'log')
+# Bytes waiting to be sent to a client beyond which messages are dropped.
+CLIENT_BUFFER = 64 * 1024
+
+
+class _Protocol(ARGBProtocol):
+    # Keeps the frame being dispatched, so that it can be passed on to
+    # clients as it is.
+    frame = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The daemon shuts down by itself once the device is gone.
+        self.stop_loop = False
+
+    def process_packet(self, data):
+        self.frame = data
+        try:
+            super().process_packet(data)
+        finally:
+            self.frame = None
+
+
+class Client:
+    def __init__(self, id, reader, writer):
+        self.id = id
+        self.reader = reader
+        self.writer = writer
+        self.framer = FrameSplitter()
+        self.subscriptions = set()
+        self.closed = False
+        self.requests = 0
+        self.dropped = 0
+
+    def send(self, data, droppable=False):
+        if self.closed:
+            return
+        if droppable and self.writer.transport.get_write_buffer_size() > CLIENT_BUFFER:
+            self.dropped += 1
+            return
+        self.writer.write(data)
+
+
+class Daemon:
+    def __init__(self, port, path=DEFAULT_SOCKET, crc=DEFAULT_ENGINE, baudrate=DEFAULT_BAUDRATE,
+                 lights=DEFAULT_LIGHTS, leds=DEFAULT_LEDS):
+        self.port = port
+        self.path = path
+        self.crc = crc
+        self.baudrate = baudrate
+        self.lights = lights
+        self.leds = leds
+        self.logger = get_logger('daemon')
+        self.packet = PacketProcessor(crc)
+        self.protocol = None
+        self.transport = None
+        self.server = None
+        self.device_ready = Event()
+        self.closed = Event()
+        self.clients = set()
+        # The Client every connection is served to, by the task serving it.
+        self._handlers = {}
+        self._next_id = 0
+        # The latest set_light key of every light waiting for a commit, and
+        # the client which last set every light, for the statistics.
+        self.staged = {}
+        self.owners = {}
+        self._commit_delta = None
+        self._commit_handle = None
+        # Clients waiting for a current_time response, in request order.
+        self._time_requests = deque()
+        self._log_frames = {}
+        self.set_lights = 0
+        self.superseded = 0
+        self.takeovers = 0
+        self.invalid = 0
+        self.commits = 0
+        self.commits_merged = 0
+
+    def _log_frame(self, code, is_error=False):
+        frame = self._log_frames.get((code, is_error))
+        if frame is None:
+            response = protobuf().Response()
+            response.log.id = code
+            response.log.is_error = is_error
+            frame = self._log_frames[(code, is_error)] = self.packet.encode_frame(response)
+        return frame
+
+    async def start(self):
+        loop = get_event_loop()
+        await self._check_socket()
+        self.transport, self.protocol = await create_serial_connection(
+            loop,
+            partial(_Protocol, crc=self.crc, baudrate=self.baudrate),
+            self.port,
+            baudrate=self.baudrate)
+        self.protocol.set_delegate(self)
+        self.server = await start_unix_server(self._serve, self.path)
+        self.logger.info('listening on %s', self.path)
+
+    async def _check_socket(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            _, writer = await open_unix_connection(self.path)
+        except OSError:
+            # Left behind by a daemon which didn't shut down cleanly.
+            os.remove(self.path)
+            return
+        writer.close()
+        raise RuntimeError(f'a daemon is already listening on {self.path}')
+
+    def close(self):
+        '''
+        Stops listening and closes the connections to the clients and the
+        device. wait_closed() waits until the clients have been served.
+        '''
+        self.closed.set()
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        for client in self._handlers.values():
+            client.writer.close()
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        handlers = list(self._handlers)
+        if not self.device_ready.is_set():
+            # Clients only start reading once the device is ready.
+            for handler in handlers:
+                handler.cancel()
+        await gather(*handlers, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+
+    # ARGBProtocol delegate.
+
+    def ready(self, protocol):
+        self.logger.info('device ready')
+        self.device_ready.set()
+        # Nothing sent before the reset will be answered.
+        self._time_requests.clear()
+        frame = self._log_frame(READY)
+        for client in self.clients:
+            client.send(frame)
+
+    def process(self, protocol, message):
+        kind = message.WhichOneof('payload')
+        if kind == 'current_time':
+            # The device answers in order, so the response belongs to the
+            # oldest request, even if its client has gone since.
+            if self._time_requests:
+                client = self._time_requests.popleft()
+                client.send(bytes(protocol.frame) + b'\x00')
+        elif kind is not None:
+            # Acknowledgements of the daemon's own set_light requests are only
+            # passed on to clients which subscribed to logs.
+            self._publish(kind, protocol.frame)
+        return False
+
+    def debug_message(self, protocol, message):
+        self._publish('debug', protocol.frame)
+
+    def completed(self, protocol):
+        self.logger.info('device disconnected')
+        self.close()
+
+    def _publish(self, kind, frame):
+        data = None
+        for client in self.clients:
+            if kind in client.subscriptions:
+                if data is None:
+                    data = bytes(frame) + b'\x00'
+                client.send(data, droppable=True)
+
+    # Clients.
+
+    async def _serve(self, reader, writer):
+        client = Client(self._next_id, reader, writer)
+        self._next_id += 1
+        self.logger.info('client %d connected', client.id)
+        task = current_task()
+        self._handlers[task] = client
+        try:
+            await self.device_ready.wait()
+            # The leading delimiter ends whatever a client's reader thinks it
+            # has received so far, like the zeros the firmware sends.
+            client.send(b'\x00' + self._log_frame(READY))
+            self.clients.add(client)
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                client.framer.feed(data)
+                for frame in client.framer:
+                    self._request(client, frame)
+        except ConnectionError:
+            pass
+        finally:
+            del self._handlers[task]
+            self._disconnected(client)
+            writer.close()
+
+    def _disconnected(self, client):
+        client.closed = True
+        self.clients.discard(client)
+        for light in [light for light, owner in self.owners.items() if owner is client]:
+            del self.owners[light]
+        self.logger.info('client %d disconnected', client.id)
+
+    def _request(self, client, frame):
+        client.requests += 1
+        result = self.packet.process_request(frame)
+        if result is None:
+            self.invalid += 1
+            client.send(self._log_frame(INVALID_CRC, True))
+            return
+        kind, message = result
+        if kind == 'set_light':
+            self._set_light(client, request_key(message))
+        elif kind == 'commit_transaction':
+            self._commit(message.commit_transaction.timestamp)
+        elif kind == 'current_time_request':
+            self._time_requests.append(client)
+            self.protocol.send_key(request_key(message))
+        elif kind == 'debug':
+            self._subscribe(client, message)
+        elif kind == 'error':
+            self.invalid += 1
+            client.send(self._log_frame(PROTOBUF_DECODE, True))
+        else:
+            client.send(self._log_frame(UNKNOWN_MESSAGE, True))
+
+    def _subscribe(self, client, message):
+        if message.id != SUBSCRIBE:
+            return
+        kinds = {kind.strip() for kind in message.description.split(',') if kind.strip()}
+        if 'all' in kinds:
+            kinds = set(SUBSCRIPTIONS)
+        client.subscriptions = kinds & set(SUBSCRIPTIONS)
+        self.logger.info('client %d subscribed to %s', client.id,
+                         ', '.join(sorted(client.subscriptions)) or 'nothing')
+
+    def _set_light(self, client, key):
+        fields = key[1]
+        light = fields[0]
+        if not valid_set_light(light, fields[1], self.lights, self.leds):
+            client.send(self._log_frame(NO_CALLBACK_ASSIGNED, True))
+            return
+        self.set_lights += 1
+        if light in self.staged:
+            self.superseded += 1
+        self.staged[light] = key
+        owner = self.owners.get(light)
+        if owner is not client:
+            if owner is not None:
+                self.takeovers += 1
+            self.owners[light] = client
+        client.send(self._log_frame(SET_LIGHT))
+
+    def _commit(self, delta):
+        self._commit_delta = delta
+        if self._commit_handle is not None:
+            self.commits_merged += 1
+            return
+        self._commit_handle = get_event_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._commit_handle = None
+        protocol = self.protocol
+        with protocol.batch():
+            for key in self.staged.values():
+                protocol.send_key(key)
+            protocol.send_key(commit_key(self._commit_delta))
+        self.staged.clear()
+        self.commits += 1
+
+    def statistics(self):
+        return {
+            'clients': {client.id: {'requests': client.requests, 'dropped': client.dropped,
+                                    'subscriptions': sorted(client.subscriptions)}
+                        for client in self.clients},
+            'owners': {light: owner.id for light, owner in self.owners.items()},
+            'set_lights': self.set_lights,
+            'superseded': self.superseded,
+            'takeovers': self.takeovers,
+            'invalid': self.invalid,
+            'commits': self.commits,
+            'commits_merged': self.commits_merged,
+            'mirror': self.protocol.mirror.statistics() if self.protocol else None,
+            'link': self.protocol.link.statistics() if self.protocol else None,
+        }
+
+
+class DaemonClient(Device):
+    '''
+    A Device connected to a Daemon rather than to a serial port.
+
+    Messages of the kinds in subscriptions ('debug' and 'stack_measurement')
+    are queued and returned by next_message(), which requires a window. At
+    most queue_size messages are kept, dropping the oldest.
+    '''
+    def __init__(self, path=DEFAULT_SOCKET, delegate=None, window=4, subscriptions=(),
+                 queue_size=256, **kwargs):
+        super().__init__(path, delegate, window=window, **kwargs)
+        # Other clients may have changed a light since this one last set it,
+        # and the daemon skips redundant writes to the device anyway.
+        self.mirror.enabled = False
+        subscriptions = tuple(subscriptions)
+        if 'log' in subscriptions:
+            raise ValueError("logs can't be told apart from acknowledgements")
+        self.subscriptions = subscriptions
+        self.messages = Queue(queue_size)
+        self.dropped = 0
+        for kind in subscriptions:
+            self.dispatcher.register(kind, partial(self._queue, kind))
+
+    async def _open(self):
+        self.reader, self.writer = await open_unix_connection(self.port)
+        if self.subscriptions:
+            message = protobuf().DebugMessage()
+            message.id = SUBSCRIBE
+            message.description = ','.join(self.subscriptions)
+            self.writer.write(self.packet.encode_frame(message))
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await super().__aexit__(exc_type, exc, tb)
+        self.writer.close()
+
+    def _queue(self, kind, message):
+        if self.messages.full():
+            self.messages.get_nowait()
+            self.dropped += 1
+        self.messages.put_nowait((kind, message))
+
+    async def next_message(self):
+        '''
+        Returns the next (kind, message) subscribed to.
+        '''
+        return await self.messages.get()
+
+
+async def serve(port, path=DEFAULT_SOCKET, **kwargs):
+    '''
+    Runs a daemon until the device disconnects.
+    '''
+    daemon = Daemon(port, path, **kwargs)
+    await daemon.start()
+    try:
+        await daemon.closed.wait()
+    finally:
+        daemon.close()
+        await daemon.wait_closed()
+    return daemon
+
+
+async def monitor(delegate, path=DEFAULT_SOCKET):
+    '''
+    Passes the debug messages and stack measurements of the device behind
+    a daemon to delegate, e.g. a DebugMonitor, until it asks to stop.
+    '''
+    async with DaemonClient(path, subscriptions=('debug', 'stack_measurement')) as client:
+        while True:
+            kind, message = await client.next_message()
+            if kind == 'debug':
+                delegate.debug_message(client, message)
+            elif delegate.process(client, message):
+                break
+        delegate.completed(client)
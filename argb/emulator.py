@@ -0,0 +1,432 @@
+'''
+An emulation of argb_controller.ino on a pseudo-terminal.
+
+Emulator opens a pty and behaves like the firmware on its far end, so
+Device, AsyncServer and Server can connect to Emulator.port instead of
+/dev/ttyACM0. Like an Uno, it resets whenever a client opens the port: it
+sends the initialized debug message, waits out the startup delay, discards
+its input and sends the ready log.
+
+Requests are handled as connection.hpp and the callback in
+argb_controller.ino do: set_light is acknowledged with log 8, or error 6 for
+an invalid light or range; commits aren't acknowledged, and are applied once
+their timestamp has passed since the last applied commit, as
+AnimationController::update does; current_time_request is answered with the
+milliseconds since the reset. Frames which don't fit into the 80 byte packet
+buffer, are too short, fail the CRC check or can't be decoded produce the
+firmware's error codes. The firmware also streams
+stack measurements from its main loop, which can be turned off.
+
+In realtime mode, writes are paced at the baud rate, the input is read no
+faster than the baud rate allows, and errors stall the emulator like the
+firmware's status LED blink does.
+
+Run python -m argb.emulator to start one and print its port.
+'''
+import os
+import select
+import tty
+from collections import deque
+from random import Random
+from threading import Thread, Event
+from time import monotonic, sleep
+from cobs.cobs import encode, decode
+from messages_pb2 import Request, Response, DebugMessage
+from .crc import make_crc, DEFAULT_ENGINE
+from .log import get_logger, set_debug, DEBUG
+from .budget import DEFAULT_BAUDRATE, DEVICE_BUFFER_SIZE, BITS_PER_BYTE
+from .messages import (
+    OVERFLOW, TOO_SHORT, INVALID_CRC, PROTOBUF_DECODE, NO_CALLBACK_ASSIGNED, UNKNOWN_MESSAGE,
+    SET_LIGHT, READY, ARBITRARY_MESSAGE, PROTOBUF_ERROR_DECODE, valid_set_light,
+    DEFAULT_LEDS, DEFAULT_LIGHTS)
+
+
+# STARTUP_DELAY in argb_controller.ino, and the two 200 ms delays of
+# Connection::error.
+STARTUP_DELAY = 3.0
+ERROR_DELAY = 0.4
+# Connection::debug truncates descriptions to 63 characters.
+DEBUG_DESCRIPTION_SIZE = 63
+# StackMeasurer<4>, with plausible values for an ATmega328P.
+STACK_MEASUREMENTS = 4
+RAMEND = 0x8ff
+
+
+def _pack(a, b):
+    value = (a << 16) | b
+    # The fields are int32s.
+    return value - (1 << 32) if value >= 1 << 31 else value
+
+
+class Emulator:
+    def __init__(self, baudrate=DEFAULT_BAUDRATE, realtime=True, startup_delay=STARTUP_DELAY,
+                 error_delay=ERROR_DELAY, stack_measurements=True, error_rate=0.0, seed=None,
+                 buffer_size=DEVICE_BUFFER_SIZE, lights=DEFAULT_LIGHTS, leds=DEFAULT_LEDS,
+                 crc=DEFAULT_ENGINE):
+        self.baudrate = baudrate
+        self.realtime = realtime
+        self.startup_delay = startup_delay
+        self.error_delay = error_delay
+        self.stack_measurements = stack_measurements
+        # Probability of corrupting each byte, in either direction.
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.buffer_size = buffer_size
+        self.lights_count = lights
+        self.leds_count = leds
+        self.crc = make_crc(crc)
+        self.logger = get_logger('emulator')
+        self.master = None
+        self.port = None
+        self._thread = None
+        self._stopped = Event()
+        self.ready = Event()
+        self.resets = 0
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.corrupted = 0
+        self.errors = {}
+        self._reset_state()
+
+    @property
+    def logging(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging.setter
+    def logging(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def _reset_state(self):
+        self.started = monotonic()
+        self._last_read = None
+        self.buffer = bytearray()
+        self.overflowed = False
+        # SetLight messages by id, waiting for a commit and applied.
+        self.staged = {}
+        self.lights = {}
+        # AnimationController is constructed before millis() starts.
+        self.last_commit_time = 0
+        self.commit_update_time = 0
+        self.did_update = False
+        # millis() of the most recently applied commits.
+        self.applied = deque(maxlen=1000)
+        self.commits = 0
+        self.measured = {0, 1}
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        self.master, slave = os.openpty()
+        self.port = os.ttyname(slave)
+        tty.setraw(slave)
+        # Only clients keep the slave open, so the master sees a hang up
+        # while nobody is connected.
+        os.close(slave)
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='argb-emulator', daemon=True)
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self.master is not None:
+            os.close(self.master)
+            self.master = None
+
+    def _sleep(self, seconds):
+        if self.realtime and seconds > 0:
+            self._stopped.wait(seconds)
+
+    def _airtime(self, size):
+        return size * BITS_PER_BYTE / self.baudrate
+
+    def _connected(self, timeout):
+        poll = select.poll()
+        poll.register(self.master, select.POLLIN)
+        events = poll.poll(timeout * 1000)
+        return not any(event & select.POLLHUP for _, event in events)
+
+    def _run(self):
+        connected = False
+        while not self._stopped.is_set():
+            if not self._connected(self._idle_timeout(0.01) if connected else 0.05):
+                if connected:
+                    self.log('client disconnected')
+                    self.ready.clear()
+                connected = False
+                continue
+            if not connected:
+                connected = True
+                self.log('client connected')
+                try:
+                    self._setup()
+                except OSError:
+                    connected = False
+                    continue
+            try:
+                self._loop()
+            except OSError:
+                # The client closed the port while it was being written.
+                connected = False
+                self.ready.clear()
+
+    def _setup(self):
+        self.resets += 1
+        self._reset_state()
+        self.debug(ARBITRARY_MESSAGE, 'initialized')
+        self._sleep(self.startup_delay)
+        # Clear the input buffer before initiating messages.
+        while self._read_available():
+            pass
+        self.buffer.clear()
+        self.log_code(READY)
+        self.ready.set()
+
+    def _read_available(self, limit=4096):
+        if not select.select([self.master], [], [], 0)[0]:
+            return b''
+        try:
+            return os.read(self.master, limit)
+        except OSError:
+            return b''
+
+    def _loop(self):
+        # One iteration of loop() in argb_controller.ino.
+        if self.realtime:
+            # Only what the line could have carried since the last read. When
+            # the loop waited for input, the first byte has only just arrived.
+            now = monotonic()
+            if self._last_read is None:
+                limit = 1
+                self._last_read = now
+            else:
+                limit = int((now - self._last_read) / self._airtime(1))
+                self._last_read += self._airtime(limit)
+        else:
+            limit = 4096
+        data = self._read_available(limit) if limit else b''
+        if limit and not data and not self.stack_measurements:
+            self._last_read = None
+        if data:
+            self.bytes_in += len(data)
+            self._update(self._corrupt(data))
+        self._update_animation()
+        self.measured.add(2)
+        if self.stack_measurements:
+            self._send_stack_measurements()
+        elif not data and limit:
+            select.select([self.master], [], [], self._idle_timeout(0.001 if self.realtime else 0.01))
+        elif not data:
+            # Waiting for the next byte.
+            sleep(self._idle_timeout(self._airtime(1)))
+
+    def _idle_timeout(self, timeout):
+        # Waiting for input mustn't delay a pending commit.
+        if self.did_update:
+            due = self.last_commit_time + self.commit_update_time - self.millis()
+            timeout = min(timeout, max(due, 0) / 1000)
+        return timeout
+
+    def _update_animation(self):
+        # AnimationController::update
+        if self.did_update and self.millis() - self.last_commit_time >= self.commit_update_time:
+            self.lights.update(self.staged)
+            self.staged.clear()
+            self.did_update = False
+            self.last_commit_time = self.millis()
+            self.commit_update_time = 0
+            self.applied.append(self.last_commit_time)
+
+    def _corrupt(self, data):
+        if not self.error_rate:
+            return data
+        data = bytearray(data)
+        for index in range(len(data)):
+            if self.random.random() < self.error_rate:
+                data[index] ^= 1 << self.random.randrange(8)
+                self.corrupted += 1
+        return data
+
+    def _update(self, data):
+        # PacketSerial::update followed by the overflow check of
+        # Connection::update.
+        for byte in data:
+            if byte == 0:
+                if self.buffer:
+                    packet = bytes(self.buffer)
+                    self.buffer.clear()
+                    self.overflowed = False
+                    self._packet(packet)
+            elif len(self.buffer) + 1 < self.buffer_size:
+                self.buffer.append(byte)
+            else:
+                self.overflowed = True
+        if self.overflowed:
+            self.error(OVERFLOW)
+
+    def _packet(self, packet):
+        self.frames += 1
+        try:
+            payload = decode(packet)
+        except Exception:
+            # PacketSerial hands over whatever its COBS decoder produced,
+            # which won't pass the CRC check.
+            payload = packet
+        if len(payload) <= 4:
+            self.error(TOO_SHORT)
+            return
+        if self.crc.digest(payload[:-4]) != payload[-4:]:
+            self.error(INVALID_CRC)
+            return
+        try:
+            request = Request.FromString(payload[:-4])
+        except Exception as error:
+            self.error(PROTOBUF_DECODE)
+            self.debug(PROTOBUF_ERROR_DECODE, str(error))
+            return
+        self._callback(request)
+
+    def _callback(self, request):
+        self.measured.add(3)
+        kind = request.WhichOneof('payload')
+        if kind == 'set_light':
+            if self._update_command(request.set_light):
+                self.log_code(SET_LIGHT)
+            else:
+                self.error(NO_CALLBACK_ASSIGNED)
+        elif kind == 'commit_transaction':
+            # AnimationController::set_commit_time
+            self.commit_update_time = request.commit_transaction.timestamp
+            self.did_update = True
+            self.commits += 1
+        elif kind == 'current_time_request':
+            response = Response()
+            response.current_time.timestamp = self.millis()
+            self.send(response)
+        else:
+            self.error(UNKNOWN_MESSAGE)
+
+    def _update_command(self, set_light):
+        # AnimationController::update_command
+        if not valid_set_light(set_light.id, set_light.range, self.lights_count, self.leds_count):
+            return False
+        message = Request().set_light
+        message.CopyFrom(set_light)
+        self.staged[set_light.id] = message
+        return True
+
+    def millis(self):
+        return int((monotonic() - self.started) * 1000)
+
+    def _send_stack_measurements(self):
+        response = Response()
+        message = response.stack_measurement
+        message.data = _pack(0x100, 0x11e)
+        message.bss = _pack(0x11e, 0x2f4)
+        message.heap = _pack(0x2f4, 0)
+        message.heap_gap = _pack(0, 128)
+        message.stack = _pack(RAMEND - 64 - 16 * max(self.measured), RAMEND)
+        for id in sorted(self.measured):
+            message.id = id
+            self.send(response)
+
+    def send(self, message):
+        # Connection::send
+        payload = bytearray(message.SerializeToString())
+        payload.extend(self.crc.digest(payload))
+        data = self._corrupt(b'\x00\x00\x00\x00' + encode(payload) + b'\x00')
+        self._write(data)
+
+    def _write(self, data):
+        # The last byte leaves the firmware's serial buffer after the
+        # airtime of the whole frame.
+        self._sleep(self._airtime(len(data)))
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master, view)
+            view = view[written:]
+        self.bytes_out += len(data)
+
+    def log_code(self, code):
+        response = Response()
+        response.log.id = code
+        response.log.is_error = False
+        self.send(response)
+
+    def error(self, code):
+        self.log('error %d', code)
+        self.errors[code] = self.errors.get(code, 0) + 1
+        response = Response()
+        response.log.id = code
+        response.log.is_error = True
+        self.send(response)
+        self._sleep(self.error_delay)
+
+    def debug(self, code, description):
+        message = DebugMessage()
+        message.id = code
+        message.description = description[:DEBUG_DESCRIPTION_SIZE]
+        self.send(message)
+
+    def statistics(self):
+        return {
+            'resets': self.resets,
+            'frames': self.frames,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'corrupted': self.corrupted,
+            'errors': dict(self.errors),
+            'commits': self.commits,
+        }
+
+
+def run(baudrate=DEFAULT_BAUDRATE, fast=False, no_stack=False, error_rate=0.0, log=False):
+    '''
+    Runs an emulator until interrupted, printing its port.
+    '''
+    emulator = Emulator(
+        baudrate=baudrate,
+        realtime=not fast,
+        stack_measurements=not no_stack,
+        error_rate=error_rate)
+    emulator.logging = log
+    with emulator:
+        print(emulator.port, flush=True)
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            print()
+            print(emulator.statistics())
+
+
+def main():
+    import click
+
+    @click.command
+    @click.option('-b', '--baudrate', default=DEFAULT_BAUDRATE, show_default=True)
+    @click.option('--fast', is_flag=True, help='Run without pacing or delays.')
+    @click.option('--no-stack', is_flag=True, help="Don't stream stack measurements.")
+    @click.option('-e', '--error-rate', default=0.0, show_default=True,
+                  help='Probability of corrupting each byte.')
+    @click.option('-l', '--log', is_flag=True)
+    def command(baudrate, fast, no_stack, error_rate, log):
+        run(baudrate, fast, no_stack, error_rate, log)
+
+    command()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+DELIMITER = 0
+
+
+class FrameSplitter:
+    '''
+    Splits a stream of COBS encoded bytes into frames separated by zero bytes.
+
+    Bytes are appended with feed() and complete frames are returned as
+    memoryview slices of the internal buffer, so they should be released
+    before the next call to feed(). Consumed bytes are dropped from the front of the
+    buffer only once compact_threshold of them have accumulated, so each
+    byte is scanned once regardless of how the input is chunked.
+    '''
+    def __init__(self, compact_threshold=4096):
+        self.buffer = bytearray()
+        self.compact_threshold = compact_threshold
+        # Start of the frame currently being received.
+        self.frame_start = 0
+        # Position from which to continue searching for a delimiter.
+        self.scan_offset = 0
+        self.frames = 0
+        self.compactions = 0
+        # Whether fed bytes are dropped up to the next delimiter, see resync().
+        self.discarding = False
+
+    def __len__(self):
+        '''
+        Number of buffered bytes which are not part of a returned frame.
+        '''
+        return len(self.buffer) - self.frame_start
+
+    def feed(self, data):
+        try:
+            self._compact()
+            self.buffer.extend(data)
+        except BufferError:
+            # A frame handed out earlier is still referenced, so the buffer
+            # can't be resized. Move the unconsumed bytes to a new buffer.
+            self.buffer = self.buffer[self.frame_start:]
+            self.scan_offset -= self.frame_start
+            self.frame_start = 0
+            self.compactions += 1
+            self.buffer.extend(data)
+        if self.discarding:
+            self.discarding = not self.discard_until_delimiter()
+
+    def next_frame(self):
+        '''
+        Returns the next complete frame, or None if there isn't one yet.
+        '''
+        buffer = self.buffer
+        start = self.frame_start
+        scan_offset = self.scan_offset
+        while True:
+            index = buffer.find(DELIMITER, scan_offset)
+            if index == -1:
+                self.frame_start = start
+                self.scan_offset = len(buffer)
+                return None
+            # Consecutive delimiters produce empty frames, which are skipped.
+            if index > start:
+                self.frame_start = self.scan_offset = index + 1
+                self.frames += 1
+                return memoryview(buffer)[start:index]
+            start = scan_offset = index + 1
+
+    def __iter__(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def discard_until_delimiter(self):
+        '''
+        Drops the partially received frame up to and including the next
+        delimiter. Returns False if no delimiter has been received yet, in
+        which case everything buffered is dropped.
+        '''
+        index = self.buffer.find(DELIMITER, self.frame_start)
+        if index == -1:
+            self.frame_start = self.scan_offset = len(self.buffer)
+            return False
+        self.frame_start = self.scan_offset = index + 1
+        return True
+
+    def resync(self):
+        '''
+        Drops everything buffered, and everything fed afterwards up to and
+        including the next delimiter, so that the next frame returned starts
+        at a frame boundary.
+        '''
+        self.frame_start = self.scan_offset = len(self.buffer)
+        self.discarding = True
+
+    def _compact(self):
+        if self.frame_start == 0:
+            return
+        if self.frame_start < self.compact_threshold and self.frame_start != len(self.buffer):
+            return
+        del self.buffer[:self.frame_start]
+        self.scan_offset -= self.frame_start
+        self.frame_start = 0
+        self.compactions += 1
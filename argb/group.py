@@ -0,0 +1,214 @@
+from asyncio import gather
+from .Device import Device
+from .messages import set_light_key, commit_key, DEFAULT_LEDS, DEFAULT_LIGHTS
+from .log import get_logger, set_debug, DEBUG
+
+
+def _lerp(a, b, t):
+    return tuple(round(x + (y - x) * t) for x, y in zip(a, b))
+
+
+class DeviceGroup:
+    '''
+    Drives several devices from one event loop as if they were one long
+    strip.
+
+    The LEDs of the devices are concatenated in the order of ports into a
+    global index space, so a light spanning global LEDs start to end is sent
+    as one set_light per device it touches, each using the same light id and
+    the device local part of the range. Gradients are split at the device
+    boundaries so that the colours line up.
+
+    Devices are opened with a window (see Device), and commits are written to
+    all devices back to back once every device's set_light requests have gone
+    out, so that scenes switch on all devices together.
+    '''
+    def __init__(self, ports, delegate=None, leds=DEFAULT_LEDS, lights=DEFAULT_LIGHTS, window=4,
+                 **kwargs):
+        if isinstance(leds, int):
+            leds = [leds] * len(ports)
+        if len(leds) != len(ports):
+            raise ValueError('leds must give the number of LEDs of every port')
+        self.ports = list(ports)
+        self.leds = list(leds)
+        self.lights = lights
+        self.devices = [Device(port, delegate, window=window, **kwargs) for port in self.ports]
+        self.offsets = []
+        offset = 0
+        for count in self.leds:
+            self.offsets.append(offset)
+            offset += count
+        self.size = offset
+        self.logger = get_logger('group')
+
+    @property
+    def logging(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging.setter
+    def logging(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, index):
+        return self.devices[index]
+
+    async def __aenter__(self):
+        self.log('enter')
+        # Every device waits several seconds for the firmware to start, so
+        # open them all at once.
+        results = await gather(*(device.__aenter__() for device in self.devices),
+                               return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await gather(*(device.__aexit__(None, None, None)
+                           for device, result in zip(self.devices, results)
+                           if not isinstance(result, BaseException)))
+            raise errors[0]
+        self.log('ready')
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await gather(*(device.__aexit__(exc_type, exc, tb) for device in self.devices))
+        self.log('exit')
+
+    def locate(self, start, end):
+        '''
+        Returns (device index, local start, local end) for every device the
+        global LEDs start to end (exclusive) fall on.
+        '''
+        if start > end:
+            start, end = end, start
+        if start < 0 or end > self.size:
+            raise IndexError(f'LEDs {start} to {end} are outside of 0 to {self.size}')
+        parts = []
+        for index, (offset, count) in enumerate(zip(self.offsets, self.leds)):
+            local_start = max(start - offset, 0)
+            local_end = min(end - offset, count)
+            if local_start < local_end:
+                parts.append((index, local_start, local_end))
+        return parts
+
+    def set_light_keys(
+            self,
+            index,
+            start,
+            end,
+            start_color,
+            end_color,
+            ahds,
+            start_color_alt=None,
+            end_color_alt=None):
+        '''
+        Returns a list of (device index, request key) for a light covering
+        the global LEDs start to end.
+        '''
+        if not 0 <= index < self.lights:
+            raise IndexError(f'light {index} is outside of 0 to {self.lights}')
+        start_color_alt = start_color_alt or start_color
+        end_color_alt = end_color_alt or end_color
+        if start > end:
+            start, end = end, start
+        length = end - start
+        keys = []
+        for device, local_start, local_end in self.locate(start, end):
+            offset = self.offsets[device]
+            # The firmware interpolates from the A to the B colours across a
+            # light's LEDs, so each part gets the colours at its own ends.
+            first = (local_start + offset - start) / length
+            last = (local_end + offset - start) / length
+            keys.append((device, set_light_key(
+                index,
+                local_start,
+                local_end,
+                _lerp(start_color, start_color_alt, first),
+                _lerp(end_color, end_color_alt, first),
+                ahds,
+                _lerp(start_color, start_color_alt, last),
+                _lerp(end_color, end_color_alt, last))))
+        return keys
+
+    def _scene_keys(self, scene):
+        keys = [[] for _ in self.devices]
+        for light in scene:
+            for device, key in self.set_light_keys(**light):
+                keys[device].append(key)
+        return keys
+
+    async def _send_lights(self, device, keys, force):
+        with device.batch():
+            return [await device.send_key(key, force) for key in keys]
+
+    async def send_scene(self, scene, delta=0, force=False):
+        '''
+        Sends a scene, an iterable of set_light keyword arguments in global
+        coordinates, to all devices followed by a commit of delta. Returns
+        the futures acknowledging the set_light requests of each device (see
+        Device.send).
+        '''
+        keys = self._scene_keys(scene)
+        futures = await gather(*(self._send_lights(device, device_keys, force)
+                                 for device, device_keys in zip(self.devices, keys)))
+        self.commit_all(delta, force)
+        await gather(*(device.writer.drain() for device in self.devices))
+        return futures
+
+    async def send_scene_at(self, scene, at, clocks, force=False):
+        '''
+        Sends a scene like send_scene, but has every device apply it at host
+        time at, using the ClockSync of each device in clocks (see
+        clock.ClockSync.apply_at). Returns the futures of each device and
+        the latest host time a device is expected to apply it at.
+        '''
+        keys = self._scene_keys(scene)
+        results = await gather(*(clock.apply_at(at, device_keys, force)
+                                 for clock, device_keys in zip(clocks, keys)))
+        return [futures for futures, _ in results], max(applied for _, applied in results)
+
+    def commit_all(self, delta=0, force=False):
+        '''
+        Writes a commit to every device without yielding to the event loop
+        in between. Commits aren't acknowledged, so nothing waits on the
+        window.
+        '''
+        key = commit_key(delta)
+        for device in self.devices:
+            device.flush_batch()
+            if device.queue_key(key, force):
+                device.flush_batch()
+        self.log('commit')
+
+    async def send_commit(self, delta=0, force=False):
+        self.commit_all(delta, force)
+        await gather(*(device.writer.drain() for device in self.devices))
+
+    async def send_light(self, *args, force=False, **kwargs):
+        '''
+        Pipelined set_light in global coordinates. Returns the futures of the
+        requests sent to each device the light touches.
+        '''
+        futures = []
+        for device, key in self.set_light_keys(*args, **kwargs):
+            futures.append(await self.devices[device].send_key(key, force))
+        return futures
+
+    async def flush(self):
+        return await gather(*(device.flush() for device in self.devices))
+
+    def statistics(self):
+        return [
+            {
+                'port': device.port,
+                'batching': device.batch_statistics(),
+                'mirror': device.mirror.statistics(),
+                'cache': device.cache.statistics(),
+                'budget': device.budget.statistics(),
+                'link': device.link.statistics(),
+            }
+            for device in self.devices
+        ]
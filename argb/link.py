@@ -0,0 +1,186 @@
+'''
+Link quality tracking.
+
+Every frame received from the device is recorded in a LinkQuality with its
+outcome: decoded fine, failed the CRC check, failed COBS decoding, too short
+to hold a CRC, or failed protobuf decoding. Error logs in which the device
+reports that it couldn't read one of our frames are recorded as rejected.
+The last window outcomes are kept, and their error rates decide the health
+of the link:
+
+- healthy: the error rate is at most degraded_threshold.
+- degraded: the link works, but callers such as the AnimationScheduler
+  should send less.
+- resyncing: an outcome exceeded its threshold in thresholds, or all errors
+  together exceeded error_threshold. The transport drops what it has
+  buffered up to the next delimiter, fails or holds back requests in flight
+  and drops what it receives for settle_time seconds, long enough for the
+  responses still on their way, before the link is used again. A ready log
+  ends the resync early. The device isn't reset, but when it resets on its
+  own its ready log is handled by the transport as usual.
+'''
+from collections import deque
+from time import monotonic
+from .messages import OVERFLOW, TOO_SHORT, INVALID_CRC, PROTOBUF_DECODE
+
+# Outcomes of received frames.
+OK = 'ok'
+CRC = 'crc'
+COBS = 'cobs'
+RUNT = 'runt'
+DECODE = 'decode'
+REJECTED = 'rejected'
+OUTCOMES = (OK, CRC, COBS, RUNT, DECODE, REJECTED)
+
+# Errors in which the device reports a frame it couldn't read.
+REJECTION_CODES = (OVERFLOW, TOO_SHORT, INVALID_CRC, PROTOBUF_DECODE)
+
+HEALTHY = 'healthy'
+DEGRADED = 'degraded'
+RESYNCING = 'resyncing'
+
+# Fraction of the window each kind of error may make up before resyncing.
+DEFAULT_THRESHOLDS = {CRC: 0.2, COBS: 0.2, RUNT: 0.3, DECODE: 0.2, REJECTED: 0.2}
+# Connection::error blinks for 400 ms before the firmware reads on, after
+# which the frames written after a rejected one are answered.
+SETTLE_TIME = 0.5
+
+
+class LinkQuality:
+    def __init__(self, window=50, thresholds=None, error_threshold=0.3, degraded_threshold=0.05,
+                 minimum_frames=10, settle_time=SETTLE_TIME, clock=monotonic):
+        self.window = window
+        self.thresholds = dict(DEFAULT_THRESHOLDS if thresholds is None else thresholds)
+        self.error_threshold = error_threshold
+        self.degraded_threshold = degraded_threshold
+        # Thresholds are only checked once the window holds this many frames.
+        self.minimum_frames = minimum_frames
+        self.settle_time = settle_time
+        self.clock = clock
+        self.outcomes = deque()
+        self.counts = dict.fromkeys(OUTCOMES, 0)
+        self.totals = dict.fromkeys(OUTCOMES, 0)
+        self.state = HEALTHY
+        # Called with the link and its new health whenever it changes.
+        self.listeners = []
+        self.resyncs = 0
+        # Resyncs which settled rather than ended with a ready log.
+        self.resyncs_settled = 0
+        self.resync_time = 0.0
+        self.reason = None
+        self._resync_started = None
+
+    def record(self, outcome):
+        '''
+        Records the outcome of a received frame. Returns True if it started
+        a resync.
+        '''
+        outcomes = self.outcomes
+        counts = self.counts
+        if len(outcomes) >= self.window:
+            counts[outcomes.popleft()] -= 1
+        outcomes.append(outcome)
+        counts[outcome] += 1
+        self.totals[outcome] += 1
+        if outcome == OK and self.state == HEALTHY:
+            return False
+        return self._update()
+
+    def rejected(self, message):
+        '''
+        Records an error log from the device as rejected if it reports an
+        unreadable frame, in place of the outcome it was recorded with when
+        it was received. Returns True if it started a resync.
+        '''
+        if not (message.log.is_error and message.log.id in REJECTION_CODES):
+            return False
+        outcomes = self.outcomes
+        if outcomes and outcomes[-1] == OK:
+            outcomes.pop()
+            self.counts[OK] -= 1
+            self.totals[OK] -= 1
+        return self.record(REJECTED)
+
+    def _update(self):
+        if self.state == RESYNCING:
+            self._check_settled()
+            return False
+        size = len(self.outcomes)
+        errors = size - self.counts[OK]
+        if size >= self.minimum_frames:
+            for outcome, threshold in self.thresholds.items():
+                if self.counts[outcome] > threshold * size:
+                    self.start_resync(f'{outcome} rate {self.counts[outcome] / size:.2f}')
+                    return True
+            if errors > self.error_threshold * size:
+                self.start_resync(f'error rate {errors / size:.2f}')
+                return True
+        self._set_state(DEGRADED if errors > self.degraded_threshold * size else HEALTHY)
+        return False
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        for listener in self.listeners:
+            listener(self, state)
+
+    def _clear(self):
+        self.outcomes.clear()
+        for outcome in self.counts:
+            self.counts[outcome] = 0
+
+    def start_resync(self, reason=None):
+        if self.state == RESYNCING:
+            return
+        self.resyncs += 1
+        self.reason = reason
+        self._resync_started = self.clock()
+        self._clear()
+        self._set_state(RESYNCING)
+
+    def ready(self):
+        '''
+        Records the device's ready log, which ends a resync.
+        '''
+        if self.state != RESYNCING:
+            return
+        self.resync_time += self.clock() - self._resync_started
+        self._resync_started = None
+        self._clear()
+        self._set_state(HEALTHY)
+
+    def _check_settled(self):
+        if self.clock() - self._resync_started >= self.settle_time:
+            self.resyncs_settled += 1
+            self.ready()
+
+    @property
+    def health(self):
+        if self.state == RESYNCING:
+            self._check_settled()
+        return self.state
+
+    @property
+    def healthy(self):
+        return self.health == HEALTHY
+
+    @property
+    def resyncing(self):
+        return self.health == RESYNCING
+
+    def error_rate(self):
+        size = len(self.outcomes)
+        return (size - self.counts[OK]) / size if size else 0.0
+
+    def statistics(self):
+        return {
+            'health': self.health,
+            'error_rate': self.error_rate(),
+            'window': {outcome: count for outcome, count in self.counts.items() if count},
+            'totals': dict(self.totals),
+            'resyncs': self.resyncs,
+            'resyncs_settled': self.resyncs_settled,
+            'resync_time': self.resync_time,
+            'reason': self.reason,
+        }
@@ -0,0 +1,207 @@
+'''
+Logging shared by the transports, on top of the standard library's logging.
+
+Every subsystem (connection, protocol, device, packet, ...) logs through the
+logger get_logger() returns for it, logging.getLogger('argb.<subsystem>').
+Messages are %-style format strings followed by their arguments, which
+logging only formats once a record is emitted; arguments which are
+expensive to turn into text, such as hex dumps, are wrapped in Lazy (see
+hexdump) so that even that work is skipped. Hot paths can also check
+isEnabledFor() before building any arguments at all.
+
+configure() sets the levels per subsystem from a specification such as
+ARGB_LOG=debug or ARGB_LOG=info,packet=error and prints the records of the
+argb loggers. The CLI calls it; a program using the package configures
+logging as it likes instead.
+
+Warnings which can repeat for every frame, such as CRC failures on a noisy
+link, are logged with limited(): RateLimit, a filter on every logger
+get_logger() returns, lets the first occurrence through and counts further
+ones, which are reported with the next occurrence at most every
+SUMMARY_INTERVAL seconds and by flush_limited().
+'''
+import logging
+import os
+import sys
+from time import monotonic
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+OFF = logging.CRITICAL + 10
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR, 'off': OFF}
+
+ROOT = 'argb'
+DEFAULT_LEVEL = INFO
+# Seconds between reports of a rate limited warning.
+SUMMARY_INTERVAL = 5.0
+
+# Levels configure() set, by logger name, which set_debug() returns to.
+_configured = {}
+
+
+def parse_levels(text):
+    '''
+    Returns (default level or None, {subsystem: level}) for a specification
+    such as 'info,packet=error'.
+    '''
+    default = None
+    levels = {}
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        subsystem, _, level = item.rpartition('=')
+        level = LEVELS[level.strip().lower()]
+        if subsystem:
+            levels[subsystem.strip()] = level
+        else:
+            default = level
+    return default, levels
+
+
+def configure(text=None, stream=None):
+    '''
+    Applies a level specification, by default from ARGB_LOG, and prints the
+    records of the argb loggers to stream, stdout by default, as
+    'subsystem: message'.
+    '''
+    if text is None:
+        text = os.environ.get('ARGB_LOG', '')
+    default, levels = parse_levels(text)
+    root = logging.getLogger(ROOT)
+    if not root.handlers:
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter('%(subsystem)s: %(message)s'))
+        handler.addFilter(_add_subsystem)
+        root.addHandler(handler)
+        root.propagate = False
+    root.setLevel(DEFAULT_LEVEL if default is None else default)
+    for subsystem, level in levels.items():
+        name = f'{ROOT}.{subsystem}'
+        _configured[name] = level
+        logging.getLogger(name).setLevel(level)
+
+
+def _add_subsystem(record):
+    record.subsystem = record.name[len(ROOT) + 1:] or ROOT
+    return True
+
+
+class RateLimit(logging.Filter):
+    '''
+    Rate limits the records logged with limited(), by key.
+    '''
+    def __init__(self, interval=SUMMARY_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        # [time last emitted, suppressed count, level] by key. Arguments
+        # aren't kept, as they may be views of buffers which are about to be
+        # reused.
+        self.state = {}
+
+    def filter(self, record):
+        key = getattr(record, 'limit', None)
+        if key is None:
+            return True
+        now = monotonic()
+        state = self.state.get(key)
+        if state is None:
+            self.state[key] = [now, 0, record.levelno]
+            return True
+        if now - state[0] < self.interval:
+            state[1] += 1
+            return False
+        suppressed = state[1]
+        state[0] = now
+        state[1] = 0
+        if suppressed:
+            record.msg = f'{record.msg} (and {suppressed} more since the last report)'
+        return True
+
+    def statistics(self):
+        return {key: state[1] for key, state in self.state.items()}
+
+
+def get_logger(subsystem):
+    '''
+    Returns the logger of subsystem, with a RateLimit filter.
+    '''
+    logger = logging.getLogger(f'{ROOT}.{subsystem}')
+    if not any(isinstance(installed, RateLimit) for installed in logger.filters):
+        logger.addFilter(RateLimit())
+    return logger
+
+
+def _rate_limit(logger):
+    for installed in logger.filters:
+        if isinstance(installed, RateLimit):
+            return installed
+    return None
+
+
+def limited(logger, key, msg, *args, level=WARNING):
+    '''
+    Logs a warning identified by key at most once every SUMMARY_INTERVAL
+    seconds, counting the occurrences in between.
+    '''
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={'limit': key})
+
+
+def flush_limited(logger):
+    '''
+    Logs a summary of every rate limited warning of logger with suppressed
+    occurrences, e.g. before closing.
+    '''
+    rate_limit = _rate_limit(logger)
+    if rate_limit is None:
+        return
+    for key, state in rate_limit.state.items():
+        _, suppressed, level = state
+        if suppressed:
+            logger.log(level, '%d more %s warnings', suppressed, key)
+        state[1] = 0
+
+
+def set_debug(logger, enabled):
+    '''
+    Logs logger's debug records, or returns it to the level configure() set.
+    '''
+    logger.setLevel(DEBUG if enabled else _configured.get(logger.name, logging.NOTSET))
+
+
+class Lazy:
+    '''
+    Calls function(*args) when converted to a string, so that it is only
+    called if the record it is an argument of is emitted.
+    '''
+    __slots__ = ('function', 'args')
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __str__(self):
+        return str(self.function(*self.args))
+
+
+def hexdump(data):
+    return Lazy(_hex, data)
+
+
+def _hex(data):
+    return bytes(data).hex('-')
+
+
+def one_line(value):
+    '''
+    Formats value, such as a protobuf message, on a single line.
+    '''
+    return Lazy(_one_line, value)
+
+
+def _one_line(value):
+    return ' '.join(str(value).split())
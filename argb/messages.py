@@ -1,4 +1,39 @@
-from messages_pb2 import Request, DebugMessage, Response
+from importlib import import_module
+
+# messages_pb2 pulls in the protobuf runtime, so it is only imported once a
+# protobuf message is actually needed. Request, DebugMessage and Response
+# are still available as attributes of this module.
+PROTOBUF_CLASSES = ('Request', 'DebugMessage', 'Response')
+
+_protobuf = None
+
+def protobuf():
+    global _protobuf
+    if _protobuf is None:
+        _protobuf = import_module('messages_pb2')
+    return _protobuf
+
+def __getattr__(name):
+    if name in PROTOBUF_CLASSES:
+        return getattr(protobuf(), name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# ErrorCode, LogCode and DebugCode in connection.hpp.
+OVERFLOW = 1
+TOO_SHORT = 2
+INVALID_CRC = 3
+PROTOBUF_DECODE = 4
+NO_CALLBACK_ASSIGNED = 6
+UNKNOWN_MESSAGE = 7
+SET_LIGHT = 8
+READY = 9
+ARBITRARY_MESSAGE = 10
+PROTOBUF_ERROR_DECODE = 11
+
+# Must match MAXIMUM_NUMBER_OF_LEDS and the number of lights of the
+# AnimationController in argb_controller.ino.
+DEFAULT_LEDS = 20
+DEFAULT_LIGHTS = 4
 
 def pack_rgb(v):
     a, b, c = v
@@ -8,7 +43,19 @@ def pack_ahds(v):
     a, h, d, s = v
     return (a << 24) | (h << 16) | (d << 8) | s
 
-def set_light(
+# Requests are identified by a key of (payload name, value). For set_light the
+# value is a tuple of the SetLight fields in the order they are declared in
+# messages.proto, for commits it is the timestamp.
+
+# The response the firmware sends to acknowledge each kind of request. Commits
+# are not acknowledged.
+ACKNOWLEDGEMENTS = {
+    'set_light': 'log',
+    'current_time_request': 'current_time',
+    'commit_transaction': None,
+}
+
+def set_light_key(
         index,
         start,
         end,
@@ -19,19 +66,74 @@ def set_light(
         end_color_alt=None):
     start_color_alt = start_color_alt or start_color
     end_color_alt = end_color_alt or end_color
-    request = Request()
-    message = request.set_light
-    message.id = index
-    message.range = (start << 16) | end
-    message.start_color = pack_rgb(start_color)
-    message.end_color = pack_rgb(end_color)
-    message.start_color_alt = pack_rgb(start_color_alt)
-    message.end_color_alt = pack_rgb(end_color_alt)
-    message.ahds = pack_ahds(ahds)
+    return ('set_light', (
+        index,
+        (start << 16) | end,
+        pack_rgb(start_color),
+        pack_rgb(end_color),
+        pack_ahds(ahds),
+        pack_rgb(start_color_alt),
+        pack_rgb(end_color_alt),
+    ))
+
+def commit_key(delta):
+    return ('commit_transaction', delta)
+
+def request_key(request):
+    kind = request.WhichOneof('payload')
+    if kind == 'set_light':
+        message = request.set_light
+        return (kind, (
+            message.id,
+            message.range,
+            message.start_color,
+            message.end_color,
+            message.ahds,
+            message.start_color_alt,
+            message.end_color_alt,
+        ))
+    elif kind == 'commit_transaction':
+        return (kind, request.commit_transaction.timestamp)
+    elif kind == 'current_time_request':
+        return (kind, request.current_time_request)
+    return (kind, None)
+
+def valid_set_light(id, range, lights, leds):
+    '''
+    Whether the firmware accepts a set_light for light id and the packed
+    range (see AnimationController::update_command), given its number of
+    lights and LEDs.
+    '''
+    if not 0 <= id < lights:
+        return False
+    start = (range >> 16) & 0xffff
+    end = range & 0xffff
+    if start > end:
+        start, end = end, start
+    return start < leds and end <= leds
+
+def build_request(key):
+    kind, value = key
+    request = protobuf().Request()
+    if kind == 'set_light':
+        message = request.set_light
+        (message.id,
+         message.range,
+         message.start_color,
+         message.end_color,
+         message.ahds,
+         message.start_color_alt,
+         message.end_color_alt) = value
+    elif kind == 'commit_transaction':
+        request.commit_transaction.timestamp = value
+    elif kind == 'current_time_request':
+        request.current_time_request = value
+    else:
+        raise ValueError(f'unknown request: {kind}')
     return request
 
+def set_light(*args, **kwargs):
+    return build_request(set_light_key(*args, **kwargs))
+
 def commit(delta):
-    request = Request()
-    message = request.commit_transaction
-    message.timestamp = delta
-    return request
+    return build_request(commit_key(delta))
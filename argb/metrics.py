@@ -0,0 +1,182 @@
+import os
+from bisect import bisect_left
+from collections import deque
+from time import perf_counter
+
+# Upper bounds, in seconds, of the latency histogram buckets. A frame takes
+# about 30 ms to send at 9600 baud.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper bounds, in seconds, of the encode and decode time buckets.
+CODEC_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3)
+
+COUNTERS = (
+    'messages_in',
+    'messages_out',
+    'bytes_in',
+    'bytes_out',
+    'cobs_failures',
+    'crc_failures',
+    'runts',
+    'decode_failures',
+)
+
+HISTOGRAMS = {
+    'ack_latency_seconds': LATENCY_BUCKETS,
+    'encode_seconds': CODEC_BUCKETS,
+    'decode_seconds': CODEC_BUCKETS,
+}
+
+
+class Histogram:
+    '''
+    Counts observations into buckets with fixed upper bounds, plus an
+    overflow bucket.
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+
+class Metrics:
+    '''
+    Counters and histograms kept by a transport.
+
+    Counters are keyed by name and an optional label, e.g. the kind of
+    message. Histograms, such as ack_latency_seconds, are keyed by name and
+    label as well. Everything is a no-op while enabled is False, and hot
+    paths also check enabled before taking timestamps.
+
+    Acknowledgement latency is tracked with expect() when a request that
+    will be acknowledged is sent, and acknowledged() when the response
+    arrives. The device answers in order, so the two are matched first in
+    first out.
+    '''
+    def __init__(self, transport, enabled=False):
+        self.transport = transport
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self._expected = {}
+
+    def count(self, name, label=None, amount=1):
+        if not self.enabled:
+            return
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, label=None):
+        if not self.enabled:
+            return
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(HISTOGRAMS[name])
+        histogram.observe(value)
+
+    def expect(self, kind):
+        if not self.enabled:
+            return
+        expected = self._expected.get(kind)
+        if expected is None:
+            expected = self._expected[kind] = deque()
+        expected.append(perf_counter())
+
+    def acknowledged(self, kind):
+        expected = self._expected.get(kind)
+        if expected:
+            self.observe('ack_latency_seconds', perf_counter() - expected.popleft(), kind)
+
+    def forget(self):
+        '''
+        Drops the requests waiting for acknowledgement, e.g. after a reset.
+        '''
+        self._expected.clear()
+
+    def reset(self):
+        self.counters.clear()
+        self.histograms.clear()
+        self._expected.clear()
+
+    def snapshot(self):
+        counters = {}
+        for (name, label), value in self.counters.items():
+            counters.setdefault(name, {})[label] = value
+        histograms = {}
+        for (name, label), histogram in self.histograms.items():
+            histograms.setdefault(name, {})[label] = histogram.snapshot()
+        return {'transport': self.transport, 'counters': counters, 'histograms': histograms}
+
+    def _labels(self, label, **extra):
+        labels = {'transport': self.transport}
+        if label is not None:
+            labels['kind'] = label
+        labels.update(extra)
+        return '{' + ','.join(f'{name}="{value}"' for name, value in labels.items()) + '}'
+
+    def prometheus(self):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        lines = []
+        for name in COUNTERS:
+            values = [(label, value) for (counter, label), value in self.counters.items()
+                      if counter == name]
+            if not values:
+                continue
+            lines.append(f'# TYPE argb_{name}_total counter')
+            for label, value in values:
+                lines.append(f'argb_{name}_total{self._labels(label)} {value}')
+        for name in HISTOGRAMS:
+            values = [(label, histogram) for (histogram_name, label), histogram
+                      in self.histograms.items() if histogram_name == name]
+            if not values:
+                continue
+            lines.append(f'# TYPE argb_{name} histogram')
+            for label, histogram in values:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'argb_{name}_bucket{self._labels(label, le=bound)} {cumulative}')
+                lines.append(f'argb_{name}_sum{self._labels(label)} {histogram.sum}')
+                lines.append(f'argb_{name}_count{self._labels(label)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        '''
+        Writes prometheus() to path, replacing it atomically so that a
+        collector never reads a partial file.
+        '''
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as file:
+            file.write(self.prometheus())
+        os.replace(temporary, path)
+
+    async def serve(self, path):
+        '''
+        Serves prometheus() to every client connecting to the Unix socket at
+        path. Returns the asyncio server.
+        '''
+        from asyncio import start_unix_server
+
+        async def respond(reader, writer):
+            writer.write(self.prometheus().encode())
+            await writer.drain()
+            writer.close()
+        return await start_unix_server(respond, path)
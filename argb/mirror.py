@@ -0,0 +1,140 @@
+from collections import deque
+
+
+class LightMirror:
+    '''
+    Mirrors the lights the device has acknowledged so that requests which
+    wouldn't change anything can be skipped.
+
+    A set_light is redundant when its fields match what was last sent for the
+    same light, and a commit is redundant when no set_light has been sent
+    since the previous commit. Passing force=True sends the request anyway.
+    '''
+    def __init__(self, enabled=True):
+        # Requests are never skipped while enabled is False.
+        self.enabled = enabled
+        # Fields of the last set_light the device acknowledged, by light id.
+        self.lights = {}
+        # Fields of the last set_light sent, acknowledged or not, by light id.
+        self.expected = {}
+        # set_light requests waiting for acknowledgement, in the order sent,
+        # as [fields, committed] pairs.
+        self.pending = deque()
+        # Whether an acknowledged set_light hasn't been committed yet.
+        self.staged = False
+        self.frame_sizes = {}
+        self.frames_saved = 0
+        self.bytes_saved = 0
+
+    def should_send(self, key, force=False):
+        '''
+        Returns False, and counts the saving, if the request identified by key
+        (see messages.request_key) is redundant.
+        '''
+        kind, fields = key
+        if force or not self.enabled:
+            return True
+        if kind == 'set_light':
+            if self.expected.get(fields[0]) != fields:
+                return True
+            self._skipped(fields[0])
+            return False
+        if kind == 'commit_transaction':
+            if self.staged or any(not committed for _, committed in self.pending):
+                return True
+            self._skipped(kind)
+            return False
+        return True
+
+    def _skipped(self, key):
+        self.frames_saved += 1
+        self.bytes_saved += self.frame_sizes.get(key, 0)
+
+    def sent(self, key, frame_size):
+        kind, fields = key
+        if kind == 'set_light':
+            self.expected[fields[0]] = fields
+            self.pending.append([fields, False])
+            self.frame_sizes[fields[0]] = frame_size
+        elif kind == 'commit_transaction':
+            self.staged = False
+            for entry in self.pending:
+                entry[1] = True
+            self.frame_sizes[kind] = frame_size
+
+    def acknowledged(self, is_error=False):
+        '''
+        Records the device's response to the oldest unacknowledged set_light.
+        '''
+        if not self.pending:
+            return
+        fields, committed = self.pending.popleft()
+        light = fields[0]
+        if is_error:
+            # Unless a later request for the light is in flight, fall back to
+            # what the device last accepted so the next request goes out.
+            if any(entry[0][0] == light for entry in self.pending):
+                return
+            if light in self.lights:
+                self.expected[light] = self.lights[light]
+            else:
+                self.expected.pop(light, None)
+            return
+        self.lights[light] = fields
+        if not committed:
+            self.staged = True
+
+    def invalidate(self):
+        '''
+        Forgets everything, e.g. after the device has reset.
+        '''
+        self.lights.clear()
+        self.expected.clear()
+        self.pending.clear()
+        self.staged = False
+
+    def statistics(self):
+        return {
+            'frames_saved': self.frames_saved,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+class Scene:
+    '''
+    Records the set_light requests written to the device, by light, and
+    which of them a commit has applied, so that what the device shows can
+    be restored after it resets.
+    '''
+    def __init__(self):
+        self.committed = {}
+        self.staged = {}
+        self.commits = 0
+
+    def sent(self, key):
+        kind, value = key
+        if kind == 'set_light':
+            self.staged[value[0]] = key
+        elif kind == 'commit_transaction':
+            self.committed.update(self.staged)
+            self.staged.clear()
+            self.commits += 1
+
+    def replay(self, staged=False):
+        '''
+        Returns the keys of the requests restoring the committed scene at
+        once, followed by the staged set_light requests if staged is True.
+        '''
+        keys = list(self.committed.values())
+        if keys:
+            keys.append(('commit_transaction', 0))
+        if staged:
+            keys.extend(self.staged.values())
+        return keys
+
+    def drop_staged(self):
+        self.staged.clear()
+
+    def clear(self):
+        self.committed.clear()
+        self.staged.clear()
@@ -0,0 +1,10 @@
+'''
+Settings shared by Supervisor and AsyncServer for restoring the output after
+the device is lost or resets, kept apart from both so that neither pulls in
+the other's transport. See supervisor for what the policies do.
+'''
+
+QUEUE = 'queue'
+DROP = 'drop'
+# The firmware sends the ready log three seconds after a reset.
+READY_TIMEOUT = 4.0
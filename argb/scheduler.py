@@ -0,0 +1,202 @@
+from asyncio import CancelledError, get_event_loop, sleep
+from math import floor, sqrt
+from .link import DEGRADED, RESYNCING
+from .log import get_logger, set_debug, DEBUG
+
+
+class AnimationScheduler:
+    '''
+    Runs effects at a fixed frame rate against the event loop's clock.
+
+    An effect is a callable taking the frame time in seconds since the start
+    and the frame index, and returning an iterable of set_light keyword
+    arguments (or None to leave the lights alone). Every frame, the output
+    of all effects is sent to a pipelined Device as one batch followed by a
+    commit. A frame whose deadline has passed by more than a period, or which
+    comes due while the previous frame is still waiting for room in the
+    device's window, is dropped rather than queued.
+
+    The update rate also adapts to the device's LinkBudget: after a frame of
+    n bytes, the next one is only sent once the link could have carried it
+    within the budget's target utilisation. Frames skipped this way are
+    counted as throttled; as effects compute each frame from scratch, the
+    next frame that goes out carries the latest state of every light.
+
+    It backs off on a bad link as well (see Device.link): while the link is
+    degraded the interval is multiplied by degraded_backoff, and while it
+    resyncs frames are skipped and counted as backed off.
+    '''
+    def __init__(self, device, rate=30, commit_delta=0, degraded_backoff=2.0):
+        self.device = device
+        self.rate = rate
+        self.commit_delta = commit_delta
+        self.degraded_backoff = degraded_backoff
+        self.effects = []
+        self.logger = get_logger('scheduler')
+        self._sending = None
+        self._task = None
+        self._not_before = 0.0
+        self.reset_statistics()
+
+    @property
+    def logging(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging.setter
+    def logging(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    def add_effect(self, effect):
+        self.effects.append(effect)
+
+    def remove_effect(self, effect):
+        self.effects.remove(effect)
+
+    @property
+    def period(self):
+        return 1 / self.rate
+
+    def reset_statistics(self):
+        self.frames = 0
+        self.dropped = 0
+        self.throttled = 0
+        self.backed_off = 0
+        self.errors = 0
+        self.started = None
+        self._lateness_sum = 0.0
+        self._lateness_squares = 0.0
+        self._lateness_max = 0.0
+
+    def _record_lateness(self, lateness):
+        self._lateness_sum += lateness
+        self._lateness_squares += lateness * lateness
+        self._lateness_max = max(self._lateness_max, lateness)
+
+    def statistics(self):
+        '''
+        Returns the achieved frame rate and the jitter, i.e. how late frames
+        started relative to their deadlines, in seconds.
+        '''
+        elapsed = get_event_loop().time() - self.started if self.started is not None else 0
+        mean = self._lateness_sum / self.frames if self.frames else 0.0
+        variance = self._lateness_squares / self.frames - mean * mean if self.frames else 0.0
+        return {
+            'frames': self.frames,
+            'dropped': self.dropped,
+            'throttled': self.throttled,
+            'backed_off': self.backed_off,
+            'errors': self.errors,
+            'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+            'jitter_mean': mean,
+            'jitter_std': sqrt(max(variance, 0.0)),
+            'jitter_max': self._lateness_max,
+            'utilisation': self.device.budget.utilisation(),
+            'link': self.device.link.health,
+        }
+
+    def _scene(self, frame_time, index):
+        scene = []
+        for effect in self.effects:
+            lights = effect(frame_time, index)
+            if lights is not None:
+                scene.extend(lights)
+        return scene
+
+    def _check_acknowledgement(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        response = None if error is not None else future.result()
+        if error is not None or (response is not None and response.log.is_error):
+            self.errors += 1
+            self.log('request failed: %s', error or response)
+
+    async def _send(self, scene):
+        device = self.device
+        sent = device.budget.bytes
+        try:
+            with device.batch():
+                futures = [await device.send_light(**light) for light in scene]
+                futures.append(await device.send_commit(self.commit_delta))
+        except CancelledError:
+            raise
+        except Exception:
+            self.errors += 1
+            self.logger.exception('sending a frame failed')
+            return
+        finally:
+            size = device.budget.bytes - sent
+            interval = device.budget.minimum_interval(size)
+            if device.link.state == DEGRADED:
+                interval *= self.degraded_backoff
+            self._not_before = get_event_loop().time() + interval
+        # Acknowledgements are checked as they arrive, without holding up
+        # the next frame.
+        for future in futures:
+            future.add_done_callback(self._check_acknowledgement)
+
+    async def run(self, frames=None):
+        '''
+        Runs until cancelled, or until frames frames have come due, and
+        returns the statistics.
+        '''
+        loop = get_event_loop()
+        self.started = start = loop.time()
+        index = 0
+        try:
+            while frames is None or index < frames:
+                period = self.period
+                deadline = start + index * period
+                delay = deadline - loop.time()
+                if delay > 0:
+                    await sleep(delay)
+                now = loop.time()
+                lateness = now - deadline
+                if lateness > period:
+                    # Skip to the next deadline instead of catching up.
+                    missed = floor(lateness / period)
+                    self.dropped += missed
+                    index += missed
+                    self.log('dropped %d frames', missed)
+                    continue
+                index += 1
+                if self._sending is not None and not self._sending.done():
+                    self.dropped += 1
+                    self.log('dropped frame, the previous frame is still being sent')
+                    continue
+                if now < self._not_before:
+                    self.throttled += 1
+                    continue
+                if self.device.link.health == RESYNCING:
+                    self.backed_off += 1
+                    continue
+                try:
+                    scene = self._scene(deadline - start, index - 1)
+                except Exception:
+                    # A failing effect costs the frame, not the animation.
+                    self.errors += 1
+                    self.logger.exception('an effect failed')
+                    continue
+                # Only frames which are sent count towards the jitter, which
+                # statistics() averages over self.frames.
+                self._record_lateness(lateness)
+                self.frames += 1
+                self._sending = loop.create_task(self._send(scene))
+            if self._sending is not None:
+                await self._sending
+        finally:
+            if self._sending is not None and not self._sending.done():
+                self._sending.cancel()
+        return self.statistics()
+
+    def start(self):
+        self._task = get_event_loop().create_task(self.run())
+        return self._task
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,194 @@
+from asyncio import Event as AsyncEvent, get_event_loop
+from threading import Thread, Event
+from time import monotonic
+from .log import get_logger, set_debug, DEBUG
+
+# Temperature sensors of common CPUs, in the order they are tried.
+DEFAULT_KEYS = ('k10temp', 'coretemp', 'cpu_thermal', 'acpitz')
+
+
+def read_temperatures():
+    from psutil import sensors_temperatures
+    return sensors_temperatures()
+
+
+def select_reading(readings, key):
+    '''
+    Returns the current value of the sensor identified by key in readings,
+    as returned by psutil.sensors_temperatures(), or None. A key is a chip
+    name, optionally followed by /label or :index to pick one of its
+    sensors; otherwise its first sensor is used.
+    '''
+    chip, label, index = key, None, 0
+    if '/' in key:
+        chip, label = key.split('/', 1)
+    elif ':' in key:
+        chip, index = key.split(':', 1)
+        index = int(index)
+    sensors = readings.get(chip)
+    if not sensors:
+        return None
+    if label is not None:
+        for sensor in sensors:
+            if sensor.label == label:
+                return sensor.current
+        return None
+    if index >= len(sensors):
+        return None
+    return sensors[index].current
+
+
+class SensorSampler:
+    '''
+    Polls a sensor on a worker thread, so that slow reads (psutil reads
+    every hwmon file in sysfs) never block the event loop.
+
+    Every interval seconds the first of keys found in read() is sampled and
+    smoothed with an exponential moving average (alpha is the weight of the
+    new sample). mapping turns the smoothed value, and the minimum and
+    maximum smoothed values seen so far, into a tuple such as a colour.
+    Waiters are only woken when a channel of the mapped tuple moves by more
+    than threshold from what they were last woken with.
+    '''
+    def __init__(self, keys=DEFAULT_KEYS, interval=1.0, alpha=0.3, threshold=0, mapping=None,
+                 read=read_temperatures):
+        if isinstance(keys, str):
+            keys = (keys,)
+        self.keys = tuple(keys)
+        self.interval = interval
+        self.alpha = alpha
+        self.threshold = threshold
+        self.mapping = mapping or (lambda value, minimum, maximum: (value,))
+        self.read = read
+        self.logger = get_logger('sensors')
+        self.key = None
+        self.current = None
+        self.value = None
+        self.minimum = None
+        self.maximum = None
+        self.mapped = None
+        self.samples = 0
+        self.wakeups = 0
+        self.errors = 0
+        self.read_time = 0.0
+        self._published = None
+        self._latest = (None, None, None, None)
+        self._loop = None
+        self._changed = None
+        self._thread = None
+        self._stopped = Event()
+
+    @property
+    def logging(self):
+        return self.logger.isEnabledFor(DEBUG)
+
+    @logging.setter
+    def logging(self, enabled):
+        set_debug(self.logger, enabled)
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        self.stop()
+
+    def start(self, loop=None):
+        self._loop = loop or get_event_loop()
+        self._changed = AsyncEvent()
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='argb-sensors', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stopped.is_set():
+            started = monotonic()
+            try:
+                self.sample()
+            except Exception:
+                self.errors += 1
+                # A missing sensor fails the same way every interval.
+                if self.errors == 1:
+                    self.logger.exception('sampling failed')
+                else:
+                    self.log('sampling failed (%d times)', self.errors)
+            self._stopped.wait(max(self.interval - (monotonic() - started), 0))
+
+    def _find(self, readings):
+        # Stick to the first key found, so a sensor that drops out isn't
+        # silently replaced by another one.
+        if self.key is not None:
+            return select_reading(readings, self.key)
+        for key in self.keys:
+            value = select_reading(readings, key)
+            if value is not None:
+                self.key = key
+                self.log('using %s', key)
+                return value
+        return None
+
+    def sample(self):
+        '''
+        Takes one sample. Called from the worker thread.
+        '''
+        started = monotonic()
+        readings = self.read()
+        self.read_time = monotonic() - started
+        current = self._find(readings)
+        if current is None:
+            raise LookupError(f'none of the sensors {", ".join(self.keys)} were found')
+        self.samples += 1
+        self.current = current
+        if self.value is None:
+            self.value = current
+        else:
+            self.value += self.alpha * (current - self.value)
+        if self.minimum is None or self.value < self.minimum:
+            self.minimum = self.value
+        if self.maximum is None or self.value > self.maximum:
+            self.maximum = self.value
+        self.mapped = tuple(self.mapping(self.value, self.minimum, self.maximum))
+        # Replaced in one assignment so the loop never sees a partial update.
+        self._latest = (self.value, self.minimum, self.maximum, self.mapped)
+        if self._should_wake(self.mapped):
+            self._published = self.mapped
+            self.wakeups += 1
+            self._loop.call_soon_threadsafe(self._changed.set)
+
+    def _should_wake(self, mapped):
+        if self._published is None or len(mapped) != len(self._published):
+            return True
+        return any(abs(a - b) > self.threshold for a, b in zip(mapped, self._published))
+
+    def latest(self):
+        '''
+        Returns (smoothed value, minimum, maximum, mapped value).
+        '''
+        return self._latest
+
+    async def changed(self):
+        '''
+        Waits until the mapped value has changed by more than the threshold
+        and returns latest().
+        '''
+        await self._changed.wait()
+        self._changed.clear()
+        return self.latest()
+
+    def statistics(self):
+        return {
+            'key': self.key,
+            'samples': self.samples,
+            'wakeups': self.wakeups,
+            'errors': self.errors,
+            'read_time': self.read_time,
+        }
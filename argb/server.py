@@ -1,9 +1,7 @@
-from time import sleep
 from traceback import format_exc
 
 from .coms import Connection
-from .messages import Request, DebugMessage
-from .messages import set_light as build_set_light
+from .messages import set_light as build_set_light, build_request, commit_key
 
 class Server:
     def __init__(self, device, delegate):
@@ -15,30 +13,30 @@ class Server:
         self.connection.sendMessage(request)
 
     def commit(self, delta):
-        request = Request()
-        message = request.commit_transaction
-        message.timestamp = delta
-        self.connection.sendMessage(request)
+        self.connection.sendMessage(build_request(commit_key(delta)))
 
     def send_request(self, msg):
         self.connection.sendMessage(msg)
 
-    def receiveMessage(self):
-        if self.connection.serialPort.in_waiting != 0:
-            return self.connection.receiveMessage()
-        else:
-            return None
+    def receiveMessage(self, timeout=None):
+        return self.connection.receiveMessage(timeout)
 
     def main(self):
         with self.connection:
             self.connection.ignore_until_next_message()
             while True:
                 try:
-                    msg = self.receiveMessage()
-                    if msg is None:
-                        sleep(0.3)
+                    result = self.connection.receive_payload()
+                    if result is None:
+                        continue
+                    kind, msg = result
+                    if kind == 'debug':
+                        print(f'server debug: {msg}')
+                        continue
+                    if kind == 'error':
+                        print(f'server error: {msg}')
                         continue
-                    if msg.HasField('log') and msg.log.id == 9:
+                    if kind == 'log' and msg.log.id == 9:
                         self.delegate.ready(self)
                         continue
                     should_stop = self.delegate.process(self, msg)
@@ -1,3 +1,4 @@
+from array import array
 from dataclasses import dataclass, asdict
 
 @dataclass
@@ -72,3 +73,118 @@ class StackMeasurement:
     def todict(self):
         return asdict(self)
 
+
+# (column, StackMeasurement field) in the order of the StackMeasurement
+# dataclass. Each field packs a start and an end value.
+FIELDS = (
+    ('data', 'data'),
+    ('bss', 'bss'),
+    ('heap', 'heap'),
+    ('gap', 'heap_gap'),
+    ('stack', 'stack'),
+)
+COLUMNS = tuple(f'{name}.{part}' for name, _ in FIELDS for part in ('start', 'end'))
+# (name, StackStatistics attribute) of the statistics in a summary.
+STATISTICS = (('min', 'minimum'), ('mode', 'mode'), ('max', 'maximum'))
+
+
+class StackStatistics:
+    '''
+    Running minimum, maximum and mode of the columns of the measurements
+    with one id. The mode is tracked incrementally from a count of every
+    value seen, and ties go to the value that reached the count first.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.minimum = array('H', [0xffff] * len(COLUMNS))
+        self.maximum = array('H', [0] * len(COLUMNS))
+        self.mode = array('H', [0] * len(COLUMNS))
+        self.mode_count = array('Q', [0] * len(COLUMNS))
+        # The values are mostly constant, so a dict per column stays small.
+        self.histograms = [{} for _ in COLUMNS]
+
+    def add(self, values):
+        self.count += 1
+        minimum = self.minimum
+        maximum = self.maximum
+        mode = self.mode
+        mode_count = self.mode_count
+        for column, value in enumerate(values):
+            if value < minimum[column]:
+                minimum[column] = value
+            if value > maximum[column]:
+                maximum[column] = value
+            histogram = self.histograms[column]
+            count = histogram.get(value, 0) + 1
+            histogram[value] = count
+            if count > mode_count[column]:
+                mode_count[column] = count
+                mode[column] = value
+
+
+class StackAggregator:
+    '''
+    Aggregates stack measurements by id as they arrive, in memory that
+    doesn't grow with the number of measurements.
+    '''
+    def __init__(self):
+        self.statistics = {}
+        self.count = 0
+
+    def add(self, msg):
+        '''
+        Adds a StackMeasurement message, i.e. response.stack_measurement.
+        '''
+        values = []
+        for _, field in FIELDS:
+            value = getattr(msg, field)
+            values.append((value >> 16) & 0xFFFF)
+            values.append(value & 0xFFFF)
+        statistics = self.statistics.get(msg.id)
+        if statistics is None:
+            statistics = self.statistics[msg.id] = StackStatistics()
+        statistics.add(values)
+        self.count += 1
+
+    def add_response(self, response):
+        self.add(response.stack_measurement)
+
+    def reset(self):
+        self.statistics.clear()
+        self.count = 0
+
+    def summary(self):
+        '''
+        Returns {id: {column: {'min': ..., 'mode': ..., 'max': ...}}}.
+        '''
+        return {
+            id: {
+                column: {name: getattr(statistics, attribute)[index] for name, attribute in STATISTICS}
+                for index, column in enumerate(COLUMNS)
+            }
+            for id, statistics in sorted(self.statistics.items())
+        }
+
+    def format(self):
+        '''
+        Returns the summary as a table with a column per id.
+        '''
+        ids = sorted(self.statistics)
+        lines = [f'{"":>18}' + ''.join(f'{id:>8}' for id in ids)]
+        for index, column in enumerate(COLUMNS):
+            for name, attribute in STATISTICS:
+                values = (getattr(self.statistics[id], attribute)[index] for id in ids)
+                lines.append(f'{column:>12} {name:>5}' + ''.join(f'{value:>8}' for value in values))
+        return '\n'.join(lines)
+
+    def to_dataframe(self):
+        '''
+        Returns the summary as a pandas DataFrame, indexed by column and
+        statistic with a column per id. Requires pandas.
+        '''
+        import pandas as pd
+        return pd.DataFrame({
+            id: {(column, name): value for column, values in columns.items()
+                 for name, value in values.items()}
+            for id, columns in self.summary().items()
+        })
@@ -1,61 +1,165 @@
-from pycrc.algorithms import Crc
+from time import perf_counter
 from cobs.cobs import encode, decode
-from messages_pb2 import Request, Response, DebugMessage
+from .crc import make_crc, DEFAULT_ENGINE
+from .wire import encode_request, decode_response, decode_debug_message, default_codec
+from .messages import build_request, protobuf
+from .metrics import Metrics
+from .log import get_logger, limited, hexdump
+from .link import OK, CRC, COBS, DECODE
+
+# DebugMessage starts with its id varint (field 1) while every Response
+# payload is a length delimited field, so the first tag identifies the type.
+DEBUG_MESSAGE_TAG = (1 << 3) | 0
+
+def decode_payload(data, codec='protobuf'):
+    '''
+    Decodes a payload sent by the device in a single pass. Returns (kind,
+    message), where kind is the name of the Response payload (None if it is
+    empty) and message the Response, 'debug' and the DebugMessage, or
+    'error' and the exception raised while decoding.
+    '''
+    try:
+        if data and data[0] == DEBUG_MESSAGE_TAG:
+            if codec == 'wire':
+                return ('debug', decode_debug_message(data))
+            return ('debug', protobuf().DebugMessage.FromString(data))
+        if codec == 'wire':
+            message = decode_response(data)
+        else:
+            message = protobuf().Response.FromString(data)
+        return (message.WhichOneof('payload'), message)
+    except Exception as error:
+        return ('error', error)
+
+
+class Dispatcher:
+    '''
+    Calls the handler registered for the kind of each decoded message (see
+    decode_payload), or the default handler if there isn't one.
+    '''
+    def __init__(self, default=None):
+        self.handlers = {}
+        self.default = default
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def dispatch(self, kind, message):
+        handler = self.handlers.get(kind, self.default)
+        if handler is not None:
+            return handler(message)
+
 
 class PacketProcessor:
-    def __init__(self):
-        self.crc = Crc(
-            width=32,
-            poly=0x04c11db7,
-            reflect_in=True,
-            xor_in=0xffffffff,
-            xor_out=0xffffffff,
-            reflect_out=True
-        )
+    def __init__(self, crc=DEFAULT_ENGINE, codec=None, metrics=None, logger=None, link=None):
+        self.crc = make_crc(crc)
+        # 'wire' or 'protobuf', see wire.default_codec.
+        self.codec = codec or default_codec()
+        self.metrics = metrics if metrics is not None else Metrics('packet')
+        self.logger = logger if logger is not None else get_logger('packet')
+        # A LinkQuality the outcome of every frame is recorded in, if set.
+        self.link = link
+        self._payload = bytearray()
 
     def process(self, data):
+        metrics = self.metrics
+        link = self.link
         try:
-            msg = decode(data)
+            # cobs only accepts bytes-like objects without a format, so
+            # memoryview frames are copied here.
+            msg = decode(bytes(data))
         except Exception as error:
-            print(f'{error}: {data}')
+            metrics.count('cobs_failures')
+            if link is not None:
+                link.record(COBS)
+            limited(self.logger, 'cobs', '%s: %s', error, hexdump(data))
             return None
         protobuf_payload, crc = msg[:-4], msg[-4:]
         if not self._check_crc(protobuf_payload, crc):
+            metrics.count('crc_failures')
+            if link is not None:
+                link.record(CRC)
             return None
-        return self._decode_protobuf(protobuf_payload)
+        if not metrics.enabled:
+            result = self._decode_protobuf(protobuf_payload)
+        else:
+            start = perf_counter()
+            result = self._decode_protobuf(protobuf_payload)
+            metrics.observe('decode_seconds', perf_counter() - start)
+            if result[0] == 'error':
+                metrics.count('decode_failures')
+            else:
+                metrics.count('messages_in', result[0])
+        if link is not None:
+            link.record(DECODE if result[0] == 'error' else OK)
+        return result
 
-    def _decode_protobuf(self, data):
+    def process_request(self, data):
+        '''
+        Decodes a frame sent to the device, where process() decodes frames
+        sent by it. Returns (kind, message), where kind is the name of the
+        Request payload, 'debug' and a DebugMessage, or 'error' and the
+        exception raised while decoding; or None if the frame fails COBS
+        decoding or the CRC check.
+        '''
         try:
-            message = Response()
-            message.ParseFromString(data)
-            return ('Response', message)
-        except Exception as e:
-            error = e
+            msg = decode(bytes(data))
+        except Exception:
+            return None
+        payload = msg[:-4]
+        if len(msg) <= 4 or self.crc.digest(payload) != msg[-4:]:
+            return None
         try:
-            message = DebugMessage()
-            message.ParseFromString(data)
-            return ('DebugMessage', message)
-        except:
-            pass
+            if payload[0] == DEBUG_MESSAGE_TAG:
+                return ('debug', protobuf().DebugMessage.FromString(payload))
+            request = protobuf().Request.FromString(payload)
+        except Exception as error:
+            return ('error', error)
+        return (request.WhichOneof('payload'), request)
 
-        return ('error', error)
+    def _decode_protobuf(self, data):
+        return decode_payload(data, self.codec)
 
     def _check_crc(self, msg, received_crc):
-        crc = self.crc.bit_by_bit(msg)
-        crc = bytes([
-            (crc & 0x000000FF) >> 0*8,
-            (crc & 0x0000FF00) >> 1*8,
-            (crc & 0x00FF0000) >> 2*8,
-            (crc & 0xFF000000) >> 3*8,
-        ])
+        crc = self.crc.digest(msg)
         result = received_crc == crc
         if not result:
-            print(f'warning: received crc: {received_crc.hex("-")}, expected crc: {crc.hex("-")}')
+            limited(self.logger, 'crc', 'received crc: %s, expected crc: %s',
+                                hexdump(received_crc), hexdump(crc))
         return result
 
     def encode(self, msg):
-        message = msg.SerializeToString()
-        checksum = self.crc.bit_by_bit(message).to_bytes(4, byteorder='little')
+        return self.encode_payload(msg.SerializeToString())
+
+    def encode_frame(self, msg):
+        '''
+        Returns the encoded message followed by the frame delimiter.
+        '''
+        return self.encode(msg) + b'\x00'
+
+    def encode_key(self, key):
+        '''
+        Returns the frame, with its delimiter, for the request identified by
+        key (see messages.request_key) without building a protobuf message.
+        '''
+        if self.metrics.enabled:
+            start = perf_counter()
+            frame = self._encode_key(key)
+            self.metrics.observe('encode_seconds', perf_counter() - start)
+            return frame
+        return self._encode_key(key)
+
+    def _encode_key(self, key):
+        if self.codec == 'wire':
+            payload = encode_request(key, self._payload)
+        else:
+            payload = self._payload
+            payload[:] = build_request(key).SerializeToString()
+        payload.extend(self.crc.digest(payload))
+        return encode(payload) + b'\x00'
+
+    def encode_payload(self, message):
+        checksum = self.crc.digest(message)
         data = bytearray(message)
         data.extend(checksum)
         return encode(data)
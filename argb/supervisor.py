@@ -0,0 +1,280 @@
+'''
+A Device which survives the port dropping out and the firmware resetting.
+
+Supervisor keeps a pipelined Device open. When the port drops, e.g. on a
+USB hiccup, it reopens it with exponential backoff, waits for the ready log
+and then replays the last committed scene (see mirror.Scene): every light's
+last set_light followed by a commit, written as one batch. A ready log
+without the port dropping, i.e. a reset of the firmware alone, is answered
+with the same replay.
+
+The futures send() returns belong to the Supervisor rather than the
+Device, so they don't fail when the device goes. Requests made while the
+device is gone, and requests which were in flight when it went, are handled
+according to policy:
+
+- QUEUE: new requests wait until the scene has been restored and are then
+  sent in order, and set_light requests which hadn't been committed yet are
+  sent again after the replay. Requests which were in flight are answered
+  by the replay's acknowledgements, or sent again after it if the replay
+  doesn't include them.
+- DROP: new requests are dropped, returning None, and uncommitted set_light
+  requests are forgotten; only the committed scene is restored. Requests
+  which were in flight resolve to None.
+
+The time from losing the device to the replay being acknowledged is
+recorded as the time to restored output.
+'''
+from asyncio import CancelledError, Event, get_event_loop, sleep, wait_for
+from collections import deque
+from time import monotonic
+from .Device import Device
+from .messages import set_light_key, commit_key, request_key
+from .mirror import Scene
+from .log import get_logger
+from .recovery import QUEUE, DROP, READY_TIMEOUT
+
+
+class Supervisor:
+    def __init__(self, port, delegate=None, window=4, policy=QUEUE, backoff=0.05, max_backoff=2.0,
+                 ready_timeout=READY_TIMEOUT, **kwargs):
+        if policy not in (QUEUE, DROP):
+            raise ValueError(f'unknown policy: {policy}')
+        self.port = port
+        self.delegate = delegate
+        self.window = window
+        self.policy = policy
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.ready_timeout = ready_timeout
+        self.kwargs = kwargs
+        self.logger = get_logger('supervisor')
+        self.device = None
+        self.scene = Scene()
+        self.connected = Event()
+        # (key, future) of the requests in flight when the device went,
+        # under QUEUE.
+        self._orphans = []
+        self._task = None
+        self._closing = False
+        self._outage_started = None
+        self.outages = 0
+        self.resets = 0
+        self.attempts = 0
+        self.dropped = 0
+        # Seconds from losing the device to the output being restored, of
+        # the most recent outages.
+        self.restore_times = deque(maxlen=100)
+
+    def _make_device(self):
+        device = Device(self.port, self.delegate, window=self.window,
+                        ready_timeout=self.ready_timeout, **self.kwargs)
+        # The scene outlives the connection it was sent over.
+        device.scene = self.scene
+        device.ready_listeners.append(self._device_reset)
+        return device
+
+    async def __aenter__(self):
+        self.device = self._make_device()
+        await self.device.__aenter__()
+        self.connected.set()
+        self._task = get_event_loop().create_task(self._supervise())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+        if self.device is not None:
+            await self._close_device()
+        orphans, self._orphans = self._orphans, []
+        for _, future in orphans:
+            if not future.done():
+                future.set_exception(ConnectionAbortedError('supervisor closed'))
+
+    async def _close_device(self):
+        device, self.device = self.device, None
+        try:
+            await device.__aexit__(None, None, None)
+        except Exception:
+            pass
+        if device.writer is not None:
+            device.writer.close()
+
+    async def _supervise(self):
+        while True:
+            try:
+                # The reader only stops when reading fails.
+                await self.device.wait_lost()
+            except CancelledError:
+                raise
+            except Exception as error:
+                self.logger.warning('lost %s: %s', self.port, error)
+            self.connected.clear()
+            self.outages += 1
+            self._outage_started = monotonic()
+            await self._close_device()
+            await self._reconnect()
+            await self._restore()
+
+    async def _reconnect(self):
+        delay = self.backoff
+        while True:
+            # A port which just dropped is rarely back straight away.
+            await sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+            self.attempts += 1
+            device = self._make_device()
+            try:
+                await device.__aenter__()
+            except (OSError, EOFError) as error:
+                self.log('reconnecting failed: %s', error)
+                if device.writer is not None:
+                    device.writer.close()
+                continue
+            self.device = device
+            self.logger.info('reconnected to %s', self.port)
+            return
+
+    def _device_reset(self, device):
+        # The firmware reset without the port dropping.
+        self.resets += 1
+        self.connected.clear()
+        self._outage_started = monotonic()
+        get_event_loop().create_task(self._restore())
+
+    async def _restore(self):
+        if self.policy == DROP:
+            self.scene.drop_staged()
+        device = self.device
+        while True:
+            keys = self.scene.replay(staged=self.policy == QUEUE)
+            orphans, self._orphans = self._orphans, []
+            try:
+                with device.batch():
+                    futures = {}
+                    for key in keys:
+                        futures[key] = await device.send_key(key, force=True)
+                    for key, caller in orphans:
+                        if caller.done():
+                            continue
+                        future = futures.get(key)
+                        if future is None:
+                            future = await device.send_key(key, force=True)
+                        self._track(device, key, caller, future)
+                for future in futures.values():
+                    await future
+                break
+            except (ConnectionError, OSError) as error:
+                self.log('replay failed: %s', error)
+                if device is not self.device or device.lost:
+                    # Lost again; the supervisor will notice.
+                    return
+                # The link resynced; the replay is sent again.
+        elapsed = monotonic() - self._outage_started
+        self.restore_times.append(elapsed)
+        self._outage_started = None
+        self.logger.info('output restored in %.3f s, %d requests replayed', elapsed, len(keys))
+        self.connected.set()
+
+    def log(self, msg, *args):
+        self.logger.debug(msg, *args)
+
+    # The pipelined API of Device.
+
+    @property
+    def budget(self):
+        return self.device.budget
+
+    @property
+    def link(self):
+        return self.device.link
+
+    def batch(self):
+        return self.device.batch()
+
+    async def send_key(self, key, force=False):
+        while True:
+            if not self.connected.is_set():
+                if self.policy == DROP:
+                    self.dropped += 1
+                    future = get_event_loop().create_future()
+                    future.set_result(None)
+                    return future
+                await self.connected.wait()
+            device = self.device
+            try:
+                future = await device.send_key(key, force)
+            except (ConnectionError, OSError):
+                # The device went away while the request was being written.
+                if self.connected.is_set():
+                    raise
+                continue
+            caller = get_event_loop().create_future()
+            self._track(device, key, caller, future)
+            return caller
+
+    def _track(self, device, key, caller, future):
+        future.add_done_callback(lambda _: self._forward(device, key, caller, future))
+
+    def _forward(self, device, key, caller, future):
+        # Resolves the future handed to the caller from the device's.
+        if caller.done():
+            return
+        if future.cancelled():
+            caller.cancel()
+            return
+        error = future.exception()
+        if error is None:
+            caller.set_result(future.result())
+        elif device is self.device and self.connected.is_set() and not device.lost:
+            # Failed without the device going, e.g. on a link resync.
+            caller.set_exception(error)
+        elif self.policy == DROP:
+            self.dropped += 1
+            caller.set_result(None)
+        else:
+            self._orphans.append((key, caller))
+
+    async def send(self, message, force=False):
+        return await self.send_key(request_key(message), force)
+
+    async def send_light(self, *args, force=False, **kwargs):
+        return await self.send_key(set_light_key(*args, **kwargs), force=force)
+
+    async def send_commit(self, delta, force=False):
+        return await self.send_key(commit_key(delta), force=force)
+
+    async def set_light(self, *args, force=False, **kwargs):
+        return await (await self.send_light(*args, force=force, **kwargs))
+
+    async def commit(self, delta, force=False):
+        return await (await self.send_commit(delta, force=force))
+
+    async def flush(self):
+        return await self.device.flush()
+
+    async def wait_restored(self, timeout=None):
+        '''
+        Waits until the device is connected and its output restored.
+        '''
+        await wait_for(self.connected.wait(), timeout)
+
+    def statistics(self):
+        times = list(self.restore_times)
+        return {
+            'connected': self.connected.is_set(),
+            'outages': self.outages,
+            'resets': self.resets,
+            'attempts': self.attempts,
+            'dropped': self.dropped,
+            'restored': len(times),
+            'restore_time_last': times[-1] if times else None,
+            'restore_time_mean': sum(times) / len(times) if times else None,
+            'restore_time_max': max(times) if times else None,
+        }
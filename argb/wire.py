@@ -0,0 +1,333 @@
+'''
+Direct encoding and decoding of the messages in messages.proto.
+
+The schema only uses varint and length delimited fields, so requests can be
+written straight from a request key (see messages.request_key) without
+building protobuf objects, and responses can be read without the protobuf
+runtime. messages_pb2 remains the reference implementation.
+
+The protobuf runtime's native backends (upb, cpp) are faster than this
+module; it only pays off when protobuf runs as pure python, which is what
+default_codec() checks for.
+'''
+
+INT32_MIN = -(1 << 31)
+INT32_MAX = (1 << 31) - 1
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# Outer tags of the Request payload.
+SET_LIGHT_TAG = (1 << 3) | LENGTH_DELIMITED
+CURRENT_TIME_REQUEST_TAG = (2 << 3) | VARINT
+COMMIT_TRANSACTION_TAG = (3 << 3) | LENGTH_DELIMITED
+
+# SetLight fields are all varints numbered 1 to 7 in the order of the request
+# key. ahds is the only int64 field.
+SET_LIGHT_FIELDS = (
+    ((1 << 3) | VARINT, INT32_MIN, INT32_MAX),
+    ((2 << 3) | VARINT, INT32_MIN, INT32_MAX),
+    ((3 << 3) | VARINT, INT32_MIN, INT32_MAX),
+    ((4 << 3) | VARINT, INT32_MIN, INT32_MAX),
+    ((5 << 3) | VARINT, INT64_MIN, INT64_MAX),
+    ((6 << 3) | VARINT, INT32_MIN, INT32_MAX),
+    ((7 << 3) | VARINT, INT32_MIN, INT32_MAX),
+)
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def default_codec():
+    '''
+    Returns 'wire' if protobuf is running as pure python, otherwise
+    'protobuf'.
+    '''
+    try:
+        from google.protobuf.internal import api_implementation
+    except ImportError:
+        return 'wire'
+    return 'wire' if api_implementation.Type() == 'python' else 'protobuf'
+
+
+def write_varint(out, value):
+    if value < 0:
+        # Negative integers are sign extended to 64 bits.
+        value += 1 << 64
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _check_range(value, minimum, maximum):
+    if not minimum <= value <= maximum:
+        raise ValueError(f'value out of range: {value}')
+
+
+def _write_set_light(out, fields):
+    out.append(SET_LIGHT_TAG)
+    # Submessages are at most 7 * 10 bytes long, so the length is one byte.
+    length_index = len(out)
+    out.append(0)
+    for (field_tag, minimum, maximum), value in zip(SET_LIGHT_FIELDS, fields):
+        _check_range(value, minimum, maximum)
+        out.append(field_tag)
+        write_varint(out, value)
+    out[length_index] = len(out) - length_index - 1
+
+
+def encode_request(key, out=None):
+    '''
+    Serializes the request identified by key into out, which is cleared
+    first, and returns it. Produces the same bytes as
+    build_request(key).SerializeToString().
+    '''
+    if out is None:
+        out = bytearray()
+    else:
+        del out[:]
+    kind, value = key
+    if kind == 'set_light':
+        _write_set_light(out, value)
+    elif kind == 'commit_transaction':
+        _check_range(value, INT64_MIN, INT64_MAX)
+        out.append(COMMIT_TRANSACTION_TAG)
+        length_index = len(out)
+        out.append(0)
+        out.append((1 << 3) | VARINT)
+        write_varint(out, value)
+        out[length_index] = len(out) - length_index - 1
+    elif kind == 'current_time_request':
+        out.append(CURRENT_TIME_REQUEST_TAG)
+        out.append(1 if value else 0)
+    else:
+        raise ValueError(f'unknown request: {kind}')
+    return out
+
+
+def read_varint(data, position):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            byte = data[position]
+        except IndexError:
+            raise DecodeError('truncated varint') from None
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+        if shift >= 70:
+            raise DecodeError('varint too long')
+
+
+def _signed(value):
+    value &= (1 << 64) - 1
+    if value >= 1 << 63:
+        value -= 1 << 64
+    return value
+
+
+def _int32(value):
+    value = _signed(value)
+    # Like protobuf, truncate rather than reject out of range int32 values.
+    value &= 0xffffffff
+    if value > INT32_MAX:
+        value -= 1 << 32
+    return value
+
+
+def read_fields(data, start=0, end=None):
+    '''
+    Returns a dict of field number to value. Varints are returned as
+    unsigned integers and length delimited fields as (start, end) offsets
+    into data. Later occurrences of a field replace earlier ones.
+    '''
+    if end is None:
+        end = len(data)
+    fields = {}
+    position = start
+    while position < end:
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 0x7
+        if number == 0:
+            raise DecodeError('invalid field number')
+        if wire_type == VARINT:
+            fields[number], position = read_varint(data, position)
+        elif wire_type == LENGTH_DELIMITED:
+            length, position = read_varint(data, position)
+            if position + length > end:
+                raise DecodeError('truncated field')
+            fields[number] = (position, position + length)
+            position += length
+        elif wire_type == FIXED64:
+            position += 8
+        elif wire_type == FIXED32:
+            position += 4
+        else:
+            raise DecodeError(f'unsupported wire type: {wire_type}')
+    if position != end:
+        raise DecodeError('truncated message')
+    return fields
+
+
+def _require(fields, numbers, name):
+    for number in numbers:
+        if number not in fields:
+            raise DecodeError(f'{name} is missing required field {number}')
+
+
+def _require_varints(fields, numbers, name):
+    _require(fields, numbers, name)
+    for number in numbers:
+        if isinstance(fields[number], tuple):
+            raise DecodeError(f'{name} field {number} has the wrong wire type')
+
+
+class WireMessage:
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+
+class WireLog(WireMessage):
+    __slots__ = ('id', 'is_error')
+
+    def __init__(self, id, is_error):
+        self.id = id
+        self.is_error = is_error
+
+
+class WireCurrentTime(WireMessage):
+    __slots__ = ('timestamp',)
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+
+
+class WireStackMeasurement(WireMessage):
+    __slots__ = ('id', 'data', 'bss', 'heap', 'heap_gap', 'stack')
+
+    def __init__(self, id, data, bss, heap, heap_gap, stack):
+        self.id = id
+        self.data = data
+        self.bss = bss
+        self.heap = heap
+        self.heap_gap = heap_gap
+        self.stack = stack
+
+
+class WireResponse(WireMessage):
+    '''
+    A decoded Response. Like the protobuf message, the payload is accessed
+    through the current_time, log and stack_measurement attributes, and
+    HasField and WhichOneof report which one is set.
+    '''
+    __slots__ = ('payload', 'value')
+
+    def __init__(self, payload=None, value=None):
+        self.payload = payload
+        self.value = value
+
+    def WhichOneof(self, name):
+        return self.payload
+
+    def HasField(self, name):
+        return self.payload == name
+
+    def _get(self, name):
+        if self.payload != name:
+            raise AttributeError(f'{name} is not set')
+        return self.value
+
+    @property
+    def current_time(self):
+        return self._get('current_time')
+
+    @property
+    def log(self):
+        return self._get('log')
+
+    @property
+    def stack_measurement(self):
+        return self._get('stack_measurement')
+
+
+class WireDebugMessage(WireMessage):
+    __slots__ = ('id', 'description')
+
+    def __init__(self, id, description):
+        self.id = id
+        self.description = description
+
+
+def _decode_current_time(data, start, end):
+    fields = read_fields(data, start, end)
+    _require_varints(fields, (1,), 'CurrentTime')
+    return WireCurrentTime(_signed(fields[1]))
+
+
+def _decode_log(data, start, end):
+    fields = read_fields(data, start, end)
+    _require_varints(fields, (1, 2), 'Log')
+    return WireLog(_int32(fields[1]), fields[2] != 0)
+
+
+def _decode_stack_measurement(data, start, end):
+    fields = read_fields(data, start, end)
+    _require_varints(fields, (1, 2, 3, 4, 5, 6), 'StackMeasurement')
+    return WireStackMeasurement(*(_int32(fields[number]) for number in range(1, 7)))
+
+
+RESPONSE_PAYLOADS = {
+    1: ('current_time', _decode_current_time),
+    2: ('log', _decode_log),
+    3: ('stack_measurement', _decode_stack_measurement),
+}
+
+
+def decode_response(data):
+    fields = read_fields(data)
+    response = WireResponse()
+    # The oneof keeps the payload which appears last.
+    last = None
+    position = 0
+    for number, value in fields.items():
+        if number not in RESPONSE_PAYLOADS:
+            continue
+        if not isinstance(value, tuple):
+            raise DecodeError(f'Response field {number} has the wrong wire type')
+        if last is None or value[0] > position:
+            last, position = number, value[0]
+    if last is not None:
+        name, decode = RESPONSE_PAYLOADS[last]
+        start, end = fields[last]
+        response.payload = name
+        response.value = decode(data, start, end)
+    return response
+
+
+def decode_debug_message(data):
+    fields = read_fields(data)
+    _require(fields, (1, 2), 'DebugMessage')
+    if isinstance(fields[1], tuple) or not isinstance(fields[2], tuple):
+        raise DecodeError('DebugMessage field has the wrong wire type')
+    start, end = fields[2]
+    try:
+        description = bytes(data[start:end]).decode('utf-8')
+    except UnicodeDecodeError as error:
+        raise DecodeError(str(error)) from None
+    return WireDebugMessage(_int32(fields[1]), description)
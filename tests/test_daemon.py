@@ -0,0 +1,48 @@
+from argb.daemon import Client, Daemon
+from argb.messages import Response
+from argb.stream import PacketProcessor
+
+TIME_REQUEST = ('current_time_request', True)
+
+
+class Writer:
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(bytes(data))
+
+
+class Protocol:
+    frame = None
+
+    def __init__(self):
+        self.sent = []
+
+    def send_key(self, key, force=False):
+        self.sent.append(key)
+
+
+def current_time(packet, timestamp):
+    response = Response()
+    response.current_time.timestamp = timestamp
+    return packet.encode(response)
+
+
+def test_current_time_response_of_a_disconnected_client_is_dropped():
+    daemon = Daemon('unused', 'unused')
+    daemon.protocol = protocol = Protocol()
+    packet = PacketProcessor()
+    request = packet.encode_key(TIME_REQUEST)[:-1]
+    clients = [Client(id, None, Writer()) for id in range(3)]
+    for client in clients:
+        daemon._request(client, request)
+    assert protocol.sent == [TIME_REQUEST] * 3
+    # The first client goes while its request is pending.
+    daemon._disconnected(clients[0])
+    for timestamp in (1, 2, 3):
+        protocol.frame = current_time(packet, timestamp)
+        daemon.process(protocol, Response(current_time={'timestamp': timestamp}))
+    assert clients[0].writer.data == []
+    assert clients[1].writer.data == [current_time(packet, 2) + b'\x00']
+    assert clients[2].writer.data == [current_time(packet, 3) + b'\x00']
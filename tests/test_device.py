@@ -0,0 +1,24 @@
+from asyncio import run, wait_for
+
+import pytest
+
+from argb.Device import Device
+from argb.emulator import Emulator
+from argb.messages import build_request
+
+LIGHT = dict(index=0, start=0, end=5, start_color=(1, 0, 0), end_color=(0, 0, 1), ahds=(0, 0, 0, 0))
+
+
+@pytest.mark.parametrize('stack_measurements', [False, True])
+def test_stop_and_wait_commit_and_current_time(stack_measurements):
+    async def main():
+        with Emulator(realtime=False, startup_delay=0.1, stack_measurements=stack_measurements) as emulator:
+            async with Device(emulator.port) as device:
+                await wait_for(device.set_light(**LIGHT), 2)
+                # Commits aren't answered, so nothing is read for them.
+                await wait_for(device.commit(0), 2)
+                response = await wait_for(device.write(build_request(('current_time_request', True))), 2)
+                assert response.WhichOneof('payload') == 'current_time'
+            return emulator.commits
+
+    assert run(main()) == 1
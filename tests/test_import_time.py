@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Loaded by the subcommands which need them, not by starting the CLI.
+LAZY = ('pandas', 'serial_asyncio', 'messages_pb2')
+
+
+def imported_modules(module):
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join(filter(None, (ROOT, environment.get('PYTHONPATH'))))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=environment, capture_output=True, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[0].startswith('import time:'):
+            modules.add(fields[2].strip())
+    return modules
+
+
+def test_main_imports_lazily():
+    modules = imported_modules('argb.__main__')
+    assert 'argb.__main__' in modules
+    for name in LAZY:
+        assert not any(module == name or module.startswith(name + '.') or module.endswith('.' + name)
+                       for module in modules), f'{name} is imported'
+
+
+def test_emulator_does_not_import_the_serial_transport():
+    modules = imported_modules('argb.emulator')
+    assert 'argb.emulator' in modules
+    assert 'serial_asyncio' not in modules
+    assert 'argb.Device' not in modules
@@ -0,0 +1,34 @@
+import pytest
+
+from argb import bench
+from argb.messages import Response
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_verify_wire(seed):
+    bench.verify_wire(count=250, seed=seed)
+
+
+def test_verify_wire_catches_encode_mismatch(monkeypatch):
+    encode_request = bench.encode_request
+
+    def broken(key, *args):
+        data = bytearray(encode_request(key, *args))
+        data.append(0)
+        return data
+
+    monkeypatch.setattr(bench, 'encode_request', broken)
+    with pytest.raises(AssertionError):
+        bench.verify_wire(count=10)
+
+
+def test_verify_wire_catches_decode_mismatch(monkeypatch):
+    decode_response = bench.decode_response
+    response = Response()
+    response.log.id = 1 << 20
+    response.log.is_error = False
+    other = response.SerializeToString()
+
+    monkeypatch.setattr(bench, 'decode_response', lambda data: decode_response(other))
+    with pytest.raises(AssertionError):
+        bench.verify_wire(count=10)